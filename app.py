@@ -6,26 +6,39 @@
 import threading
 import time
 import json
+import logging
 import os
 import subprocess
+from functools import wraps
 #import webview
-import paho.mqtt.client as mqtt
 
-from flask import Flask, Response, request, redirect, url_for, jsonify, render_template
+from startup import TIMELINE, Deferred, NotReady
 
-from db_management import DBManagement
+from flask import Flask, Response, g, request, redirect, url_for, jsonify, render_template
 
-# Import your TreadmillSimulate as before
-from ble_treadmill import TreadmillSimulate
+from latency import LatencyTracker
+from health import HeartbeatRegistry, Watchdog, tick_asyncio
+from logging_setup import setup_logging
+from profiler import AsyncioMonitor, collapsed, sample_stacks
+from metrics import CONTENT_TYPE, REGISTRY, gauge, histogram
 
-# Import the new BLEConnection class
+# Import the new BLEConnection class (bleak is imported by the BLE thread)
 from ble_connection import BLEConnection
 
+# DBManagement (SQLAlchemy, APScheduler), MQTTPublisher (paho), TreadmillSimulate
+# (D-Bus, GLib) and session_export are imported by the threads that need them
+TIMELINE.mark("imports")
+
+logger = logging.getLogger("app")
+
 
 # Load the JSON file
 with open("config.json", "r") as file:
     config = json.load(file)
 
+# Log records are written by a listener thread, never by the BLE/GLib threads
+setup_logging(config.get("Logging"))
+
 # Access BLE-related settings from the "Settings" section
 settings = config["Settings"]
 limits = config["Limits"]
@@ -36,14 +49,23 @@ mqtt_broker = mqtt_settings["server"]
 mqtt_port = mqtt_settings["port"]
 mqtt_topic = mqtt_settings["topic"]
 mqtt_message = mqtt_settings["message"]
+mqtt_telemetry_topic = mqtt_settings.get("telemetry_topic")
+mqtt_telemetry_rate = mqtt_settings.get("telemetry_rate", 1.0)
+debug_settings = config.get("Debug", {})
+pace_settings = config.get("Pace", {})
+health_settings = config.get("Health", {})
 
 app = Flask(__name__)
 
+# How long a route waits for a subsystem still starting before answering 503
+STARTUP_WAIT = 30
 
-# Instantiate the class
-db_manager = DBManagement(config["Database"])
+HTTP_SECONDS = histogram("http_request_duration_seconds", "Flask request latency",
+                         ("route", "method", "status"))
+THREAD_ALIVE = gauge("thread_alive", "1 while the thread is running", ("thread",))
+MQTT_CONNECTED = gauge("mqtt_connected", "1 while connected to the MQTT broker")
+MQTT_QUEUED = gauge("mqtt_queued_messages", "Messages waiting for the broker")
 
-client = mqtt.Client()
 
 # Set environment variables from the JSON file
 env_vars = config["EnvironmentVariables"]
@@ -53,25 +75,141 @@ os.environ["XAUTHORITY"] = env_vars["XAUTHORITY"]  # Set XAUTHORITY
 
 # Create a Flask app
 
-# Instantiate your treadmill simulator
-treadmill = TreadmillSimulate(device_name=settings["device_name"])
+# Age of the treadmill data at each hop, served by /api/latency
+latency_tracker = LatencyTracker()
 
+# Every loop ticks its heartbeat from inside; /healthz and the systemd watchdog read them
+health_registry = HeartbeatRegistry(startup_grace=health_settings.get("startup_grace_s", 30))
+max_lag = health_settings.get("max_lag_s", 5)
 
-# Instantiate the BLEConnection class using values from the config
+# Instantiate the BLEConnection class using values from the config; the
+# treadmill simulator and the DB are attached by init_gatt() and init_db()
 ble_connection = BLEConnection(
-    treadmill=treadmill,  # Assuming treadmill is already defined in your code
-    db_manager=db_manager,
-    address=settings["address"],
+    treadmill=None,
+    db_manager=None,
+    address=settings.get("address", "auto"),
+    address_cache=settings.get("address_cache", "ftms_device.json"),
+    exclude_names=(settings["device_name"],),  # our own FTMS server, seen by the scan
     speed_characteristic_uuid=settings["speed_characteristic_uuid"],
     control_point_uuid=settings["control_point_uuid"],
     max_retries=settings["max_retries"],
-    limits=limits
+    limits=limits,
+    latency=latency_tracker,
+    pace_tau=pace_settings.get("tau_s", 5.0),
+    pace_window=pace_settings.get("window_s", 30.0),
+    pb_distance=pace_settings.get("pb_distance_m", 1000)
+)
+
+# Pending tasks and slow callbacks of the bleak loop, served by /debug/asyncio
+asyncio_monitor = AsyncioMonitor(
+    ble_connection.ble_loop,
+    debug=debug_settings.get("asyncio_debug", False),
+    slow_callback_ms=debug_settings.get("slow_callback_ms", 100)
 )
+profile_lock = threading.Lock()
+
+tick_asyncio(ble_connection.ble_loop, health_registry.register("ble_loop", max_lag))
+
+
+##############
+#   SUBSYSTEMS
+##############
+# Built in parallel background threads once Flask is up (see startup.py);
+# routes that need one wait for it with .get()
+
+def init_db():
+    from db_management import DBManagement
+    db_manager = DBManagement(config["Database"])
+
+    # Nightly rollup of old samples, batched deletes, vacuum and ANALYZE
+    if "Retention" in config:
+        db_manager.schedule_maintenance(config["Retention"])
+
+    # Weekly check that MySQL still matches SQLite, re-syncing what differs
+    db_manager.scheduler.add_job(
+        db_manager.reconcile_remote, 'cron', day_of_week='sun', hour=5,
+        id="reconcile_remote", coalesce=True, max_instances=1, replace_existing=True
+    )
+
+    # Nightly job moving the samples of finished runs to the columnar archive
+    archive_settings = config.get("Archive")
+    if archive_settings:
+        try:
+            from sample_archive import SampleArchive
+            sample_archive = SampleArchive(
+                db_manager,
+                directory=archive_settings.get("directory", "archive"),
+                min_age_hours=archive_settings.get("min_age_hours", 24),
+                rollup_seconds=config.get("Retention", {}).get("rollup_seconds", 60),
+                delete=archive_settings.get("delete", False)
+            )
+            db_manager.archive = sample_archive
+            db_manager.scheduler.add_job(
+                sample_archive.archive_finished_runs, 'cron',
+                hour=archive_settings.get("hour", 3), id="archive_samples", replace_existing=True
+            )
+        except ImportError as e:
+            print(f"Sample archive disabled: {e}")
+
+    db_manager.scheduler.add_job(
+        health_registry.register("scheduler", 30).beat, 'interval', seconds=10,
+        id="heartbeat", coalesce=True, max_instances=1, replace_existing=True
+    )
+    THREAD_ALIVE.labels(thread="scheduler").set_function(lambda: db_manager.scheduler.running)
+    ble_connection.db_manager = db_manager
+    ble_connection.load_personal_bests()
+    return db_manager
+
+
+def init_mqtt():
+    from mqtt_publisher import MQTTPublisher
+
+    # One MQTT connection for the whole app; connects (and reconnects) in the background
+    mqtt_publisher = MQTTPublisher(mqtt_broker, mqtt_port, client_id=settings["device_name"])
+    MQTT_CONNECTED.set_function(mqtt_publisher.connected.is_set)
+    MQTT_QUEUED.set_function(lambda: len(mqtt_publisher.queue))
+    mqtt_publisher.start()
+    if mqtt_telemetry_topic:
+        mqtt_publisher.start_telemetry(ble_connection.data_stream, mqtt_telemetry_topic, mqtt_telemetry_rate)
+        THREAD_ALIVE.labels(thread="mqtt_telemetry").set_function(
+            lambda: mqtt_publisher.telemetry_thread.is_alive())
+    return mqtt_publisher
+
+
+def init_gatt():
+    """
+    Run the GATT server (D-Bus, GLib loop) in its own thread. The adapter is
+    probed and only reset if registering fails (ble_treadmill.AdapterSetup).
+    """
+    with TIMELINE.phase("import ble_treadmill"):
+        from ble_treadmill import TreadmillSimulate
+    treadmill = TreadmillSimulate(device_name=settings["device_name"], latency=latency_tracker,
+                                  heartbeat=health_registry.register("glib_loop", max_lag),
+                                  advertising=config.get("Advertising"))
+    ble_connection.treadmill = treadmill
+    server_thread = threading.Thread(target=treadmill.start, name="gatt_server", daemon=True)
+    server_thread.start()
+    THREAD_ALIVE.labels(thread="gatt_server").set_function(server_thread.is_alive)
+    return treadmill, server_thread
+
+
+def init_ble():
+    """Connect to the treadmill once the DB and the GATT server are up."""
+    with TIMELINE.phase("import bleak"):
+        import bleak  # meanwhile the GATT server comes up
+    db.get()
+    gatt.get()
+    ble_thread = threading.Thread(target=ble_connection.start_ble_loop, name="ble", daemon=True)
+    ble_thread.start()
+    THREAD_ALIVE.labels(thread="ble").set_function(ble_thread.is_alive)
+    return ble_thread
+
+
+db = Deferred("db", init_db)
+mqtt = Deferred("mqtt", init_mqtt)
+gatt = Deferred("gatt", init_gatt)
+ble = Deferred("ble", init_ble)
 
-temp_average = {
-    "speed": [],
-    "bpm": []
-}
 
 # Create an API class that will be exposed to JavaScript
 class API:
@@ -82,6 +220,114 @@ class API:
             window.destroy()
 
 
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def observe_request(response):
+    start = g.pop("request_start", None)
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        HTTP_SECONDS.labels(route=route, method=request.method, status=response.status_code).observe(
+            time.perf_counter() - start)
+    return response
+
+
+@app.errorhandler(NotReady)
+def subsystem_not_ready(e):
+    return jsonify({"error": str(e)}), 503
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus text format: BLE, GATT, HTTP, DB, sync and thread metrics."""
+    return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
+
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    """
+    Lag of every loop (503 if one is stale or a thread died), age of the
+    last treadmill packet and rows waiting to be synced.
+    """
+    components = health_registry.components()
+    healthy = all(c["healthy"] for c in components.values())
+    rx_time = ble_connection.last_rx
+    try:
+        backlog = db.get(timeout=0).sync_backlog()
+    except Exception as e:
+        backlog = {"error": str(e)}
+    body = {
+        "healthy": healthy,
+        "components": components,
+        "ble_connected": bool(ble_connection.client and ble_connection.client.is_connected),
+        "last_packet_age_s": round(time.monotonic() - rx_time, 3) if rx_time is not None else None,
+        "sync_backlog": backlog,
+    }
+    return jsonify(body), 200 if healthy else 503
+
+
+def admin_only(view):
+    """
+    Debug endpoints: bearer token (Debug.token in config.json) or, without
+    a token, only requests from the kiosk itself (or an SSH tunnel).
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        token = debug_settings.get("token")
+        if token:
+            allowed = request.headers.get("Authorization") == f"Bearer {token}"
+        else:
+            allowed = request.remote_addr in ("127.0.0.1", "::1")
+        if not allowed:
+            return jsonify({"error": "forbidden"}), 403
+        return view(*args, **kwargs)
+    return wrapper
+
+
+@app.route('/debug/profile', methods=['GET'])
+@admin_only
+def debug_profile():
+    """
+    Sample the stacks of every thread for ?seconds= (default 30) at ?hz=
+    (default 100) and return them in the collapsed format, for
+    flamegraph.pl or speedscope. The session keeps running meanwhile.
+    """
+    try:
+        seconds = float(request.args.get("seconds", 30))
+        hz = float(request.args.get("hz", 100))
+    except ValueError:
+        return jsonify({"error": "seconds and hz must be numbers"}), 400
+    if not 0 < hz <= 1000:
+        return jsonify({"error": "hz must be in (0, 1000]"}), 400
+    if not profile_lock.acquire(blocking=False):
+        return jsonify({"error": "a profile is already running"}), 409
+    try:
+        counts = sample_stacks(seconds, interval=1 / hz)
+    finally:
+        profile_lock.release()
+    response = Response(collapsed(counts), content_type="text/plain; charset=utf-8")
+    response.headers["Content-Disposition"] = \
+        f"attachment; filename=profile-{time.strftime('%Y%m%d-%H%M%S')}.folded"
+    return response
+
+
+@app.route('/debug/asyncio', methods=['GET'])
+@admin_only
+def debug_asyncio():
+    """Pending tasks of the bleak loop and the last asyncio warnings."""
+    return jsonify(asyncio_monitor.snapshot())
+
+
+@app.route('/debug/startup', methods=['GET'])
+@admin_only
+def debug_startup():
+    """Startup timeline: phases (ms from the process start) and marks such as first_sample."""
+    return jsonify(TIMELINE.as_dict())
+
+
 @app.route('/')
 def index():
     return render_template('newindex.html')
@@ -89,34 +335,104 @@ def index():
 @app.route('/api/treadmill_data', methods=['GET'])
 def get_treadmill_data():
     """API endpoint to return treadmill data as JSON."""
-    speed = float(ble_connection.data_stream["speed"])
-    bpm = int(ble_connection.data_stream["bpm"])
-    if (speed > 0): 
-        temp_average["speed"].append(speed)   
-    if (bpm > 0):
-        temp_average["bpm"].append(bpm) 
     # Access the data_stream from our ble_connection instance
-    return jsonify(ble_connection.data_stream)
+    response = jsonify(ble_connection.data_stream)
+    rx_time = ble_connection.last_rx
+    if rx_time is not None:
+        latency_tracker.record("http", rx_time)
+        response.headers["X-Data-Age-Ms"] = f"{(time.monotonic() - rx_time) * 1000:.0f}"
+    return response
+
+
+@app.route('/api/latency', methods=['GET'])
+def get_latency():
+    """
+    Age of the treadmill data (ms since the BLE notification) when it was
+    decoded, rebroadcast, served by /api/treadmill_data and written to the
+    DB: percentiles over the last records and a histogram per hop.
+    """
+    return jsonify(latency_tracker.snapshot())
 
 
 @app.route('/save_session', methods=['POST'])
 def save_session():  
-    avg_speed = sum(temp_average["speed"]) / len(temp_average["speed"]) if len(temp_average["speed"]) > 0 else 0
-    avg_bpm = sum(temp_average["bpm"]) / len(temp_average["bpm"]) if len(temp_average["bpm"]) > 0 else 0
+    # Averaged over every packet since the last save (not over the polls of the open tabs)
+    avg_speed = ble_connection.session_average["speed"].mean()
+    avg_bpm = ble_connection.session_average["bpm"].mean()
     data = {
         "datetime": time.strftime("%Y-%m-%d %H:%M:%S"),
         "km": int(ble_connection.data_stream["distance"]*1000),
         "elapsed": ble_connection.data_stream["running_time"],
         "avg_speed": avg_speed,
         "avg_bpm": avg_bpm,
-        "kcal": ble_connection.data_stream["energy"]
+        "kcal": ble_connection.data_stream["energy"],
+        "run_id": ble_connection.run_id
     }
-    db_manager.save_local_session(data)
-    temp_average["speed"].clear()
-    temp_average["bpm"].clear()
+    db.get(STARTUP_WAIT).save_local_session(data)
+    ble_connection.flush_samples()
+    ble_connection.save_best_efforts()
+    ble_connection.session_average["speed"].clear()
+    ble_connection.session_average["bpm"].clear()
     return redirect(url_for('index'))
 
 
+@app.route('/api/sessions', methods=['GET'])
+def get_sessions():
+    """
+    Session history, newest first, one page at a time.
+    Query params: cursor (next_cursor of the previous page), limit,
+    from / to (YYYY-MM-DD), fields (comma separated column names).
+    """
+    try:
+        cursor = request.args.get('cursor', type=int)
+        limit = min(max(request.args.get('limit', 50, type=int), 1), 500)
+        fields = request.args.get('fields')
+        fields = [f.strip() for f in fields.split(',') if f.strip()] if fields else None
+        page = db.get(STARTUP_WAIT).list_local_sessions_page(
+            before_id=cursor,
+            limit=limit,
+            date_from=request.args.get('from'),
+            date_to=request.args.get('to'),
+            fields=fields
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(page)
+
+
+@app.route('/api/stats', methods=['GET'])
+def get_stats():
+    """Totals per week or month: /api/stats?group=week|month[&from=&to=]"""
+    try:
+        stats = db.get(STARTUP_WAIT).session_stats(
+            group=request.args.get('group', 'week'),
+            date_from=request.args.get('from'),
+            date_to=request.args.get('to')
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(stats)
+
+
+@app.route('/api/sessions/<int:run_id>/export', methods=['GET'])
+def export_session(run_id):
+    """Download a run as FIT, TCX or GPX: ?format=fit|tcx|gpx (default tcx)."""
+    from session_export import FORMATS, export_filename, export_run
+
+    fmt = request.args.get('format', 'tcx').lower()
+    try:
+        chunks = export_run(db.get(STARTUP_WAIT), run_id, fmt)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except LookupError as e:
+        return jsonify({"error": str(e)}), 404
+    return Response(
+        chunks,
+        mimetype=FORMATS[fmt],
+        headers={"Content-Disposition": f"attachment; filename={export_filename(run_id, fmt)}"}
+    )
+
+
 @app.route('/set_speed', methods=['POST'])
 def set_speed():
     """
@@ -164,58 +480,53 @@ def screen_off():
 
 @app.route('/shutdown', methods=['POST'])
 def shutdown():
-    try:
-        # Initialize MQTT client
-        client = mqtt.Client()
-        client.connect(mqtt_broker, mqtt_port)
-        print("Connected to MQTT broker successfully.")
-        client.publish(mqtt_topic, mqtt_message)
-        print(f"Message published to topic '{mqtt_topic}': {mqtt_message}")
-
-        # Disconnect from the broker
-        client.disconnect()
-        print("Disconnected from MQTT broker.")
-
-    except Exception as e:
-        print(f"An error occurred: {e}")
-        time.sleep(5)  # Wait for 5 seconds before shutting down
+    # The switch_off message must reach the broker before the board goes down
+    if not mqtt.get(STARTUP_WAIT).publish_and_wait(mqtt_topic, mqtt_message, timeout=3.0):
+        print(f"Could not publish '{mqtt_message}' to '{mqtt_topic}', shutdown cancelled.")
         return redirect(url_for('index'))
+    print(f"Message published to topic '{mqtt_topic}': {mqtt_message}")
 
     os.system("sudo shutdown now")  # Send shutdown command
     return "Server shutting down..."
 
 
-def reset_bluetooth():
-    print("Resetting Bluetooth interface...")
-    os.system("rfkill block bluetooth")
-    os.system("rfkill unblock bluetooth")
-
 def start_flask():
-    app.run(host='0.0.0.0', port=5000, debug=False)
+    from werkzeug.serving import make_server
+    server = make_server('0.0.0.0', 5000, app, threaded=True)
+    TIMELINE.mark("http_ready")
+    server.serve_forever()
 
 ##############
 #   MAIN APP
 ##############
 
 if __name__ == '__main__':
+    watchdog = None
     try:
+        # Start the Flask API first: the UI is served while the rest comes up
+        print("Starting Flask API...")
+        api = API()
+        flask_thread = threading.Thread(target=start_flask, name="flask", daemon=True)
+        flask_thread.start()
+        THREAD_ALIVE.labels(thread="flask").set_function(flask_thread.is_alive)
+
+        # DB, MQTT, GATT server and the BLE connection, in parallel
         print("Starting BLE connection...")
-        reset_bluetooth()
+        for subsystem in (db, mqtt, gatt, ble):
+            subsystem.start()
 
-        # Start BLE connection loop in a separate daemon thread
-        ble_thread = threading.Thread(target=ble_connection.start_ble_loop, daemon=True)
-        ble_thread.start()
+        # READY=1, then WATCHDOG=1 while every loop is healthy (Type=notify, WatchdogSec=)
+        health_registry.watch_thread("flask", flask_thread)
+        watchdog = Watchdog(health_registry)
+        watchdog.start()
 
-        # Start the treadmill server in its own thread
-        server_thread = threading.Thread(target=treadmill.start, daemon=True)
-        server_thread.start()
+        for subsystem in (db, mqtt, gatt, ble):
+            subsystem.done.wait()
+        TIMELINE.mark("started")
+        logger.info("Startup timeline:\n%s", TIMELINE.report())
 
-        # Start the Flask API     
-        print("Starting Flask API...")
-        # Start Flask in a separate thread
-        api = API()
-        flask_thread = threading.Thread(target=start_flask, daemon=True)
-        flask_thread.start()
+        # Serve until Ctrl+C
+        flask_thread.join()
 
         # Create a PyWebView window
         #window = webview.create_window(
@@ -233,12 +544,19 @@ if __name__ == '__main__':
     finally:
         #if window:
         #    window.destroy()
-        db_manager.shutdown()
-        treadmill.stop()
-        server_thread.join()
+        if watchdog:
+            watchdog.stop()
+        if db.ready:
+            db.get().shutdown()
+        if mqtt.ready:
+            mqtt.get().stop()
+        if gatt.ready:
+            treadmill, server_thread = gatt.get()
+            treadmill.stop()
+            server_thread.join()
         # Stop the asyncio loop & join the BLE thread
         ble_connection.disconnect()
         #ble_connection.ble_loop.stop()
-        ble_connection.disconnect()
-        ble_thread.join()
+        if ble.ready:
+            ble.get().join(timeout=5)
         print("Main app done.")
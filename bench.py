@@ -0,0 +1,625 @@
+# bench.py
+# Benchmarks of the hot paths, with stored baselines and a regression check.
+#
+#   decode   BLEConnection.decode_treadmill_data (our flags and all flags)
+#   build    the Treadmill Data packet of TreadmillDataCharacteristic
+#   api      /api/treadmill_data JSON under N concurrent HTTP clients
+#   storage  save_local_session, list_local_sessions and the paged list
+#            on a local DB of 10k / 100k (--full: 1M) sessions
+#   sync     sync_session and sync_pending_sessions against a SQLite
+#            stand-in for the remote MySQL DB
+#   pipeline the whole receive path without a radio: FakeTreadmill packets
+#            through connect_treadmill (with injected disconnects), the
+#            decoder and the local DB, while /api/treadmill_data is polled
+#   boot     cold start in a fresh interpreter, startup sequence of app.py:
+#            ms to the web UI served and to the first treadmill sample,
+#            which must also stay within --boot-budget-ms
+#   latency  replay_latency.py in a fresh interpreter (--latency-duration
+#            seconds, real time): fails if a hop is over its p99 budget
+#   soak     soak.py in a fresh interpreter (--soak-hours simulated):
+#            fails if memory keeps growing after the warm-up
+#
+# Everything runs offline in a temporary directory. Results are compared to
+# the baseline of this machine type (platform.machine(), e.g. "aarch64" on
+# the Orange Pi, "x86_64" on a PC) in bench_baselines.json.
+#
+# Usage: python bench.py                     run all, compare with the baseline
+#        python bench.py --only decode,api   run some of them
+#        python bench.py --save              run and store as the new baseline
+#        python bench.py --threshold 0.3     fail if 30% worse (default 25%)
+#
+# Exit code 1 if any metric regressed beyond the threshold, or a budget
+# (boot, latency) or the soak memory check failed.
+
+import argparse
+import datetime
+import http.client
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import redirect_stdout
+
+from flask import Flask, jsonify
+from werkzeug.serving import make_server
+
+from ble_connection import BLEConnection
+from latency import LatencyTracker
+from treadmill_simulator import (
+    ALL_FLAGS,
+    DEFAULT_FLAGS,
+    PERIPHERAL_FLAGS,
+    TreadmillSimulator,
+    encode_treadmill_data,
+    interval_workout,
+    steady_workout,
+)
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baselines.json")
+
+
+def best_rate(func, count, repeat=5):
+    """Operations per second of func() (which does count operations), best of repeat."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return count / best
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * q), len(ordered) - 1)]
+
+
+class _NullTreadmill:
+    """Stands in for the GATT server: the benchmarks measure the decoder."""
+
+    def set_measures(self, **measures):
+        pass
+
+
+# -------------------------
+# decode / build
+# -------------------------
+def bench_decode(args):
+    results = {}
+    for name, flags in (("default", DEFAULT_FLAGS), ("all_flags", ALL_FLAGS)):
+        # Under 1 km, so no lap (and no DB write) is triggered
+        simulator = TreadmillSimulator(steady_workout(minutes=5), rate_hz=10, flags=flags)
+        packets = [packet for _, packet in simulator.packets()]
+        connection = BLEConnection(_NullTreadmill(), db_manager=None)
+
+        def run():
+            for packet in packets:
+                connection.decode_treadmill_data(packet)
+            connection.average["speed"].clear()
+            connection.average["bpm"].clear()
+
+        results[f"decode.{name}.packets_per_s"] = best_rate(run, len(packets))
+    return results
+
+
+def bench_build(args):
+    values = [(10.0 + i % 50 / 10, i * 2.8, i // 10, i) for i in range(5000)]
+
+    def run():
+        for speed, distance, kcal, elapsed in values:
+            encode_treadmill_data(PERIPHERAL_FLAGS, speed=speed, distance=distance,
+                                  kcal=kcal, elapsed=elapsed)
+
+    results = {"build.packets_per_s": best_rate(run, len(values))}
+    try:
+        from ble_treadmill import measurement_packet
+        import dbus
+    except ImportError:
+        return results  # no D-Bus on this machine: the pure builder only
+
+    def run_dbus():
+        for speed, distance, kcal, elapsed in values:
+            packet = measurement_packet(speed, distance, kcal, elapsed)
+            dbus.Array([dbus.Byte(b) for b in packet], signature='y')
+
+    results["build.dbus_packets_per_s"] = best_rate(run_dbus, len(values))
+    return results
+
+
+# -------------------------
+# api
+# -------------------------
+def bench_api(args):
+    """
+    Same view as app.get_treadmill_data (app.py itself needs BlueZ and
+    config.json at import), on a data_stream filled by a full simulated
+    interval workout, served by the threaded werkzeug server.
+    """
+    latency = LatencyTracker()
+    connection = BLEConnection(_NullTreadmill(), db_manager=_LapSink(), latency=latency)
+    TreadmillSimulator(interval_workout(), rate_hz=1).run(connection.notification_handler,
+                                                          realtime=False)
+
+    app = Flask(__name__)
+
+    @app.route('/api/treadmill_data', methods=['GET'])
+    def get_treadmill_data():
+        response = jsonify(connection.data_stream)
+        latency.record("http", connection.last_rx)
+        response.headers["X-Data-Age-Ms"] = f"{(time.monotonic() - connection.last_rx) * 1000:.0f}"
+        return response
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)  # no access log per request
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    port = server.server_port
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    results = {}
+    try:
+        for clients in args.clients:
+            latencies = []
+            lock = threading.Lock()
+
+            def client():
+                mine = []
+                for _ in range(args.requests):
+                    start = time.perf_counter()
+                    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+                    conn.request("GET", "/api/treadmill_data")
+                    conn.getresponse().read()
+                    conn.close()
+                    mine.append(time.perf_counter() - start)
+                with lock:
+                    latencies.extend(mine)
+
+            threads = [threading.Thread(target=client) for _ in range(clients)]
+            start = time.perf_counter()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            wall = time.perf_counter() - start
+            results[f"api.c{clients}.requests_per_s"] = len(latencies) / wall
+            results[f"api.c{clients}.p95_ms"] = percentile(latencies, 0.95) * 1000
+    finally:
+        server.shutdown()
+    return results
+
+
+class _LapSink:
+    """Accepts the km rows written while the api data_stream is filled."""
+
+    def __init__(self):
+        self.rows = 0
+
+    def save_local_session(self, data):
+        self.rows += 1
+        return {"id": self.rows}, 201
+
+    def save_samples(self, run_id, samples):
+        pass
+
+    def touch_activity(self):
+        pass
+
+    def save_best_efforts(self, run_id, efforts):
+        return []
+
+
+# -------------------------
+# storage / sync
+# -------------------------
+def _open_db(workdir, name):
+    from db_management import DBManagement
+    config = {
+        "localfile": os.path.join(workdir, f"{name}.db"),
+        "remote_uri": f"sqlite:///{os.path.join(workdir, name + '-remote.db')}",
+        "device_id": "bench",
+        "Mysql": {},
+    }
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        return DBManagement(config)
+
+
+def _close_db(db_manager):
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        db_manager.shutdown()
+
+
+def _fill_sessions(db_manager, rows, needs_sync=False):
+    """Bulk insert rows past sessions (1 km each, 20 per run)."""
+    from sqlalchemy import insert
+    from db_management import LocalSession, local_db, new_ulid
+    base = datetime.datetime(2020, 1, 1)
+    with db_manager.app.app_context():
+        for offset in range(0, rows, 10000):
+            batch = []
+            for i in range(offset, min(offset + 10000, rows)):
+                batch.append({
+                    "id": i + 1,
+                    "datetime": (base + datetime.timedelta(minutes=6 * i)).strftime("%Y-%m-%d %H:%M:%S"),
+                    "km": 1000 * (i % 20),
+                    "elapsed": 360 * (i % 20),
+                    "avg_speed": 10.0,
+                    "avg_bpm": 130.0,
+                    "kcal": 60 * (i % 20),
+                    "needs_sync": needs_sync,
+                    "run_id": i - i % 20 + 1,
+                    "uid": new_ulid(),
+                })
+            local_db.session.execute(insert(LocalSession), batch)
+        local_db.session.commit()
+
+
+def _session_data(i):
+    return {
+        "datetime": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "km": 1000 * (i % 10),
+        "elapsed": 360 * (i % 10),
+        "avg_speed": 10.0,
+        "avg_bpm": 130.0,
+        "kcal": 60 * (i % 10),
+        "run_id": None,
+    }
+
+
+def bench_storage(args):
+    results = {}
+    for rows in args.rows:
+        with tempfile.TemporaryDirectory() as workdir:
+            db_manager = _open_db(workdir, f"storage{rows}")
+            try:
+                _fill_sessions(db_manager, rows)
+                label = f"storage.{rows // 1000}k"
+
+                saves = 50
+                with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+                    start = time.perf_counter()
+                    for i in range(saves):
+                        db_manager.save_local_session(_session_data(i))
+                    results[f"{label}.save_per_s"] = saves / (time.perf_counter() - start)
+
+                start = time.perf_counter()
+                listed = len(db_manager.list_local_sessions())
+                results[f"{label}.list_rows_per_s"] = listed / (time.perf_counter() - start)
+
+                results[f"{label}.page_per_s"] = best_rate(
+                    lambda: db_manager.list_local_sessions_page(limit=50), 1)
+            finally:
+                _close_db(db_manager)
+    return results
+
+
+def bench_sync(args):
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        db_manager = _open_db(workdir, "sync")
+        try:
+            rows = args.sync_rows
+            _fill_sessions(db_manager, rows, needs_sync=True)
+            singles = min(200, rows)
+            with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+                start = time.perf_counter()
+                for session_id in range(1, singles + 1):
+                    db_manager.sync_session(session_id)
+                results["sync.single_per_s"] = singles / (time.perf_counter() - start)
+
+                start = time.perf_counter()
+                db_manager.sync_pending_sessions()
+                results["sync.batch_rows_per_s"] = (rows - singles) / (time.perf_counter() - start)
+        finally:
+            _close_db(db_manager)
+    return results
+
+
+# -------------------------
+# pipeline
+# -------------------------
+def bench_pipeline(args):
+    """
+    Packets of an interval workout served by ble_transport.FakeTreadmill as
+    fast as the BLE loop takes them, through connect_treadmill (the link is
+    dropped every --pipeline-disconnect-every packets and reconnected), the
+    decoder and the sample and lap writes to a local SQLite DB, while one
+    client polls /api/treadmill_data.
+    """
+    from ble_transport import FakeTreadmill
+
+    simulator = TreadmillSimulator(interval_workout(), rate_hz=10)
+    packets = [packet for _, packet in simulator.packets()]  # encoded up front, not measured
+    with tempfile.TemporaryDirectory(prefix="bench-pipeline-") as workdir:
+        db_manager = _open_db(workdir, "pipeline")
+        fake = FakeTreadmill(packets=packets, disconnect_after=args.pipeline_disconnect_every)
+        connection = BLEConnection(_NullTreadmill(), db_manager=db_manager,
+                                   transport_factory=fake.transport)
+
+        app = Flask(__name__)
+
+        @app.route('/api/treadmill_data', methods=['GET'])
+        def get_treadmill_data():
+            return jsonify(connection.data_stream)
+
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+        server = make_server("127.0.0.1", 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        latencies = []
+
+        def poll():
+            while not fake.finished.is_set():
+                start = time.perf_counter()
+                conn = http.client.HTTPConnection("127.0.0.1", server.server_port, timeout=10)
+                conn.request("GET", "/api/treadmill_data")
+                conn.getresponse().read()
+                conn.close()
+                latencies.append(time.perf_counter() - start)
+
+        ble_thread = threading.Thread(target=connection.start_ble_loop, name="ble")
+        poller = threading.Thread(target=poll)
+        start = time.perf_counter()
+        ble_thread.start()
+        poller.start()
+        try:
+            if not fake.finished.wait(300):
+                raise RuntimeError(f"pipeline stalled after {fake.delivered} of {len(packets)} packets")
+            wall = time.perf_counter() - start
+        finally:
+            connection.disconnect()
+            ble_thread.join(10)
+            poller.join(10)
+            server.shutdown()
+            connection.flush_samples()
+            _close_db(db_manager)
+    if fake.delivered != len(packets) or fake.connects != fake.disconnects + 1:
+        raise RuntimeError(f"pipeline lost packets or connections: {fake.delivered}/{len(packets)} "
+                           f"packets, {fake.connects} connects, {fake.disconnects} drops")
+    print(f"[bench]   {len(packets)} packets, {fake.disconnects} reconnects, "
+          f"{len(latencies)} API requests")
+    return {
+        "pipeline.packets_per_s": len(packets) / wall,
+        "pipeline.api_p95_ms": percentile(latencies, 0.95) * 1000 if latencies else 0.0,
+    }
+
+
+# -------------------------
+# boot
+# -------------------------
+def boot_child(workdir):
+    """
+    The startup sequence of app.py __main__ in this fresh process: Flask
+    first, then the DB, the MQTT client and the BLE side in parallel
+    (Deferred), the simulator standing in for the treadmill. BlueZ, the
+    adapter reset and the radio connection are not part of it. Prints the
+    startup timeline as JSON.
+    """
+    from startup import TIMELINE, Deferred
+    TIMELINE.mark("imports")
+
+    app = Flask(__name__)
+    connection = BLEConnection(None, db_manager=None)
+
+    @app.route('/api/treadmill_data', methods=['GET'])
+    def get_treadmill_data():
+        return jsonify(connection.data_stream)
+
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    TIMELINE.mark("http_ready")
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def init_db():
+        connection.db_manager = _open_db(workdir, "boot")
+        return connection.db_manager
+
+    def init_mqtt():
+        from mqtt_publisher import MQTTPublisher
+        return MQTTPublisher("127.0.0.1", 1883, client_id="bench-boot")  # not started
+
+    def init_ble():
+        import bleak  # noqa: F401  (imported by the BLE thread in app.py)
+        db.get()
+        connection.treadmill = _NullTreadmill()
+        simulator = TreadmillSimulator(steady_workout(minutes=1), rate_hz=10)
+        for _, packet in simulator.packets():
+            connection.notification_handler(None, packet)
+            break
+
+    db = Deferred("db", init_db)
+    subsystems = [db, Deferred("mqtt", init_mqtt), Deferred("ble", init_ble)]
+    for subsystem in subsystems:
+        subsystem.start()
+    for subsystem in subsystems:
+        subsystem.get()
+    server.shutdown()
+    _close_db(db.get())
+    print(json.dumps(TIMELINE.as_dict()))
+
+
+def bench_boot(args):
+    """Median of --boot-runs cold starts, each in a new interpreter."""
+    runs = []
+    for _ in range(args.boot_runs):
+        with tempfile.TemporaryDirectory(prefix="bench-boot-") as workdir:
+            process = subprocess.run([sys.executable, os.path.abspath(__file__), "--boot-child", workdir],
+                                     capture_output=True, text=True, cwd=os.path.dirname(BASELINE_FILE))
+        if process.returncode != 0:
+            raise RuntimeError(f"boot child failed:\n{process.stderr}")
+        runs.append(json.loads(process.stdout.strip().splitlines()[-1]))
+    marks = [run["marks"] for run in runs]
+    slowest = max(runs, key=lambda run: run["marks"]["first_sample"])
+    for phase in slowest["phases"]:
+        print(f"[bench]   {phase['start_ms']:8.1f} ms + {phase['duration_ms']:7.1f} ms  {phase['name']}")
+    return {
+        "boot.imports_ms": statistics.median(m["imports"] for m in marks),
+        "boot.http_ready_ms": statistics.median(m["http_ready"] for m in marks),
+        "boot.first_sample_ms": statistics.median(m["first_sample"] for m in marks),
+    }
+
+
+def _run_check(script, argv):
+    """
+    Run a pass/fail script of this repo (exit code 1 on failure) in a new
+    interpreter with --json; returns its exit code and the JSON results
+    of its last output line. The report is echoed.
+    """
+    process = subprocess.run([sys.executable, script, *argv, "--json"],
+                             capture_output=True, text=True, cwd=os.path.dirname(BASELINE_FILE))
+    lines = process.stdout.strip().splitlines()
+    try:
+        report = json.loads(lines[-1])
+    except (IndexError, ValueError):
+        raise RuntimeError(f"{script} failed:\n{process.stderr}")
+    for line in lines[:-1]:
+        print(f"[bench]   {line}")
+    return process.returncode, report
+
+
+def bench_latency(args):
+    """
+    replay_latency.py: checked against its own p99 budgets only (the p99 of
+    a short replay depends on whether it includes a lap write, too noisy
+    for the baseline comparison).
+    """
+    code, report = _run_check("replay_latency.py", ["--duration", str(args.latency_duration)])
+    if code != 0:
+        args.failed_checks.append(f"latency over budget: {', '.join(report['failed'])}")
+    return {}
+
+
+def bench_soak(args):
+    """soak.py: simulated packets per second; fails if memory keeps growing."""
+    code, report = _run_check("soak.py", ["--hours", str(args.soak_hours)])
+    if code != 0:
+        args.failed_checks.append(f"memory keeps growing: {', '.join(report['failed'])}")
+    return {"soak.packets_per_s": report["packets_per_s"]}
+
+
+BENCHMARKS = {
+    "decode": bench_decode,
+    "build": bench_build,
+    "api": bench_api,
+    "storage": bench_storage,
+    "sync": bench_sync,
+    "pipeline": bench_pipeline,
+    "boot": bench_boot,
+    "latency": bench_latency,
+    "soak": bench_soak,
+}
+
+
+# -------------------------
+# Baselines
+# -------------------------
+def lower_is_better(metric):
+    return metric.endswith("_ms")
+
+
+def compare(results, baseline, threshold):
+    """Lines of the report and the list of regressed metrics."""
+    lines = []
+    regressions = []
+    for metric, value in sorted(results.items()):
+        reference = baseline.get(metric)
+        if not reference:
+            lines.append(f"  {metric:40s} {value:12.1f}   (no baseline)")
+            continue
+        if lower_is_better(metric):
+            change = reference / value - 1 if value else 0.0
+        else:
+            change = value / reference - 1
+        status = "ok"
+        if change < -threshold:
+            status = "REGRESSION"
+            regressions.append(metric)
+        lines.append(f"  {metric:40s} {value:12.1f}   baseline {reference:12.1f}   "
+                     f"{change:+7.1%}  {status}")
+    return lines, regressions
+
+
+def load_baselines():
+    try:
+        with open(BASELINE_FILE, "r") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Treadmill hot path benchmarks.")
+    parser.add_argument("--only", help="comma separated: " + ",".join(BENCHMARKS))
+    parser.add_argument("--save", action="store_true", help="store the results as the baseline")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="allowed slowdown before failing (0.25 = 25%%)")
+    parser.add_argument("--machine", default=platform.machine(), help="baseline key")
+    parser.add_argument("--full", action="store_true", help="storage up to 1M sessions")
+    parser.add_argument("--clients", default="1,4,16", help="api concurrent clients")
+    parser.add_argument("--requests", type=int, default=200, help="api requests per client")
+    parser.add_argument("--sync-rows", type=int, default=2000)
+    parser.add_argument("--pipeline-disconnect-every", type=int, default=5000,
+                        help="pipeline packets between injected disconnects")
+    parser.add_argument("--boot-runs", type=int, default=3, help="cold starts measured")
+    parser.add_argument("--boot-budget-ms", type=float, default=5000,
+                        help="max ms from process start to the first treadmill sample")
+    parser.add_argument("--latency-duration", type=float, default=30,
+                        help="seconds of workout replayed in real time")
+    parser.add_argument("--soak-hours", type=float, default=6, help="simulated hours of the soak")
+    parser.add_argument("--boot-child", metavar="WORKDIR", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    args.failed_checks = []  # budgets and checks that failed, besides regressions
+    if args.boot_child:
+        boot_child(args.boot_child)
+        return 0
+    args.clients = [int(c) for c in args.clients.split(",")]
+    args.rows = [10000, 100000, 1000000] if args.full else [10000, 100000]
+
+    names = args.only.split(",") if args.only else list(BENCHMARKS)
+    unknown = [n for n in names if n not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmarks: {unknown}")
+
+    results = {}
+    for name in names:
+        print(f"[bench] {name}...", flush=True)
+        start = time.perf_counter()
+        results.update(BENCHMARKS[name](args))
+        print(f"[bench] {name} done in {time.perf_counter() - start:.1f}s", flush=True)
+
+    baselines = load_baselines()
+    baseline = baselines.get(args.machine, {}).get("results", {})
+    lines, regressions = compare(results, baseline, args.threshold)
+    print(f"Results on {args.machine} (Python {platform.python_version()}):")
+    print("\n".join(lines))
+
+    if args.save:
+        entry = baselines.setdefault(args.machine, {"results": {}})
+        entry["results"].update({k: round(v, 1) for k, v in results.items()})
+        entry["python"] = platform.python_version()
+        entry["saved"] = datetime.date.today().isoformat()
+        with open(BASELINE_FILE, "w") as file:
+            json.dump(baselines, file, indent=2, sort_keys=True)
+            file.write("\n")
+        print(f"Baseline for {args.machine} saved to {BASELINE_FILE}.")
+        return 0
+
+    first_sample = results.get("boot.first_sample_ms")
+    if first_sample is not None and first_sample > args.boot_budget_ms:
+        args.failed_checks.append(f"boot to first sample {first_sample:.0f} ms, "
+                                  f"over the {args.boot_budget_ms:.0f} ms budget")
+    for failure in args.failed_checks:
+        print(f"FAILED: {failure}")
+    if regressions:
+        print(f"{len(regressions)} regression(s) beyond {args.threshold:.0%}: {', '.join(regressions)}")
+        return 1
+    if args.failed_checks:
+        return 1
+    print("No regressions.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
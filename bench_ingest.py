@@ -0,0 +1,106 @@
+# bench_ingest.py
+# Throughput benchmark of the ingest service on localhost: dozens of
+# simulated kiosks POST gzip NDJSON batches of sample frames at the same
+# time, and the frames per second accepted by the server are reported.
+# Only the frames the server counted as accepted in /stats are used; any
+# failed request or server error fails the run (exit code 1).
+#
+# Usage: python bench_ingest.py [--kiosks 24] [--batches 20] [--frames 300] [--db sqlite:///bench_ingest.db]
+
+import argparse
+import gzip
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from werkzeug.serving import make_server
+
+from ingest_server import create_app
+
+
+def kiosk(device_id, url, batches, frames, latencies, failures):
+    local_id = 0
+    for batch in range(batches):
+        lines = []
+        for _ in range(frames):
+            local_id += 1
+            lines.append(json.dumps({
+                "type": "sample", "device_id": device_id, "local_id": local_id,
+                "run_uid": f"{device_id}-run", "ts": time.time(), "elapsed": local_id,
+                "distance": local_id * 3, "speed": 10.5, "bpm": 140, "kcal": local_id // 10,
+            }, separators=(",", ":")))
+        body = gzip.compress("\n".join(lines).encode("utf-8"), compresslevel=6)
+        request = urllib.request.Request(url, data=body, method="POST", headers={
+            "Content-Type": "application/x-ndjson", "Content-Encoding": "gzip"})
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request, timeout=60) as response:
+                response.read()
+        except (urllib.error.URLError, OSError) as e:
+            failures.append(f"{device_id} batch {batch}: {e}")
+            continue
+        latencies.append(time.perf_counter() - start)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Ingest service throughput benchmark.")
+    parser.add_argument("--kiosks", type=int, default=24)
+    parser.add_argument("--batches", type=int, default=20, help="requests per kiosk")
+    parser.add_argument("--frames", type=int, default=300, help="frames per request")
+    parser.add_argument("--db", default=f"sqlite:///{os.path.abspath('bench_ingest.db')}")
+    parser.add_argument("--port", type=int, default=8089)
+    args = parser.parse_args(argv)
+
+    if args.db.startswith("sqlite:///"):
+        path = args.db[len("sqlite:///"):]
+        if os.path.exists(path):
+            os.remove(path)
+
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)  # no line per request
+    app = create_app(args.db)
+    server = make_server("127.0.0.1", args.port, app, threaded=True)
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    url = f"http://127.0.0.1:{args.port}/ingest"
+
+    latencies = []
+    failures = []
+    threads = [
+        threading.Thread(target=kiosk,
+                         args=(f"kiosk-{n:02d}", url, args.batches, args.frames, latencies, failures))
+        for n in range(args.kiosks)
+    ]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - start
+    with urllib.request.urlopen(f"http://127.0.0.1:{args.port}/stats", timeout=10) as response:
+        stats = json.load(response)
+    server.shutdown()
+
+    sent = args.kiosks * args.batches * args.frames
+    accepted = stats["samples"]
+    print(f"{args.kiosks} kiosks x {args.batches} batches x {args.frames} frames: "
+          f"{accepted} of {sent} frames accepted in {wall:.2f}s -> {accepted / wall:.0f} frames/s")
+    if latencies:
+        latencies.sort()
+        p50 = latencies[len(latencies) // 2]
+        p95 = latencies[max(int(len(latencies) * 0.95) - 1, 0)]
+        print(f"request p50 {p50 * 1000:.0f} ms, p95 {p95 * 1000:.0f} ms")
+    for failure in failures[:10]:
+        print(f"  failed: {failure}")
+    if failures or stats["errors"] or accepted != sent:
+        print(f"FAILED: {len(failures)} requests failed, {stats['errors']} errors on the server")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,127 @@
+# best_efforts.py
+# Fastest time of a run over the standard distances (400 m, 1 km, 5 km,
+# 10 km, half marathon).
+#
+# BestEffortTracker takes the cumulative (elapsed, distance) of the run one
+# sample at a time. For each distance it keeps a pointer to the last point
+# at least that far behind the newest one: a two-pointer sliding window
+# over the cumulative distance, so a whole run is one O(n) pass and a live
+# sample costs O(1) amortised. The start of the window is interpolated
+# inside its segment, so 1 s elapsed steps still give sub-second efforts.
+# Points behind the left pointer of every window are dropped as the run
+# goes on, so memory stays bounded by the longest distance not covered yet
+# (one point per metre gained at most), not by the length of the run.
+#
+# BLEConnection feeds it from record_sample, one point per stored sample;
+# when a run is closed the efforts are written with
+# DBManagement.save_best_efforts(), which also updates the all-time
+# personal_bests table that the kiosk reads to show the "PB pace".
+#
+#   efforts = best_efforts(db_manager.iter_run_samples(run_id))   # a stored run
+
+TRIM_SIZE = 1024  # points kept before the first trim of the history
+
+DISTANCES = {  # m -> name
+    400: "400m",
+    1000: "1k",
+    5000: "5k",
+    10000: "10k",
+    21097: "half",
+}
+
+
+class Effort:
+    __slots__ = ("distance", "seconds", "start", "end")
+
+    def __init__(self, distance, seconds, start, end):
+        self.distance = distance  # m
+        self.seconds = seconds
+        self.start = start  # elapsed s of the run where it started
+        self.end = end
+
+    def pace(self):
+        """Seconds per km."""
+        return self.seconds * 1000 / self.distance
+
+    def as_dict(self):
+        return {"distance": self.distance, "seconds": round(self.seconds, 1),
+                "start": round(self.start, 1), "end": self.end}
+
+    def __repr__(self):
+        return f"Effort({DISTANCES.get(self.distance, self.distance)}, {self.seconds:.1f} s)"
+
+
+class BestEffortTracker:
+    """Best efforts of one run, updated sample by sample."""
+
+    def __init__(self, distances=tuple(DISTANCES)):
+        self.distances = sorted(distances)
+        self.reset()
+
+    def reset(self):
+        self.times = []      # elapsed s of every sample that gained distance
+        self.positions = []  # cumulative distance m
+        self.start = {d: 0 for d in self.distances}  # index of the window start point
+        self.best = {}       # distance -> Effort
+        self.trim_size = TRIM_SIZE  # trim the history when it reaches this length
+
+    def add(self, elapsed, distance):
+        """
+        One sample: elapsed s and cumulative distance m of the run.
+        Returns the distances whose best effort improved (usually none).
+        """
+        positions = self.positions
+        if positions and distance <= positions[-1]:
+            return ()  # no progress: nothing can improve
+        times = self.times
+        times.append(elapsed)
+        positions.append(distance)
+        improved = []
+        for d in self.distances:
+            target = distance - d
+            if target < positions[0]:
+                break  # not covered yet, nor the longer ones (sorted)
+            i = self.start[d]
+            while positions[i + 1] <= target:
+                i += 1
+            self.start[d] = i
+            # Interpolate where the window starts, between points i and i + 1
+            d0, d1 = positions[i], positions[i + 1]
+            t0, t1 = times[i], times[i + 1]
+            start = t0 + (t1 - t0) * (target - d0) / (d1 - d0)
+            seconds = elapsed - start
+            best = self.best.get(d)
+            if seconds > 0 and (best is None or seconds < best.seconds):
+                self.best[d] = Effort(d, seconds, start, elapsed)
+                improved.append(d)
+        if len(positions) >= self.trim_size:
+            self._trim()
+        return improved
+
+    def _trim(self):
+        """
+        Drop the points before the slowest window start. The next trim waits
+        until the history has doubled, so trimming is O(1) amortised.
+        """
+        first = min(self.start.values())
+        if first:
+            del self.times[:first]
+            del self.positions[:first]
+            for d in self.start:
+                self.start[d] -= first
+        self.trim_size = max(TRIM_SIZE, 2 * len(self.positions))
+
+    def efforts(self):
+        """{distance: Effort} reached so far."""
+        return dict(self.best)
+
+
+def best_efforts(samples, distances=tuple(DISTANCES)):
+    """
+    Best efforts of a stored run in one pass; samples are
+    DBManagement.iter_run_samples rows (ts, elapsed, distance, ...) in order.
+    """
+    tracker = BestEffortTracker(distances)
+    for _, elapsed, distance, *_ in samples:
+        tracker.add(elapsed, distance)
+    return tracker.efforts()
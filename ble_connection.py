@@ -1,11 +1,54 @@
 # ble_connection.py
 
 import asyncio
+import logging
+import threading
 import time
 import struct
-from bleak import BleakClient
 from datetime import datetime, timedelta
 
+from best_efforts import DISTANCES, BestEffortTracker
+from ble_transport import BleakTransport
+from logging_setup import PACKET_LOGGER
+from metrics import counter, gauge, histogram
+from pace_estimator import PaceEstimator, format_pace
+from startup import TIMELINE
+
+logger = logging.getLogger(__name__)
+packet_log = logging.getLogger(PACKET_LOGGER)
+
+PACE_PUBLISH_INTERVAL = 0.25  # s, smoothed pace updated and copied to data_stream at most this often
+
+NOTIFICATIONS = counter("ble_notifications_total", "Treadmill Data notifications received")
+DECODE_ERRORS = counter("ble_decode_errors_total", "Notifications that could not be decoded")
+DECODE_SECONDS = histogram("ble_decode_seconds", "Time spent handling one notification")
+CONNECT_ATTEMPTS = counter("ble_connect_attempts_total", "Connection attempts to the treadmill",
+                           ("result",))
+CONNECTED = gauge("ble_connected", "1 while connected to the treadmill")
+RECONNECTS = counter("ble_reconnects_total", "Connections to the treadmill lost and retried")
+
+
+class RunningAverage:
+    """Mean of a stream of values in constant memory."""
+
+    __slots__ = ("total", "count")
+
+    def __init__(self):
+        self.total = 0.0
+        self.count = 0
+
+    def add(self, value):
+        self.total += value
+        self.count += 1
+
+    def mean(self):
+        return self.total / self.count if self.count > 0 else 0
+
+    def clear(self):
+        self.total = 0.0
+        self.count = 0
+
+
 class BLEConnection:
     """
     Encapsulates all BLE connection logic for treadmill data.
@@ -15,7 +58,7 @@ class BLEConnection:
         self,
         treadmill,  # Pass your TreadmillSimulate instance
         db_manager,  # Pass your DBManagement instance
-        address="FF:71:4E:77:4B:DB",  # default treadmill MAC address
+        address="FF:71:4E:77:4B:DB",  # treadmill MAC address, or "auto" to scan for it
         speed_characteristic_uuid="00002acd-0000-1000-8000-00805f9b34fb",
         control_point_uuid = "00002ace-0000-1000-8000-00805f9b34fb",
         max_retries=5,
@@ -24,20 +67,44 @@ class BLEConnection:
             "speed_red": 12.0,
             "bpm_yellow": 120,
             "bpm_red": 140
-        }
+        },
+        latency=None,  # optional LatencyTracker
+        address_cache="ftms_device.json",  # last treadmill found when address is "auto"
+        exclude_names=(),  # FTMS devices never to connect to (e.g. our own GATT server)
+        scan_timeout=15.0,
+        transport_factory=BleakTransport,  # (address, disconnected_callback) -> transport, see ble_transport.py
+        pace_tau=5.0,  # s, smoothing of speed_smooth / pace_smooth
+        pace_window=30.0,  # s, window of speed_30s / pace_30s
+        pb_distance=1000  # m, best effort whose all-time pace is shown as pb_pace
     ):
         self.treadmill = treadmill
         self.db_manager = db_manager
         self.address = address
+        self.auto_address = not address or str(address).lower() == "auto"
+        self.address_cache = address_cache
+        self.exclude_names = tuple(exclude_names)
+        self.scan_timeout = scan_timeout
+        self.transport_factory = transport_factory
+        self.stopping = False
+        self.pace = PaceEstimator(tau=pace_tau, window=pace_window)
+        self.pace_published = None  # time.monotonic() of the last pace update
+        self.best_efforts = BestEffortTracker()  # fastest 400 m ... half of the current run
+        self.personal_bests = {}  # distance m -> all-time best s, loaded by load_personal_bests()
+        self.pb_distance = pb_distance
         self.speed_characteristic_uuid = speed_characteristic_uuid
-        self.control_point_uuid = control_point_uuid,
+        self.control_point_uuid = control_point_uuid
         self.max_retries = max_retries
         self.limits = limits
+        self.latency = latency
 
         # Shared data
-        self.average = {   # Temporary storage for average speed and bpm
-            "speed": [],
-            "bpm": []
+        self.average = {   # Average speed and bpm of the current km
+            "speed": RunningAverage(),
+            "bpm": RunningAverage()
+        }
+        self.session_average = {   # Average speed and bpm since the last saved session
+            "speed": RunningAverage(),
+            "bpm": RunningAverage()
         }
         self.data_stream = {
             "speed": 0.0,
@@ -49,12 +116,21 @@ class BLEConnection:
             "bpm": 0,
             "limits": limits
         }
+        self.data_stream.update(self.pace.values())
+        self.publish_best_efforts()
         self.last_update = time.time()
         self.running_start_time = None
+        self.run_id = None  # id of the start row of the current run in the local DB
+        self.samples = []  # per-packet samples waiting to be written to the local DB
+        self.samples_flush_size = 30
+        self.samples_lock = threading.Lock()  # flush_samples() is also called from Flask
+        self.samples_rx = []  # receive time of each buffered sample, for the latency tracker
+        self.last_rx = None  # time.monotonic() when the last packet arrived
 
         # Create a dedicated event loop for BLE
         self.ble_loop = asyncio.new_event_loop()
-        self.client = None
+        self.client = None  # transport of the current connection
+        self.disconnected = None  # asyncio.Event of the current connection
         self.indicate: asyncio.Future[bytes]
         
 
@@ -75,19 +151,24 @@ class BLEConnection:
     def decode_treadmill_data(self, value):
         """
         Decode treadmill speed data.
-        Assumes speed is in bytes 2 and 3 (little-endian format), in cm/s.
+        Speed is in bytes 2 and 3 (little-endian format), in 0.01 km/h,
+        unless flag bit 0 (More Data) is set.
         """
-        speed_raw = int.from_bytes(value[2:4], byteorder="little", signed=False)
-        if (speed_raw > 0):
-            self.average["speed"].append(speed_raw / 100)
-        self.data_stream["speed"] = speed_raw / 100  # km/h
-        self.data_stream["pace"] = self.convert_kmh_to_pace(speed_raw)
-
         # Extract flags (2 bytes, little-endian)
         flags = int.from_bytes(value[0:2], byteorder='little')
+        distance = None  # m, if the packet carries it
 
-        # Initial position (2 octets for flags + 2 octets for instantaneous speed)
-        next_position = 4
+        if not flags & (1 << 0):
+            speed_raw = int.from_bytes(value[2:4], byteorder="little", signed=False)
+            if (speed_raw > 0):
+                self.average["speed"].add(speed_raw / 100)
+                self.session_average["speed"].add(speed_raw / 100)
+            self.data_stream["speed"] = speed_raw / 100  # km/h
+            self.data_stream["pace"] = self.convert_kmh_to_pace(speed_raw)
+            # Initial position (2 octets for flags + 2 octets for instantaneous speed)
+            next_position = 4
+        else:
+            next_position = 2
 
         # Check each flag to identify the offsets in the data
         if flags & (1 << 1):
@@ -127,15 +208,13 @@ class BLEConnection:
             pos_force_belt = next_position
             next_position += 4
 
-        # Instantaneous speed
-        speed = int.from_bytes(value[2:4], byteorder='little') / 100
-
         # Heart rate
         if 'pos_hr' in locals():
             bpm = value[pos_hr]
             self.data_stream["bpm"] = bpm
             if (bpm > 0):
-                self.average["bpm"].append(bpm)              
+                self.average["bpm"].add(bpm)
+                self.session_average["bpm"].add(bpm)              
 
 
         # Calories
@@ -159,7 +238,13 @@ class BLEConnection:
             )
             distance_complement = value[pos_tot_distance + 2] << 16
             distance += distance_complement
+            if distance < round(self.data_stream["distance"] * 1000):
+                # The treadmill counters went back: a new workout started
+                self.start_new_run()
             self.data_stream["distance"] = distance / 1000
+            # Last known values, when this packet does not carry them
+            elapsed_time = self.data_stream["running_time"]
+            kcal = self.data_stream["energy"]
 
             total_km = int(self.data_stream["distance"])
             # Track average speed and pace each km
@@ -175,15 +260,16 @@ class BLEConnection:
                         "avg_bpm": 0,
                         "kcal": 0
                     }
-                    self.db_manager.save_local_session(data)
-                avg_speed = sum(self.average["speed"]) / len(self.average["speed"]) if len(self.average["speed"]) > 0 else 0
-                avg_bpm = sum(self.average["bpm"]) / len(self.average["bpm"]) if len(self.average["bpm"]) > 0 else 0
+                    result, _ = self.db_manager.save_local_session(data)
+                    self.run_id = result["id"]
+                avg_speed = self.average["speed"].mean()
+                avg_bpm = self.average["bpm"].mean()
                 avg_pace = self.convert_kmh_to_pace(avg_speed * 100)  # convert back to cm/s for the method
                 self.average["speed"].clear()
                 self.average["bpm"].clear()
                 lap_time = elapsed_time - self.data_stream["average_speeds"][-1][5] if len(self.data_stream["average_speeds"]) > 0 else elapsed_time
                 lap_kal = kcal - self.data_stream["average_speeds"][-1][6] if len(self.data_stream["average_speeds"]) > 0 else kcal
-                self.data_stream["average_speeds"].append((lap_time, lap_kal, avg_speed, avg_pace, avg_bpm, elapsed_time, kcal)) 
+                self.data_stream["average_speeds"].append((lap_time, lap_kal, avg_speed, avg_pace, avg_bpm, elapsed_time, kcal, distance)) 
                 # Save session data to database
                 data = {
                     "datetime": time.strftime("%Y-%m-%d %H:%M:%S"),
@@ -191,7 +277,8 @@ class BLEConnection:
                     "elapsed": elapsed_time,
                     "avg_speed": avg_speed,
                     "avg_bpm": avg_bpm,
-                    "kcal": kcal
+                    "kcal": kcal,
+                    "run_id": self.run_id
                 }
                 self.db_manager.save_local_session(data)         
 
@@ -204,60 +291,223 @@ class BLEConnection:
                 signed=True
             ) / 10
 
+        # Smoothed speed and pace, sampled a few times a second rather than per
+        # packet (the UI polls at 1 Hz) and copied to data_stream
+        now = time.monotonic()
+        if self.pace_published is None or now - self.pace_published >= PACE_PUBLISH_INTERVAL:
+            self.pace.update(now, self.data_stream["speed"], distance)
+            self.data_stream.update(self.pace.values())
+            self.pace_published = now
+
+
+    def start_new_run(self):
+        """
+        Close the current run and reset the per-run state (laps, km
+        averages, sample buffer). Samples of a run that never reached the
+        first km have no session row and are dropped.
+        """
+        self.flush_samples()
+        with self.samples_lock:
+            self.samples = []
+            self.samples_rx = []
+        self.save_best_efforts()
+        self.run_id = None
+        self.pace.reset()
+        self.pace_published = None
+        self.best_efforts.reset()
+        self.publish_best_efforts()
+        self.data_stream["average_speeds"] = []
+        self.average["speed"].clear()
+        self.average["bpm"].clear()
+
+    def publish_best_efforts(self):
+        """
+        Copy the best efforts of the run ({name: seconds}) and the PB pace
+        (the all-time best over pb_distance, this run included) to data_stream.
+        """
+        efforts = self.best_efforts.efforts()
+        self.data_stream["best_efforts"] = {
+            DISTANCES[d]: round(effort.seconds, 1) for d, effort in efforts.items()
+        }
+        best = self.personal_bests.get(self.pb_distance)
+        current = efforts.get(self.pb_distance)
+        if current is not None and (best is None or current.seconds < best):
+            best = current.seconds
+        self.data_stream["pb_pace"] = format_pace(self.pb_distance / best * 3.6) if best else None
+
+    def load_personal_bests(self):
+        """Read the all-time personal bests from the local DB."""
+        try:
+            self.personal_bests = self.db_manager.get_personal_bests()
+        except Exception as e:
+            logger.error("Error loading personal bests: %s", e)
+        self.publish_best_efforts()
+
+    def save_best_efforts(self):
+        """
+        Store the best efforts of the current run in the local DB, which
+        updates the personal bests (on session close and at a new run).
+        """
+        efforts = self.best_efforts.efforts()
+        if self.run_id is None or not efforts:
+            return
+        try:
+            if self.db_manager.save_best_efforts(self.run_id, efforts):
+                self.personal_bests = self.db_manager.get_personal_bests()
+        except Exception as e:
+            logger.error("Error saving best efforts: %s", e)
+
+    def record_sample(self, rx_time=None):
+        """
+        Buffer the current values as one sample of the run and feed it to
+        the best efforts. Samples are written in batches once the run has a
+        row in the local DB (after the first km); until then they stay in
+        the buffer.
+        rx_time is the time.monotonic() stamp of the packet.
+        """
+        if self.data_stream["running_time"] <= 0:
+            return
+        self.db_manager.touch_activity()  # keeps maintenance jobs away from the run
+        sample = {
+            "ts": time.time(),
+            "elapsed": self.data_stream["running_time"],
+            "distance": int(self.data_stream["distance"] * 1000),
+            "speed": self.data_stream["speed"],
+            "bpm": self.data_stream["bpm"],
+            "kcal": self.data_stream["energy"]
+        }
+        if self.best_efforts.add(sample["elapsed"], sample["distance"]):
+            self.publish_best_efforts()
+        with self.samples_lock:
+            self.samples.append(sample)
+            if self.latency and rx_time is not None:
+                self.samples_rx.append(rx_time)
+        if self.run_id is not None and len(self.samples) >= self.samples_flush_size:
+            self.flush_samples()
+
+    def flush_samples(self):
+        """Write the buffered samples of the current run to the local DB."""
+        if self.run_id is None:
+            return
+        with self.samples_lock:
+            samples, self.samples = self.samples, []
+            samples_rx, self.samples_rx = self.samples_rx, []
+        if not samples:
+            return
+        try:
+            self.db_manager.save_samples(self.run_id, samples)
+            if self.latency:
+                self.latency.record_many("db", samples_rx)
+        except Exception as e:
+            logger.error("Error saving samples: %s", e)
 
     def notification_handler(self, sender, data):
         """
         Callback to handle treadmill speed notifications.
         """
+        rx_time = time.monotonic()  # carried to the rebroadcast, HTTP and DB hops
+        NOTIFICATIONS.inc()
+        packet_log.debug("[Rx] %s", data)
         try:
             self.decode_treadmill_data(data)
+            if self.last_rx is None and TIMELINE.mark("first_sample"):
+                logger.info("First treadmill sample %.1f s after start", TIMELINE.elapsed("first_sample"))
+            self.last_rx = rx_time
+            self.record_sample(rx_time)
             # Update treadmill simulator with new data
             self.treadmill.set_measures(
                 speed_m_s=self.data_stream["speed"],
                 distance_m=self.data_stream["distance"],
                 energy=self.data_stream["energy"],
                 bpm=self.data_stream["bpm"],
-                elapsed_s=self.data_stream["running_time"]
+                elapsed_s=self.data_stream["running_time"],
+                rx_time=rx_time
             )
+            if self.latency:
+                self.latency.record("decode", rx_time)
+            DECODE_SECONDS.observe(time.monotonic() - rx_time)
         except Exception as e:
-            print(f"Error decoding data: {e}")
-            print(f"Raw Data: {data}")
+            DECODE_ERRORS.inc()
+            # Rate limited: a stream of malformed packets logs one line per interval
+            logger.warning("Error decoding data: %s (raw data %s)", e, bytes(data))
     
     def notification_indicate(self, sender, data):
-        print(f"Indicate received: {data}")
+        logger.debug("Indicate received: %s", data)
         if not self.indicate.done():
             self.indicate.set_result(data)
 
 
+    async def resolve_address(self, scan):
+        """
+        Address to connect to: the configured one; with "auto", the cached
+        one (direct connect, no scan) unless scan, else the nearest FTMS
+        treadmill advertising. None if none is found.
+        """
+        if not self.auto_address:
+            return self.address
+        from ftms_scanner import AddressCache, find_treadmill
+
+        cached = AddressCache(self.address_cache).load()
+        if cached and not scan:
+            logger.info("Trying last known treadmill %s", cached)
+            return cached
+        with TIMELINE.phase("ble scan"):
+            found = await find_treadmill(timeout=self.scan_timeout, preferred=cached,
+                                         exclude_names=self.exclude_names)
+        return found.address if found is not None else None
+
     async def connect_treadmill(self):
-        """Connect to BLE treadmill and start notifications."""
+        """
+        Connect to BLE treadmill and start notifications. When the link
+        drops, reconnect at once; max_retries counts failed attempts in a
+        row. Returns after disconnect() or when every retry failed.
+        """
         retries = 0
-        while retries < self.max_retries:
+        while retries < self.max_retries and not self.stopping:
             try:
-                print(f"Attempting to connect to treadmill (Attempt {retries + 1}/{self.max_retries})...")
-                async with BleakClient(self.address, timeout=10.0, loop=self.ble_loop) as client:
-                    self.client = client
-                    print("Connected successfully!")
-                    #await client.start_notify(self.control_point_uuid, self.notification_indicate)
-                    await client.start_notify(self.speed_characteristic_uuid, self.notification_handler)
-
-                    # Keep the connection alive
-                    try:
-                        while True:
-                            await asyncio.sleep(1)
-                    except KeyboardInterrupt:
-                        print("Stopping notifications...")
-                        await client.stop_notify(self.speed_characteristic_uuid)
-                        break
-                return  # Successful connection; exit method
+                # After a failed direct connect to the cached address, scan
+                address = await self.resolve_address(scan=retries > 0)
+                if address is None:
+                    raise RuntimeError("no FTMS treadmill advertising nearby")
+                logger.info("Attempting to connect to treadmill %s (Attempt %d/%d)...",
+                            address, retries + 1, self.max_retries)
+                disconnected = asyncio.Event()
+                transport = self.transport_factory(address, disconnected_callback=lambda _: disconnected.set())
+                await transport.connect()
+                self.client = transport
+                self.disconnected = disconnected
+                try:
+                    logger.info("Connected successfully!")
+                    if self.auto_address:
+                        from ftms_scanner import AddressCache
+                        cache = AddressCache(self.address_cache)
+                        if cache.load() != address:
+                            cache.save(address)
+                    CONNECT_ATTEMPTS.labels(result="ok").inc()
+                    CONNECTED.set(1)
+                    retries = 0
+                    #await transport.start_notify(self.control_point_uuid, self.notification_indicate)
+                    await transport.start_notify(self.speed_characteristic_uuid, self.notification_handler)
+
+                    # Keep the connection until it drops or disconnect() is called
+                    await disconnected.wait()
+                finally:
+                    CONNECTED.set(0)
+                    if transport.is_connected:
+                        await transport.disconnect()
+                if not self.stopping:
+                    RECONNECTS.inc()
+                    logger.warning("Treadmill disconnected, reconnecting...")
             except Exception as e:
                 retries += 1
-                print(f"Error connecting to treadmill: {e}")
+                CONNECT_ATTEMPTS.labels(result="error").inc()
+                CONNECTED.set(0)
+                logger.error("Error connecting to treadmill: %s", e)
                 if retries < self.max_retries:
-                    print("Retrying...")
+                    logger.info("Retrying...")
                     await asyncio.sleep(2)  # Wait 2 seconds before retrying
                 else:
-                    print("Max retries reached. Unable to connect.")
+                    logger.error("Max retries reached. Unable to connect.")
                     break
 
 
@@ -271,10 +521,9 @@ class BLEConnection:
             self.ble_loop.close()
 
     def disconnect(self):
-        """Disconnect from the treadmill."""
+        """Disconnect from the treadmill, for good (no reconnect)."""
+        self.stopping = True
+        if self.disconnected is not None and not self.ble_loop.is_closed():
+            self.ble_loop.call_soon_threadsafe(self.disconnected.set)
         if self.client and self.client.is_connected:
-            asyncio.run_coroutine_threadsafe(
-                self.client.disconnect(),
-                self.ble_loop
-            )
-            print("Disconnected from treadmill.")
\ No newline at end of file
+            logger.info("Disconnected from treadmill.")
\ No newline at end of file
@@ -0,0 +1,198 @@
+# ble_transport.py
+# The link between BLEConnection and the treadmill.
+#
+# BLEConnection talks to the treadmill only through a transport built by
+# transport_factory(address, disconnected_callback):
+#
+#     await transport.connect()
+#     await transport.start_notify(uuid, handler)    handler(sender, data)
+#     await transport.write_gatt_char(uuid, data)
+#     await transport.stop_notify(uuid)
+#     await transport.disconnect()
+#     transport.is_connected
+#
+# disconnected_callback(transport) is called when the link drops, whoever
+# dropped it. BleakTransport is the radio (bleak.BleakClient). FakeTreadmill
+# is a treadmill without a radio: its transport() factory serves scripted
+# or simulated Treadmill Data packets on the BLE loop, with injected
+# latency, connect failures and disconnects, and acknowledges FTMS Control
+# Point writes, so connect_treadmill(), the reconnect path, the decoder, the
+# DB writes and /api/treadmill_data run at high packet rates in CI:
+#
+#     fake = FakeTreadmill(simulator=TreadmillSimulator(interval_workout(), rate_hz=100),
+#                          disconnect_after=5000)
+#     connection = BLEConnection(treadmill, db_manager, transport_factory=fake.transport)
+
+import asyncio
+import random
+import threading
+
+TREADMILL_DATA_UUID = "00002acd-0000-1000-8000-00805f9b34fb"
+CONTROL_POINT_UUID = "00002ad9-0000-1000-8000-00805f9b34fb"
+
+# Fitness Machine Control Point response (FTMS 4.16.2.22)
+CP_RESPONSE_CODE = 0x80
+CP_SUCCESS = 0x01
+
+
+class BleakTransport:
+    """bleak.BleakClient behind the transport interface (bleak imported on connect)."""
+
+    def __init__(self, address, disconnected_callback=None, timeout=10.0):
+        self.address = address
+        self.disconnected_callback = disconnected_callback
+        self.timeout = timeout
+        self.client = None
+
+    @property
+    def is_connected(self):
+        return self.client is not None and self.client.is_connected
+
+    async def connect(self):
+        from bleak import BleakClient
+        self.client = BleakClient(self.address, timeout=self.timeout,
+                                  disconnected_callback=self._disconnected)
+        await self.client.connect()
+
+    def _disconnected(self, client):
+        if self.disconnected_callback:
+            self.disconnected_callback(self)
+
+    async def disconnect(self):
+        if self.client is not None:
+            await self.client.disconnect()
+
+    async def start_notify(self, uuid, handler):
+        await self.client.start_notify(uuid, handler)
+
+    async def stop_notify(self, uuid):
+        await self.client.stop_notify(uuid)
+
+    async def write_gatt_char(self, uuid, data, response=True):
+        await self.client.write_gatt_char(uuid, data, response=response)
+
+
+class FakeTreadmill:
+    """
+    A treadmill without a radio; one FakeTransport per connection.
+
+    packets: Treadmill Data packets (bytes) to serve, in order, or
+    simulator: a TreadmillSimulator whose packets() are served.
+    rate_hz: notifications per second, None for as fast as the loop takes them.
+    latency, jitter: seconds added to every notification and write reply.
+    connect_failures: the first N connect() calls fail.
+    disconnect_after: drop the link every N packets.
+    The stream continues where it stopped on the next connection;
+    `finished` is set once every packet was delivered.
+    """
+
+    def __init__(self, packets=None, simulator=None, rate_hz=None, latency=0.0, jitter=0.0,
+                 connect_failures=0, disconnect_after=None, seed=None):
+        if (packets is None) == (simulator is None):
+            raise ValueError("give packets or simulator")
+        self.packets = iter(packets) if packets is not None else (p for _, p in simulator.packets())
+        self.rate_hz = rate_hz
+        self.latency = latency
+        self.jitter = jitter
+        self.connect_failures = connect_failures
+        self.disconnect_after = disconnect_after
+        self.random = random.Random(seed)
+        self.finished = threading.Event()
+        # Counters, read by tests and benchmarks
+        self.connects = 0
+        self.failed_connects = 0
+        self.disconnects = 0  # injected
+        self.delivered = 0
+        self.writes = []      # (uuid, bytes) received on the control point and elsewhere
+
+    def transport(self, address, disconnected_callback=None):
+        """The transport_factory of BLEConnection."""
+        return FakeTransport(self, address, disconnected_callback)
+
+    def delay(self):
+        return self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0.0)
+
+
+class FakeTransport:
+    """One connection to a FakeTreadmill, driven by the running event loop."""
+
+    def __init__(self, treadmill, address, disconnected_callback=None):
+        self.treadmill = treadmill
+        self.address = address
+        self.disconnected_callback = disconnected_callback
+        self.is_connected = False
+        self.handlers = {}
+        self.stream = None
+
+    async def connect(self):
+        treadmill = self.treadmill
+        await asyncio.sleep(treadmill.delay())
+        if treadmill.failed_connects < treadmill.connect_failures:
+            treadmill.failed_connects += 1
+            raise ConnectionError(f"fake connect failure {treadmill.failed_connects}")
+        treadmill.connects += 1
+        self.is_connected = True
+
+    async def disconnect(self):
+        self._drop()
+
+    def _drop(self):
+        if not self.is_connected:
+            return
+        self.is_connected = False
+        if self.stream is not None and self.stream is not asyncio.current_task():
+            self.stream.cancel()
+        if self.disconnected_callback:
+            self.disconnected_callback(self)
+
+    def _check(self):
+        if not self.is_connected:
+            raise ConnectionError("not connected")
+
+    async def start_notify(self, uuid, handler):
+        self._check()
+        self.handlers[uuid] = handler
+        if uuid == TREADMILL_DATA_UUID and self.stream is None:
+            self.stream = asyncio.get_running_loop().create_task(self._serve(handler))
+
+    async def stop_notify(self, uuid):
+        self.handlers.pop(uuid, None)
+        if uuid == TREADMILL_DATA_UUID and self.stream is not None:
+            self.stream.cancel()
+            self.stream = None
+
+    async def write_gatt_char(self, uuid, data, response=True):
+        self._check()
+        data = bytes(data)
+        self.treadmill.writes.append((uuid, data))
+        await asyncio.sleep(self.treadmill.delay())
+        handler = self.handlers.get(CONTROL_POINT_UUID)
+        if uuid == CONTROL_POINT_UUID and handler and data:
+            # Indication: response code, request op code, result
+            handler(CONTROL_POINT_UUID, bytearray([CP_RESPONSE_CODE, data[0], CP_SUCCESS]))
+
+    async def _serve(self, handler):
+        treadmill = self.treadmill
+        loop = asyncio.get_running_loop()
+        period = 1.0 / treadmill.rate_hz if treadmill.rate_hz else 0.0
+        next_time = loop.time()
+        sent = 0
+        for packet in treadmill.packets:
+            delay = treadmill.delay()
+            if delay:
+                await asyncio.sleep(delay)
+            if not self.is_connected:
+                return  # the packet is lost with the link, like over the air
+            handler(TREADMILL_DATA_UUID, bytearray(packet))
+            treadmill.delivered += 1
+            sent += 1
+            if treadmill.disconnect_after and sent % treadmill.disconnect_after == 0:
+                treadmill.disconnects += 1
+                self._drop()
+                return
+            if period:
+                next_time += period
+                await asyncio.sleep(max(next_time - loop.time(), 0))
+            else:
+                await asyncio.sleep(0)  # let the rest of the loop run
+        treadmill.finished.set()
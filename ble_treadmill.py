@@ -1,6 +1,11 @@
 #!/usr/bin/env python3
 # SPDX-License-Identifier: LGPL-2.1-or-later
 
+import glob
+import logging
+import subprocess
+import time
+
 import dbus
 import dbus.mainloop.glib
 import dbus.service
@@ -9,6 +14,12 @@ from gi.repository import GLib
 from random import randint
 from dbus.service import signal
 
+from logging_setup import PACKET_LOGGER
+from metrics import counter
+from startup import TIMELINE
+from treadmill_simulator import (MACHINE_TREADMILL, PERIPHERAL_FLAGS, encode_ftms_service_data,
+                                  encode_treadmill_data)
+
 
 ############################
 # Constants
@@ -21,13 +32,44 @@ GATT_SERVICE_IFACE = 'org.bluez.GattService1'
 GATT_CHRC_IFACE    = 'org.bluez.GattCharacteristic1'
 ADVERTISING_MANAGER_IFACE = 'org.bluez.LEAdvertisingManager1'
 ADVERTISEMENT_IFACE = 'org.bluez.LEAdvertisement1'
+ADAPTER_IFACE = 'org.bluez.Adapter1'
 
 # Treadmill Service + Treadmill Data Characteristic
 TREADMILL_SERVICE_UUID      = "00001826-0000-1000-8000-00805f9b34fb"
 TREADMILL_DATA_CHAR_UUID    = "00002acd-0000-1000-8000-00805f9b34fb"
+HEART_RATE_SERVICE_UUID     = "0000180d-0000-1000-8000-00805f9b34fb"
+
+# Advertisement defaults (config.json "Advertising" section)
+APPEARANCE_RUNNING_WALKING_SENSOR = 0x0440
+ADVERTISING_DEFAULTS = {
+    "appearance": APPEARANCE_RUNNING_WALKING_SENSOR,
+    "min_interval_ms": 100,  # fast advertising: apps scanning in low duty cycle see us sooner
+    "max_interval_ms": 150,
+}
+BASE_UUID_SUFFIX = "-0000-1000-8000-00805f9b34fb"
+LEGACY_AD_MAX = 31  # bytes of a legacy advertising PDU
 
 mainloop = None
 
+logger = logging.getLogger(__name__)
+packet_log = logging.getLogger(PACKET_LOGGER)
+
+GATT_NOTIFICATIONS = counter("gatt_notifications_sent_total",
+                             "Notifications sent by the GATT server", ("characteristic",))
+TREADMILL_NOTIFICATIONS = GATT_NOTIFICATIONS.labels(characteristic="treadmill_data")
+HEART_RATE_NOTIFICATIONS = GATT_NOTIFICATIONS.labels(characteristic="heart_rate")
+ADAPTER_RECOVERIES = counter("bluetooth_adapter_recoveries_total",
+                             "Escalation steps taken to bring the adapter up", ("step",))
+
+
+def measurement_packet(speed, distance_m, energy, elapsed_s):
+    """
+    Treadmill Data packet notified by TreadmillDataCharacteristic
+    (speed in km/h). Pure function, so it can be benchmarked without D-Bus.
+    """
+    return encode_treadmill_data(PERIPHERAL_FLAGS, speed=speed, distance=distance_m,
+                                 kcal=energy, elapsed=elapsed_s)
+
 ############################
 # D-Bus Exceptions
 ############################
@@ -66,13 +108,16 @@ class Application(dbus.service.Object):
     def add_service(self, service):
         self.services.append(service)
 
+    def service_uuids(self):
+        return [service.uuid for service in self.services]
+
     @dbus.service.method(DBUS_OM_IFACE, out_signature='a{oa{sa{sv}}}')
     def GetManagedObjects(self):
         """
         Called by BlueZ to enumerate all objects (services, characteristics).
         """
         response = {}
-        print("GetManagedObjects called")
+        logger.debug("GetManagedObjects called")
 
         for service in self.services:
             response[service.get_path()] = service.get_properties()
@@ -162,12 +207,12 @@ class Characteristic(dbus.service.Object):
 
     @dbus.service.method(GATT_CHRC_IFACE, in_signature='a{sv}', out_signature='ay')
     def ReadValue(self, options):
-        print("Default ReadValue called, returning error")
+        logger.warning("Default ReadValue called, returning error")
         raise NotSupportedException()
 
     @dbus.service.method(GATT_CHRC_IFACE, in_signature='aya{sv}')
     def WriteValue(self, value, options):
-        print("Default WriteValue called, returning error")
+        logger.warning("Default WriteValue called, returning error")
         raise NotSupportedException()
 
 ############################
@@ -208,7 +253,7 @@ class TreadmillDataCharacteristic(Characteristic):
         if self.notifying:
             return
         self.notifying = True
-        GLib.timeout_add(1000, self._send_measurement)
+        GLib.timeout_add(self.treadmill_app.notify_interval_ms, self._send_measurement)
 
     @dbus.service.method(GATT_CHRC_IFACE)
     def StopNotify(self):
@@ -216,60 +261,41 @@ class TreadmillDataCharacteristic(Characteristic):
 
     def _send_measurement(self):
         """
-        Called every second by GLib.timeout_add. We read the current
-        speed, distance, time, energy from the TreadmillApp's
+        Called every notify_interval_ms by GLib.timeout_add. We read the
+        current speed, distance, time, energy from the TreadmillApp's
         shared variables, then build the Treadmill Data packet.
         """
         if not self.notifying:
             return False
 
-        (speed_m_s, distance_m, energy, bpm, elapsed_s) = self.treadmill_app.get_measures()
-
-        # Convert speed => 1/256 m/s
-        speed_256 = int(speed_m_s * 100)
-        distance_int = int(distance_m)
-        energy = int(energy)
-
-        # Flags for Distance (bit2), Expended Energy (bit7), and Elapsed Time (bit10)
-        flags_low  = 0x84
-        flags_high = 0x04
-
-        val = [
-            dbus.Byte(flags_low),
-            dbus.Byte(flags_high),
-
-            # Speed (2 bytes)
-            dbus.Byte(speed_256 & 0xFF),
-            dbus.Byte((speed_256 >> 8) & 0xFF),
-
-            # Distance (3 bytes)
-            dbus.Byte(distance_int & 0xFF),
-            dbus.Byte((distance_int >> 8) & 0xFF),
-            dbus.Byte((distance_int >> 16) & 0xFF),
-
-            # Expended Energy (2 bytes)
-            dbus.Byte(energy & 0xFF),
-            dbus.Byte((energy >> 8) & 0xFF),
-
-            # 3 placeholder bytes
-            dbus.Byte(0x00),
-            dbus.Byte(0x00),
-            dbus.Byte(0x00),
+        raw_packet = self.treadmill_app.raw_packet
+        if raw_packet is not None:
+            # Packet built by the simulator, sent as is
+            packet_log.debug("[Notify] raw %s", raw_packet)
+            self.PropertiesChanged(
+                GATT_CHRC_IFACE,
+                {'Value': dbus.Array([dbus.Byte(b) for b in raw_packet], signature='y')},
+                []
+            )
+            TREADMILL_NOTIFICATIONS.inc()
+            return True
 
+        (speed_m_s, distance_m, energy, bpm, elapsed_s) = self.treadmill_app.get_measures()
 
-            # Elapsed Time (2 bytes)
-            dbus.Byte(elapsed_s & 0xFF),
-            dbus.Byte((elapsed_s >> 8) & 0xFF),
-        ]
+        # Distance (bit2), Expended Energy (bit7) and Elapsed Time (bit10)
+        packet = measurement_packet(speed_m_s, distance_m, energy, elapsed_s)
+        val = [dbus.Byte(b) for b in packet]
 
-        print(f"[Notify] Speed={speed_m_s:.2f} m/s, Dist={distance_m:.1f}m, "
-              f"Energy={energy}, Bpm={bpm}, Time={elapsed_s}s")
+        packet_log.debug("[Notify] Speed=%.2f m/s, Dist=%.1fm, Energy=%s, Bpm=%s, Time=%ss",
+                         speed_m_s, distance_m, energy, bpm, elapsed_s)
 
         self.PropertiesChanged(
             GATT_CHRC_IFACE,
             {'Value': dbus.Array(val, signature='y')},
             []
         )
+        self.treadmill_app.measures_sent()
+        TREADMILL_NOTIFICATIONS.inc()
 
         return True  # keep scheduling
 
@@ -284,7 +310,7 @@ class HeartRateService(Service):
     GATT Service for Heart Rate.
     """
     def __init__(self, bus, index, treadmill_app):
-        super().__init__(bus, index, "0000180D-0000-1000-8000-00805f9b34fb", True)
+        super().__init__(bus, index, HEART_RATE_SERVICE_UUID, True)
         self.add_characteristic(HeartRateMeasurementCharacteristic(bus, 0, self, treadmill_app))
 
 
@@ -334,13 +360,14 @@ class HeartRateMeasurementCharacteristic(Characteristic):
             dbus.Byte(heart_rate),  # Heart rate value
         ]
 
-        print(f"[Heart Rate Notify] BPM={heart_rate}")
+        packet_log.debug("[Heart Rate Notify] BPM=%s", heart_rate)
 
         self.PropertiesChanged(
             GATT_CHRC_IFACE,
             {'Value': dbus.Array(value, signature='y')},
             []
         )
+        HEART_RATE_NOTIFICATIONS.inc()
         return True
 
 
@@ -357,28 +384,67 @@ class Advertisement(dbus.service.Object):
         self.ad_type = ad_type
         self.service_uuids = []
         self.manufacturer_data = {}
+        self.service_data = {}
         self.solicit_uuids = []
         self.data = {}
+        self.local_name = None  # BlueZ moves it to the scan response if it does not fit
+        self.appearance = None
+        self.min_interval_ms = None
+        self.max_interval_ms = None
         dbus.service.Object.__init__(self, bus, self.path)
 
     def get_path(self):
         return dbus.ObjectPath(self.path)
 
     def add_service_uuid(self, uuid):
-        self.service_uuids.append(uuid)
+        if uuid not in self.service_uuids:
+            self.service_uuids.append(uuid)
+
+    def add_service_data(self, uuid, data):
+        self.service_data[uuid] = bytes(data)
+
+    def data_length(self):
+        """
+        Bytes of advertising data, local name aside (Flags, UUID list,
+        Service Data, Appearance...). Over LEGACY_AD_MAX, registration
+        fails on adapters without extended advertising.
+        """
+        def uuid_size(uuid):
+            return 2 if uuid.lower().endswith(BASE_UUID_SUFFIX) else 16
+
+        length = 3  # Flags
+        sizes = [uuid_size(u) for u in self.service_uuids]
+        for size in set(sizes):
+            length += 2 + size * sizes.count(size)
+        length += sum(2 + uuid_size(u) + len(d) for u, d in self.service_data.items())
+        length += sum(2 + 2 + len(d) for d in self.manufacturer_data.values())
+        if self.appearance is not None:
+            length += 4
+        return length
 
     def get_properties(self):
-        return {
-            ADVERTISEMENT_IFACE: {
-                'Type': self.ad_type,
-                'ServiceUUIDs': dbus.Array(self.service_uuids, signature='s'),
-                'ManufacturerData': dbus.Dictionary(self.manufacturer_data, signature='qv'),
-                'SolicitUUIDs': dbus.Array(self.solicit_uuids, signature='s'),
-                'Data': dbus.Dictionary(self.data, signature='sv'),
-                'Discoverable': True,  # Allow discovery
-                'Secure': False  # Disable secure connections
-            }
+        properties = {
+            'Type': self.ad_type,
+            'ServiceUUIDs': dbus.Array(self.service_uuids, signature='s'),
+            'ManufacturerData': dbus.Dictionary(self.manufacturer_data, signature='qv'),
+            'ServiceData': dbus.Dictionary(
+                {uuid: dbus.Array(data, signature='y') for uuid, data in self.service_data.items()},
+                signature='sv'),
+            'SolicitUUIDs': dbus.Array(self.solicit_uuids, signature='s'),
+            'Data': dbus.Dictionary(self.data, signature='sv'),
+            'Discoverable': True,  # Allow discovery
+            'Secure': False  # Disable secure connections
         }
+        if self.local_name:
+            properties['LocalName'] = dbus.String(self.local_name)
+        if self.appearance is not None:
+            properties['Appearance'] = dbus.UInt16(self.appearance)
+        # Experimental in BlueZ: ignored by versions that do not know them
+        if self.min_interval_ms is not None:
+            properties['MinInterval'] = dbus.UInt32(self.min_interval_ms)
+        if self.max_interval_ms is not None:
+            properties['MaxInterval'] = dbus.UInt32(self.max_interval_ms)
+        return {ADVERTISEMENT_IFACE: properties}
 
     @dbus.service.method(DBUS_PROP_IFACE,
                          in_signature='s',
@@ -390,7 +456,7 @@ class Advertisement(dbus.service.Object):
 
     @dbus.service.method(ADVERTISEMENT_IFACE)
     def Release(self):
-        print(f"{self.path}: Released")
+        logger.info("%s: Released", self.path)
 
 
 ############################
@@ -404,31 +470,31 @@ class PairingAgent(dbus.service.Object):
 
     @dbus.service.method("org.bluez.Agent1", in_signature="o", out_signature="s")
     def RequestPinCode(self, device):
-        print(f"RequestPinCode for device: {device}")
+        logger.info("RequestPinCode for device: %s", device)
         return "1234"  # Return a fixed PIN code
 
     @dbus.service.method("org.bluez.Agent1", in_signature="o", out_signature="u")
     def RequestPasskey(self, device):
-        print(f"RequestPasskey for device: {device}")
+        logger.info("RequestPasskey for device: %s", device)
         return dbus.UInt32(123456)  # Return a fixed passkey
 
     @dbus.service.method("org.bluez.Agent1", in_signature="ou", out_signature="")
     def DisplayPasskey(self, device, passkey):
-        print(f"DisplayPasskey for device {device}: {passkey}")
+        logger.info("DisplayPasskey for device %s: %s", device, passkey)
 
     @dbus.service.method("org.bluez.Agent1", in_signature="ou", out_signature="")
     def RequestConfirmation(self, device, passkey):
-        print(f"RequestConfirmation for passkey {passkey} on device {device}")
+        logger.info("RequestConfirmation for passkey %s on device %s", passkey, device)
         # Automatically confirm pairing
         return
 
     @dbus.service.method("org.bluez.Agent1", in_signature="", out_signature="")
     def Release(self):
-        print("Pairing agent released")
+        logger.info("Pairing agent released")
 
     @dbus.service.method("org.bluez.Agent1", in_signature="", out_signature="")
     def Cancel(self):
-        print("Pairing canceled")
+        logger.info("Pairing canceled")
 
 
 ############################
@@ -445,64 +511,243 @@ def find_adapter(bus):
             return path
     return None
 
+def adapter_property(bus, adapter_path, name, iface=ADAPTER_IFACE):
+    props = dbus.Interface(bus.get_object(BLUEZ_SERVICE_NAME, adapter_path), DBUS_PROP_IFACE)
+    return props.Get(iface, name)
+
 def set_bluetooth_name(bus, adapter_path, name):
-    """Set the alias (Bluetooth name) of the adapter."""
+    """Set the alias (Bluetooth name) of the adapter, unless it already has it."""
     adapter_props = dbus.Interface(
         bus.get_object(BLUEZ_SERVICE_NAME, adapter_path),
         DBUS_PROP_IFACE
     )
     try:
-        adapter_props.Set("org.bluez.Adapter1", "Alias", dbus.String(name))
-        print(f"Bluetooth name set to: {name}")
+        if adapter_props.Get(ADAPTER_IFACE, "Alias") == name:
+            return
+        adapter_props.Set(ADAPTER_IFACE, "Alias", dbus.String(name))
+        logger.info("Bluetooth name set to: %s", name)
     except dbus.DBusException as e:
-        print(f"Failed to set Bluetooth name: {str(e)}")
+        logger.error("Failed to set Bluetooth name: %s", e)
 
-def setup_pairing_agent(bus):
-    """Setup the pairing agent to disable pairing code."""
-    print("Skipping pairing agent setup for no pairing requirement.")
-    """Setup the pairing agent and make it the default."""
-    agent = PairingAgent(bus)
+def setup_pairing_agent(bus, agent=None):
+    """
+    Setup the pairing agent and make it the default. Returns the exported
+    agent, to be passed back when start() runs again in this process.
+    """
+    if agent is None:
+        try:
+            agent = PairingAgent(bus)
+        except KeyError:
+            pass  # already exported by another instance in this process
     manager = dbus.Interface(
         bus.get_object("org.bluez", "/org/bluez"),
         "org.bluez.AgentManager1"
     )
 
-    # Register the pairing agent
-    manager.RegisterAgent(PairingAgent.AGENT_PATH, "KeyboardDisplay")
-    print("Pairing agent registered with capability: KeyboardDisplay")
+    # Register the pairing agent (still registered if start() runs again in this process)
+    try:
+        manager.RegisterAgent(PairingAgent.AGENT_PATH, "KeyboardDisplay")
+        logger.info("Pairing agent registered with capability: KeyboardDisplay")
+    except dbus.DBusException as e:
+        if e.get_dbus_name() != "org.bluez.Error.AlreadyExists":
+            raise
 
     # Set it as the default agent
     manager.RequestDefaultAgent(PairingAgent.AGENT_PATH)
-    print("Pairing agent set as default")
+    logger.info("Pairing agent set as default")
+    return agent
+
+def power_on_adapter(bus, adapter_path):
+    """Power the adapter on if it is off. Returns True if it had to."""
+    props = dbus.Interface(bus.get_object(BLUEZ_SERVICE_NAME, adapter_path), DBUS_PROP_IFACE)
+    if props.Get(ADAPTER_IFACE, "Powered"):
+        return False
+    props.Set(ADAPTER_IFACE, "Powered", dbus.Boolean(True))
+    logger.info("Bluetooth adapter powered on")
+    return True
 
 def restart_adapter(bus, adapter_path):
     """Restart the Bluetooth adapter to apply changes."""
     adapter = dbus.Interface(
         bus.get_object("org.bluez", adapter_path),
-        "org.bluez.Adapter1"
+        DBUS_PROP_IFACE
     )
     try:
-        adapter.Set("org.bluez.Adapter1", "Powered", dbus.Boolean(False))
-        adapter.Set("org.bluez.Adapter1", "Powered", dbus.Boolean(True))
-        print("Bluetooth adapter restarted")
+        adapter.Set(ADAPTER_IFACE, "Powered", dbus.Boolean(False))
+        adapter.Set(ADAPTER_IFACE, "Powered", dbus.Boolean(True))
+        logger.info("Bluetooth adapter restarted")
     except dbus.DBusException as e:
-        print(f"Failed to restart adapter: {str(e)}")
+        logger.error("Failed to restart adapter: %s", e)
+
+def rfkill_blocked():
+    """True if a Bluetooth rfkill switch is soft or hard blocked (sysfs, no root needed)."""
+    for device in glob.glob("/sys/class/rfkill/rfkill*"):
+        try:
+            with open(f"{device}/type") as file:
+                if file.read().strip() != "bluetooth":
+                    continue
+            for switch in ("soft", "hard"):
+                with open(f"{device}/{switch}") as file:
+                    if file.read().strip() == "1":
+                        return True
+        except OSError:
+            continue
+    return False
+
+def rfkill_cycle(bus, block=True, timeout=10.0):
+    """
+    rfkill block (unless block=False) and unblock, then wait for the adapter
+    to come back and power it on. Returns its path, or None.
+    """
+    if block:
+        subprocess.run(["rfkill", "block", "bluetooth"], check=False)
+    subprocess.run(["rfkill", "unblock", "bluetooth"], check=False)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            adapter_path = find_adapter(bus)
+            if adapter_path:
+                power_on_adapter(bus, adapter_path)
+                return adapter_path
+        except dbus.DBusException:
+            pass
+        time.sleep(0.2)
+    return None
 
-def register_ad_cb():
-    print("Advertisement registered")
 
-def register_ad_error_cb():
-    global mainloop
-    print("Failed to register advertisement")
-    mainloop.quit()
+class AdapterSetup:
+    """
+    Registers the advertisement and the GATT application with the least
+    disruptive step that works. The adapter is only probed first (rfkill,
+    powered, free advertising slot) and fixed if needed; a harsher step is
+    taken only when the previous one failed: plain registration, then
+    unregister and re-register, then power-cycle the adapter, then rfkill
+    block/unblock. Each step is a startup timeline phase ("bluetooth
+    register", ...).
+
+    Registration replies arrive on the GLib loop, so the steps run there;
+    on_done(ok) is called once the adapter is up or every step failed.
+    """
 
-def register_app_cb():
-    print("GATT application registered (Treadmill).")
+    STEPS = ("register", "reregister", "power_cycle", "rfkill")
 
-def register_app_error_cb():
-    global mainloop
-    print("Failed to register application")
-    mainloop.quit()
+    def __init__(self, bus, adapter_path, app, advertisement, on_done):
+        self.bus = bus
+        self.adapter_path = adapter_path
+        self.app = app
+        self.advertisement = advertisement
+        self.on_done = on_done
+        self.step = 0
+        self.attempt = 0
+        self.pending = set()
+        self.errors = []
+
+    def _managers(self):
+        adapter = self.bus.get_object(BLUEZ_SERVICE_NAME, self.adapter_path)
+        return (dbus.Interface(adapter, ADVERTISING_MANAGER_IFACE),
+                dbus.Interface(adapter, GATT_MANAGER_IFACE))
+
+    def probe(self):
+        """
+        Problems of the adapter before any registration (empty list if
+        none). A powered-off adapter is just powered on.
+        """
+        problems = []
+        with TIMELINE.phase("bluetooth probe"):
+            if rfkill_blocked():
+                problems.append("rfkill blocked")
+            try:
+                power_on_adapter(self.bus, self.adapter_path)
+                if adapter_property(self.bus, self.adapter_path, "SupportedInstances",
+                                    ADVERTISING_MANAGER_IFACE) == 0:
+                    # Held by other clients: registering may fail and escalate
+                    problems.append("no free advertising slot")
+            except dbus.DBusException as e:
+                problems.append(f"adapter unreachable ({e.get_dbus_name()})")
+        return problems
+
+    def start(self):
+        problems = self.probe()
+        if problems:
+            logger.warning("Bluetooth adapter probe: %s", ", ".join(problems))
+        if "rfkill blocked" in problems:
+            with TIMELINE.phase("bluetooth rfkill unblock"):
+                self.adapter_path = rfkill_cycle(self.bus, block=False) or self.adapter_path
+        self._run_step()
+
+    def _unregister(self):
+        ad_manager, service_manager = self._managers()
+        for call, path in ((ad_manager.UnregisterAdvertisement, self.advertisement.get_path()),
+                           (service_manager.UnregisterApplication, self.app.get_path())):
+            try:
+                call(path)
+            except dbus.DBusException:
+                pass  # not registered
+
+    def _run_step(self):
+        name = self.STEPS[self.step]
+        self.attempt += 1
+        attempt = self.attempt
+        self.started = time.monotonic()
+        self.errors = []
+        if name != "register":
+            ADAPTER_RECOVERIES.labels(step=name).inc()
+            logger.warning("Bluetooth recovery: %s", name)
+            self._unregister()
+        if name == "power_cycle":
+            restart_adapter(self.bus, self.adapter_path)
+        elif name == "rfkill":
+            adapter_path = rfkill_cycle(self.bus)
+            if adapter_path is None:
+                self._finish(False, "adapter did not come back after rfkill")
+                return
+            self.adapter_path = adapter_path
+
+        ad_manager, service_manager = self._managers()
+        self.pending = {"advertisement", "application"}
+        ad_manager.RegisterAdvertisement(
+            self.advertisement.get_path(), {},
+            reply_handler=lambda: self._reply(attempt, "advertisement"),
+            error_handler=lambda e: self._reply(attempt, "advertisement", e)
+        )
+        service_manager.RegisterApplication(
+            self.app.get_path(), {},
+            reply_handler=lambda: self._reply(attempt, "application"),
+            error_handler=lambda e: self._reply(attempt, "application", e)
+        )
+
+    def _reply(self, attempt, what, error=None):
+        if attempt != self.attempt:
+            return  # reply to a step already abandoned
+        self.pending.discard(what)
+        if error is None:
+            logger.info("%s registered", what.capitalize())
+        else:
+            self.errors.append(f"{what}: {error}")
+        if self.pending:
+            return
+        name = self.STEPS[self.step]
+        TIMELINE.record(f"bluetooth {name}", self.started, time.monotonic())
+        if not self.errors:
+            self._finish(True, None)
+        elif self.step + 1 < len(self.STEPS):
+            logger.warning("Bluetooth %s failed: %s", name, "; ".join(self.errors))
+            self.step += 1
+            GLib.idle_add(self._next_step)
+        else:
+            self._finish(False, "; ".join(self.errors))
+
+    def _next_step(self):
+        self._run_step()
+        return False  # run once
+
+    def _finish(self, ok, error):
+        if ok:
+            logger.info("Bluetooth ready (%s) in %.0f ms", self.STEPS[self.step],
+                        (time.monotonic() - self.started) * 1000)
+        else:
+            logger.error("Bluetooth setup failed after %s: %s", self.STEPS[self.step], error)
+        self.on_done(ok)
 
 
 ############################
@@ -514,9 +759,14 @@ class TreadmillSimulate:
     You can set speed/distance/energy/time using set_measures(...)
     Then the TreadmillDataCharacteristic will read them each second.
     """
-    def __init__(self, device_name="Test-Treadmill"):
+    def __init__(self, device_name="Test-Treadmill", notify_interval_ms=1000, latency=None,
+                 heartbeat=None, advertising=None):
         global mainloop
         self.device_name = device_name
+        self.advertising = dict(ADVERTISING_DEFAULTS, **(advertising or {}))
+        self.notify_interval_ms = notify_interval_ms
+        self.latency = latency  # optional LatencyTracker (hop "rebroadcast")
+        self.heartbeat = heartbeat  # optional health.Heartbeat, ticked by the GLib loop
         mainloop = None
 
         # "Live" treadmill data that the characteristic will read
@@ -525,12 +775,20 @@ class TreadmillSimulate:
         self.energy = 0
         self.bpm = 0
         self.elapsed_s = 0
+        self.raw_packet = None  # complete Treadmill Data packet, overrides the measures
+        self.rx_time = None  # time.monotonic() when the measures arrived from the treadmill
+        self.rx_time_sent = None  # rx_time of the last notified measures
+        self.pairing_agent = None  # PairingAgent exported on the bus, kept for the process lifetime
 
-    def set_measures(self, speed_m_s=None, distance_m=None, energy=None, bpm=None, elapsed_s=None):
+    def set_measures(self, speed_m_s=None, distance_m=None, energy=None, bpm=None, elapsed_s=None,
+                     rx_time=None):
         """
         Update treadmill data. These are read each second
         by TreadmillDataCharacteristic::_send_measurement().
+        rx_time is the receive stamp of the packet they come from.
         """
+        if rx_time is not None:
+            self.rx_time = rx_time
         if speed_m_s is not None:
             self.speed_m_s = speed_m_s
         if distance_m is not None:
@@ -542,6 +800,23 @@ class TreadmillSimulate:
         if elapsed_s is not None:
             self.elapsed_s = elapsed_s
 
+    def set_raw_packet(self, packet):
+        """
+        Notify this exact Treadmill Data packet (bytes) instead of building
+        one from the measures; None goes back to the measures.
+        """
+        self.raw_packet = packet
+
+    def measures_sent(self):
+        """
+        Called after each notification: records the latency of measures
+        that are notified for the first time.
+        """
+        rx_time = self.rx_time
+        if self.latency and rx_time is not None and rx_time != self.rx_time_sent:
+            self.latency.record("rebroadcast", rx_time)
+        self.rx_time_sent = rx_time
+
     def get_measures(self):
         """Return the current (speed, distance, energy, time)."""
         return (
@@ -552,63 +827,91 @@ class TreadmillSimulate:
             self.elapsed_s
         )
 
-    def start(self):
+    def start(self, bus=None):
+        """
+        Run the GATT server until stop(). bus defaults to the system bus;
+        bluez_mock.py passes a private bus with a mock BlueZ on it.
+        """
         global mainloop
         dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
-        bus = dbus.SystemBus()
+        if bus is None:
+            bus = dbus.SystemBus()
 
         adapter_path = find_adapter(bus)
         if not adapter_path:
-            print("GattManager1 interface not found. Is bluetoothd running with --experimental?")
+            logger.error("GattManager1 interface not found. Is bluetoothd running with --experimental?")
             return
 
-        # Set the Bluetooth device name
+        # Set the Bluetooth device name (the adapter is no longer restarted for it)
         set_bluetooth_name(bus, adapter_path, self.device_name)
-        restart_adapter(bus, adapter_path)
 
         # Set up the pairing agent
-        setup_pairing_agent(bus)
-
-        service_manager = dbus.Interface(
-            bus.get_object(BLUEZ_SERVICE_NAME, adapter_path),
-            GATT_MANAGER_IFACE
-        )
+        self.pairing_agent = setup_pairing_agent(bus, self.pairing_agent)
 
         # Create our GATT application (Treadmill Service + Characteristic)
         app = Application(bus, self)
 
-        # Create an advertisement
-        advertisement = Advertisement(bus, 0, 'peripheral')
-        advertisement.add_service_uuid(TREADMILL_SERVICE_UUID)
-
-        ad_manager = dbus.Interface(
-            bus.get_object(BLUEZ_SERVICE_NAME, adapter_path),
-            ADVERTISING_MANAGER_IFACE
-        )
-
-        print("Registering advertisement...")
-        ad_manager.RegisterAdvertisement(
-            advertisement.get_path(),
-            {},  # no special options
-            reply_handler=register_ad_cb,
-            error_handler=register_ad_error_cb
-        )
+        advertisement = self.build_advertisement(bus, app)
 
-        print("Registering the Treadmill GATT application...")
-        service_manager.RegisterApplication(
-            app.get_path(),
-            {},  # no special options
-            reply_handler=register_app_cb,
-            error_handler=register_app_error_cb
-        )
+        # Probe the adapter, register, and reset it only if that fails
+        logger.info("Registering advertisement and Treadmill GATT application...")
+        self.adapter_setup = AdapterSetup(bus, adapter_path, app, advertisement, self._adapter_ready)
+        GLib.idle_add(self._start_adapter_setup)
 
         # Start the GLib loop
         mainloop = GLib.MainLoop()
-        print(f"Fake treadmill '{self.device_name}' running. Ctrl+C to stop.")
+        if self.heartbeat:
+            self.heartbeat.beat()
+            GLib.timeout_add(1000, self._beat)
+        logger.info("Fake treadmill '%s' running. Ctrl+C to stop.", self.device_name)
         mainloop.run()
 
+    def build_advertisement(self, bus, app):
+        """
+        Advertise everything an app needs to classify us without connecting:
+        all served services, FTMS Service Data (available, treadmill), the
+        appearance and the name. What does not fit the 31 bytes of a legacy
+        advertisement is left out, appearance first and the FTMS UUID never.
+        """
+        advertisement = Advertisement(bus, 0, 'peripheral')
+        for uuid in app.service_uuids():
+            advertisement.add_service_uuid(uuid)
+        advertisement.add_service_data(TREADMILL_SERVICE_UUID, encode_ftms_service_data(MACHINE_TREADMILL))
+        advertisement.local_name = self.device_name
+        advertisement.appearance = self.advertising["appearance"]
+        advertisement.min_interval_ms = self.advertising["min_interval_ms"]
+        advertisement.max_interval_ms = self.advertising["max_interval_ms"]
+        # Too long for a legacy PDU, registration fails and AdapterSetup would
+        # power-cycle the adapter for it: drop the optional fields instead
+        optional = (
+            ("appearance", lambda: setattr(advertisement, "appearance", None)),
+            ("service data", advertisement.service_data.clear),
+            ("services other than FTMS",
+             lambda: setattr(advertisement, "service_uuids", [TREADMILL_SERVICE_UUID])),
+        )
+        for name, drop in optional:
+            length = advertisement.data_length()
+            if length <= LEGACY_AD_MAX:
+                break
+            drop()
+            logger.warning("Advertising data is %d bytes (legacy limit %d): %s left out",
+                           length, LEGACY_AD_MAX, name)
+        return advertisement
+
+    def _start_adapter_setup(self):
+        self.adapter_setup.start()
+        return False  # run once
+
+    def _adapter_ready(self, ok):
+        if not ok:
+            mainloop.quit()  # the watchdog restarts the app
+
+    def _beat(self):
+        self.heartbeat.beat()
+        return True  # keep scheduling
+
     def stop(self):
         global mainloop
         if mainloop:
             mainloop.quit()
-            print("Stopping treadmill app...")
+            logger.info("Stopping treadmill app...")
@@ -0,0 +1,358 @@
+# bluez_mock.py
+# A stand-in for BlueZ on a private D-Bus bus, to run the GATT server of
+# ble_treadmill.py off-device (CI box, laptop, no Bluetooth adapter).
+#
+# MockBlueZ owns "org.bluez" on the bus it is given and exports what
+# TreadmillSimulate.start() talks to: ObjectManager on "/", one adapter
+# (Adapter1, GattManager1, LEAdvertisingManager1) and AgentManager1. When
+# the application registers, the mock reads its object tree like bluetoothd
+# does, calls StartNotify on every notifying characteristic (a central
+# subscribing) and records every PropertiesChanged with its arrival time.
+#
+# Run as a script it benchmarks the GATT server: a private dbus-daemon, the
+# mock in this process, TreadmillSimulate.start(bus=...) in a child process
+# fed by the treadmill simulator. It reports the time to register the
+# advertisement and the application, notifications per second, CPU time of
+# the server per notification and the jitter of the notification interval,
+# then how many GetManagedObjects calls per second the server answers (what
+# every central connecting makes bluetoothd ask).
+#
+# Not validated yet: this harness has never been run (it needs dbus-python
+# and PyGObject, with a dbus-daemon on PATH). Until a first run is recorded
+# next to it, its numbers are not a reference for any change.
+#
+# Usage: python bluez_mock.py [--seconds 30] [--interval-ms 100] [--rate 10]
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import dbus
+import dbus.bus
+import dbus.mainloop.glib
+import dbus.service
+
+from gi.repository import GLib
+
+BLUEZ_SERVICE_NAME = "org.bluez"
+DBUS_OM_IFACE = "org.freedesktop.DBus.ObjectManager"
+DBUS_PROP_IFACE = "org.freedesktop.DBus.Properties"
+ADAPTER_IFACE = "org.bluez.Adapter1"
+GATT_MANAGER_IFACE = "org.bluez.GattManager1"
+GATT_CHRC_IFACE = "org.bluez.GattCharacteristic1"
+ADVERTISING_MANAGER_IFACE = "org.bluez.LEAdvertisingManager1"
+ADVERTISEMENT_IFACE = "org.bluez.LEAdvertisement1"
+AGENT_MANAGER_IFACE = "org.bluez.AgentManager1"
+
+ADAPTER_PATH = "/org/bluez/hci0"
+
+
+class AlreadyExists(dbus.exceptions.DBusException):
+    _dbus_error_name = "org.bluez.Error.AlreadyExists"
+
+
+class DoesNotExist(dbus.exceptions.DBusException):
+    _dbus_error_name = "org.bluez.Error.DoesNotExist"
+
+
+class InvalidArgs(dbus.exceptions.DBusException):
+    _dbus_error_name = "org.freedesktop.DBus.Error.InvalidArgs"
+
+
+class MockRoot(dbus.service.Object):
+    """ObjectManager of org.bluez: the adapter, as find_adapter() expects."""
+
+    def __init__(self, bus, adapter):
+        self.adapter = adapter
+        dbus.service.Object.__init__(self, bus, "/")
+
+    @dbus.service.method(DBUS_OM_IFACE, out_signature="a{oa{sa{sv}}}")
+    def GetManagedObjects(self):
+        return {dbus.ObjectPath(ADAPTER_PATH): self.adapter.properties}
+
+
+class MockAgentManager(dbus.service.Object):
+    def __init__(self, bus):
+        self.agents = {}
+        self.default = None
+        dbus.service.Object.__init__(self, bus, "/org/bluez")
+
+    @dbus.service.method(AGENT_MANAGER_IFACE, in_signature="os")
+    def RegisterAgent(self, agent, capability):
+        if agent in self.agents:
+            raise AlreadyExists("Already Exists")
+        self.agents[agent] = capability
+
+    @dbus.service.method(AGENT_MANAGER_IFACE, in_signature="o")
+    def RequestDefaultAgent(self, agent):
+        if agent not in self.agents:
+            raise DoesNotExist("Does Not Exist")
+        self.default = agent
+
+
+class MockAdapter(dbus.service.Object):
+    """
+    hci0: Adapter1 properties, GattManager1 and LEAdvertisingManager1.
+    Registration reads the client's objects the way bluetoothd does, then
+    subscribes to every characteristic that can notify.
+    """
+
+    def __init__(self, bus, recorder, alias="mock"):
+        self.bus = bus
+        self.recorder = recorder
+        self.properties = {
+            ADAPTER_IFACE: {
+                "Address": "00:00:00:00:00:00",
+                "Alias": alias,
+                "Powered": dbus.Boolean(True),
+                "Discoverable": dbus.Boolean(False),
+            },
+            GATT_MANAGER_IFACE: {},
+            ADVERTISING_MANAGER_IFACE: {
+                "ActiveInstances": dbus.Byte(0),
+                "SupportedInstances": dbus.Byte(4),
+            },
+        }
+        self.applications = {}    # path -> object tree
+        self.owners = {}          # application path -> bus name of its process
+        self.advertisements = {}  # path -> LEAdvertisement1 properties
+        dbus.service.Object.__init__(self, bus, ADAPTER_PATH)
+
+    @dbus.service.method(DBUS_PROP_IFACE, in_signature="ss", out_signature="v")
+    def Get(self, interface, name):
+        try:
+            return self.properties[interface][name]
+        except KeyError:
+            raise InvalidArgs(f"No property {interface}.{name}")
+
+    @dbus.service.method(DBUS_PROP_IFACE, in_signature="ssv")
+    def Set(self, interface, name, value):
+        if name not in self.properties.get(interface, {}):
+            raise InvalidArgs(f"No property {interface}.{name}")
+        self.properties[interface][name] = value
+
+    @dbus.service.method(DBUS_PROP_IFACE, in_signature="s", out_signature="a{sv}")
+    def GetAll(self, interface):
+        return self.properties.get(interface, {})
+
+    @dbus.service.method(GATT_MANAGER_IFACE, in_signature="oa{sv}", sender_keyword="sender",
+                         async_callbacks=("reply", "error"))
+    def RegisterApplication(self, application, options, sender, reply, error):
+        if application in self.applications:
+            error(AlreadyExists("Already Exists"))
+            return
+
+        def got_objects(objects):
+            self.applications[application] = objects
+            self.owners[application] = sender
+            self.recorder.event("application")
+            reply()
+            for path, interfaces in objects.items():
+                flags = interfaces.get(GATT_CHRC_IFACE, {}).get("Flags", [])
+                if "notify" in flags or "indicate" in flags:
+                    self.recorder.subscribe(sender, path, str(interfaces[GATT_CHRC_IFACE]["UUID"]))
+
+        manager = dbus.Interface(self.bus.get_object(sender, application), DBUS_OM_IFACE)
+        manager.GetManagedObjects(reply_handler=got_objects, error_handler=error)
+
+    @dbus.service.method(GATT_MANAGER_IFACE, in_signature="o")
+    def UnregisterApplication(self, application):
+        if self.applications.pop(application, None) is None:
+            raise DoesNotExist("Does Not Exist")
+
+    @dbus.service.method(ADVERTISING_MANAGER_IFACE, in_signature="oa{sv}", sender_keyword="sender",
+                         async_callbacks=("reply", "error"))
+    def RegisterAdvertisement(self, advertisement, options, sender, reply, error):
+        if advertisement in self.advertisements:
+            error(AlreadyExists("Already Exists"))
+            return
+
+        def got_properties(properties):
+            self.advertisements[advertisement] = properties
+            self.properties[ADVERTISING_MANAGER_IFACE]["ActiveInstances"] = dbus.Byte(len(self.advertisements))
+            self.recorder.event("advertisement")
+            reply()
+
+        props = dbus.Interface(self.bus.get_object(sender, advertisement), DBUS_PROP_IFACE)
+        props.GetAll(ADVERTISEMENT_IFACE, reply_handler=got_properties, error_handler=error)
+
+    @dbus.service.method(ADVERTISING_MANAGER_IFACE, in_signature="o")
+    def UnregisterAdvertisement(self, advertisement):
+        if self.advertisements.pop(advertisement, None) is None:
+            raise DoesNotExist("Does Not Exist")
+        self.properties[ADVERTISING_MANAGER_IFACE]["ActiveInstances"] = dbus.Byte(len(self.advertisements))
+
+
+class Recorder:
+    """Arrival times of registrations and of every notification, per characteristic."""
+
+    def __init__(self, bus):
+        self.bus = bus
+        self.origin = time.monotonic()
+        self.events = {}         # "advertisement"/"application" -> seconds from origin
+        self.uuids = {}          # characteristic path -> UUID
+        self.notifications = {}  # characteristic path -> [time.monotonic()]
+        self.last_value = {}
+        bus.add_signal_receiver(self._properties_changed, signal_name="PropertiesChanged",
+                                dbus_interface=DBUS_PROP_IFACE, path_keyword="path")
+
+    def event(self, name):
+        self.events.setdefault(name, time.monotonic() - self.origin)
+
+    def subscribe(self, sender, path, uuid):
+        self.uuids[path] = uuid
+        self.notifications.setdefault(path, [])
+        characteristic = dbus.Interface(self.bus.get_object(sender, path), GATT_CHRC_IFACE)
+        characteristic.StartNotify(reply_handler=lambda: None,
+                                   error_handler=lambda e: print(f"StartNotify {path}: {e}", file=sys.stderr))
+
+    def _properties_changed(self, interface, changed, invalidated, path=None):
+        if interface != GATT_CHRC_IFACE or "Value" not in changed or path not in self.notifications:
+            return
+        self.notifications[path].append(time.monotonic())
+        self.last_value[path] = bytes(changed["Value"])
+
+    def count(self):
+        return sum(len(times) for times in self.notifications.values())
+
+
+class MockBlueZ:
+    """The whole stand-in, owning org.bluez on bus."""
+
+    def __init__(self, bus):
+        self.bus = bus
+        self.name = dbus.service.BusName(BLUEZ_SERVICE_NAME, bus)
+        self.recorder = Recorder(bus)
+        self.adapter = MockAdapter(bus, self.recorder)
+        self.root = MockRoot(bus, self.adapter)
+        self.agent_manager = MockAgentManager(bus)
+
+
+def start_private_bus():
+    """A dbus-daemon of our own: (process, address)."""
+    process = subprocess.Popen(["dbus-daemon", "--session", "--nofork", "--print-address=1"],
+                               stdout=subprocess.PIPE, text=True)
+    return process, process.stdout.readline().strip()
+
+
+def cpu_seconds(pid):
+    """utime + stime of a process (Linux)."""
+    with open(f"/proc/{pid}/stat", "r") as file:
+        fields = file.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def serve(address, interval_ms, rate_hz):
+    """Child process: the real GATT server on the private bus, fed by the simulator."""
+    import threading
+
+    from ble_treadmill import TreadmillSimulate
+    from treadmill_simulator import TreadmillSimulator, interval_workout
+
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    bus = dbus.bus.BusConnection(address)
+    treadmill = TreadmillSimulate(device_name="MOCK-TREADMILL", notify_interval_ms=interval_ms)
+    simulator = TreadmillSimulator(interval_workout(), rate_hz=rate_hz)
+    threading.Thread(target=simulator.drive_peripheral, args=(treadmill,), daemon=True).start()
+    treadmill.start(bus=bus)
+
+
+def interval_stats(times):
+    """Mean, standard deviation, p99 deviation from the mean and max of the intervals (ms)."""
+    gaps = [(b - a) * 1000 for a, b in zip(times, times[1:])]
+    if len(gaps) < 2:
+        return None
+    mean = statistics.mean(gaps)
+    deviations = sorted(abs(g - mean) for g in gaps)
+    return {
+        "mean_ms": mean,
+        "jitter_ms": statistics.stdev(gaps),
+        "p99_deviation_ms": deviations[min(int(len(deviations) * 0.99), len(deviations) - 1)],
+        "max_ms": max(gaps),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the GATT server against a mock BlueZ.")
+    parser.add_argument("--seconds", type=float, default=30.0, help="measured notification time")
+    parser.add_argument("--interval-ms", type=int, default=100, help="notify_interval_ms of the server")
+    parser.add_argument("--rate", type=int, default=10, help="packets/s from the simulated treadmill")
+    parser.add_argument("--tree-calls", type=int, default=500, help="GetManagedObjects calls timed")
+    parser.add_argument("--serve", metavar="ADDRESS", help=argparse.SUPPRESS)  # child process
+    args = parser.parse_args(argv)
+
+    if args.serve:
+        serve(args.serve, args.interval_ms, args.rate)
+        return 0
+
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    daemon, address = start_private_bus()
+    child = None
+    try:
+        bus = dbus.bus.BusConnection(address)
+        mock = MockBlueZ(bus)
+        recorder = mock.recorder
+        child = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve", address,
+                                  "--interval-ms", str(args.interval_ms), "--rate", str(args.rate)])
+        loop = GLib.MainLoop()
+        state = {}
+
+        def poll():
+            if child.poll() is not None:
+                print(f"GATT server exited with {child.returncode}", file=sys.stderr)
+                loop.quit()
+                return False
+            now = time.monotonic()
+            if "start" not in state and recorder.count():
+                state["start"] = (now, cpu_seconds(child.pid), recorder.count())
+            elif "start" in state and now - state["start"][0] >= args.seconds:
+                state["end"] = (now, cpu_seconds(child.pid), recorder.count())
+                loop.quit()
+                return False
+            return True
+
+        GLib.timeout_add(50, poll)
+        GLib.timeout_add_seconds(int(args.seconds) + 60, loop.quit)  # server never notified
+        loop.run()
+        if "end" not in state:
+            return 1
+
+        (t0, cpu0, n0), (t1, cpu1, n1) = state["start"], state["end"]
+        notifications = n1 - n0
+        for name in ("advertisement", "application"):
+            when = recorder.events.get(name)
+            print(f"{name:16s} registered {when * 1000:8.1f} ms after launch" if when is not None
+                  else f"{name:16s} not registered")
+        for path, properties in mock.adapter.advertisements.items():
+            print(f"advertisement    {dict(properties)}")
+        print(f"notifications    {notifications} in {t1 - t0:.1f} s, {notifications / (t1 - t0):.1f}/s")
+        print(f"server CPU       {(cpu1 - cpu0) * 1e6 / max(notifications, 1):.0f} us per notification")
+        for path, times in sorted(recorder.notifications.items()):
+            stats = interval_stats([t for t in times if t0 <= t <= t1])
+            if stats is None:
+                print(f"{recorder.uuids[path][4:8]}             too few notifications")
+                continue
+            print(f"{recorder.uuids[path][4:8]}             interval {stats['mean_ms']:.2f} ms, "
+                  f"jitter {stats['jitter_ms']:.2f} ms, p99 deviation {stats['p99_deviation_ms']:.2f} ms, "
+                  f"max {stats['max_ms']:.1f} ms")
+        for path, sender in mock.adapter.owners.items():
+            manager = dbus.Interface(bus.get_object(sender, path), DBUS_OM_IFACE)
+            start = time.perf_counter()
+            for _ in range(args.tree_calls):
+                manager.GetManagedObjects()
+            elapsed = time.perf_counter() - start
+            print(f"object tree      {args.tree_calls / elapsed:.0f} GetManagedObjects/s")
+        return 0
+    finally:
+        if child is not None and child.poll() is None:
+            child.terminate()
+            child.wait(5)
+        daemon.terminate()
+        daemon.wait(5)
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
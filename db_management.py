@@ -3,9 +3,20 @@
 
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import case, cast, delete, event, extract, func, insert, inspect, literal, select, text, update
+from sqlalchemy.exc import OperationalError
 from apscheduler.schedulers.background import BackgroundScheduler
 import datetime
+import gzip
+import json
+import os
+import socket
+import time
 import traceback
+import urllib.request
+
+from best_efforts import best_efforts
+from metrics import counter, gauge, histogram
 
 ########################################################################
 # 1. Configuration
@@ -25,13 +36,66 @@ class MySQLConfig:
         self.SQLALCHEMY_TRACK_MODIFICATIONS = False
 
 
+class RemoteURIConfig:
+    def __init__(self, uri):
+        # Any SQLAlchemy URI in place of MySQL (e.g. a local SQLite stand-in for tests)
+        self.SQLALCHEMY_DATABASE_URI = uri
+        self.SQLALCHEMY_TRACK_MODIFICATIONS = False
+        if uri.startswith("sqlite"):
+            # Several kiosks share the stand-in: wait for the write lock instead of failing
+            self.SQLALCHEMY_ENGINE_OPTIONS = {"connect_args": {"timeout": 30}}
+
+
 ########################################################################
 # 2. Two SQLAlchemy Instances
 ########################################################################
 
+CROCKFORD32 = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+
+def new_ulid():
+    """
+    ULID: 48-bit millisecond timestamp + 80 random bits, 26 Crockford
+    base32 chars. Sortable by creation time and unique across kiosks.
+    """
+    value = (int(time.time() * 1000) << 80) | int.from_bytes(os.urandom(10), "big")
+    chars = []
+    for _ in range(26):
+        chars.append(CROCKFORD32[value & 0x1F])
+        value >>= 5
+    return "".join(reversed(chars))
+
 local_db = SQLAlchemy()
 remote_db = SQLAlchemy()
 
+COMMIT_SECONDS = histogram("db_commit_seconds", "Duration of session commits", ("db",))
+SYNC_RESULTS = counter("sync_batches_total", "Sync batches pushed to the remote DB or ingest service",
+                       ("result",))
+SYNC_ROWS = counter("sync_rows_total", "Rows synced to the remote DB or ingest service", ("table",))
+SYNC_BACKLOG = gauge("sync_backlog_rows", "Local rows still flagged needs_sync", ("table",))
+
+
+def _time_commits(db, name):
+    """Observe the duration of every commit of db's session in COMMIT_SECONDS."""
+    observer = COMMIT_SECONDS.labels(db=name)
+
+    @event.listens_for(db.session, "before_commit")
+    def before_commit(session):
+        session.info["commit_start"] = time.perf_counter()
+
+    @event.listens_for(db.session, "after_commit")
+    def after_commit(session):
+        start = session.info.pop("commit_start", None)
+        if start is not None:
+            observer.observe(time.perf_counter() - start)
+
+    @event.listens_for(db.session, "after_rollback")
+    def after_rollback(session):
+        session.info.pop("commit_start", None)
+
+
+_time_commits(local_db, "local")
+_time_commits(remote_db, "remote")
+
 ########################################################################
 # 3. Models
 ########################################################################
@@ -39,17 +103,77 @@ remote_db = SQLAlchemy()
 class LocalSession(local_db.Model):
     __tablename__ = 'sessions'
     id = local_db.Column(local_db.Integer, primary_key=True)
-    datetime = local_db.Column(local_db.String, nullable=False)
+    datetime = local_db.Column(local_db.String, nullable=False, index=True)
     km = local_db.Column(local_db.Integer, default=0)
     elapsed = local_db.Column(local_db.Integer, default=0)
     avg_speed = local_db.Column(local_db.Float, default=0.0)
     avg_bpm = local_db.Column(local_db.Float, default=0.0)
     kcal = local_db.Column(local_db.Integer, default=0)
     needs_sync = local_db.Column(local_db.Boolean, default=True)
+    # id of the row that opened the run: the start row and every km row
+    # of the same run share it (rows saved before this column existed are NULL)
+    run_id = local_db.Column(local_db.Integer, index=True)
+    # Globally unique key of the session on the remote DB (with the device id)
+    uid = local_db.Column(local_db.String(64), default=new_ulid, unique=True, index=True)
+
+class LocalSample(local_db.Model):
+    __tablename__ = 'samples'
+    id = local_db.Column(local_db.Integer, primary_key=True)
+    run_id = local_db.Column(local_db.Integer, nullable=False, index=True)
+    ts = local_db.Column(local_db.Float, nullable=False)  # epoch seconds when received
+    elapsed = local_db.Column(local_db.Integer, default=0)  # s
+    distance = local_db.Column(local_db.Integer, default=0)  # m
+    speed = local_db.Column(local_db.Float, default=0.0)  # km/h
+    bpm = local_db.Column(local_db.Integer, default=0)
+    kcal = local_db.Column(local_db.Integer, default=0)
+    # Outbox flag for the ingest service (NULL on rows saved before it existed)
+    needs_sync = local_db.Column(local_db.Boolean, default=True, index=True)
+
+class LocalSampleRollup(local_db.Model):
+    __tablename__ = 'sample_rollups'
+    id = local_db.Column(local_db.Integer, primary_key=True)
+    run_id = local_db.Column(local_db.Integer, nullable=False, index=True)
+    width = local_db.Column(local_db.Integer, nullable=False)  # bucket size, s
+    elapsed = local_db.Column(local_db.Integer, default=0)  # bucket start, s
+    ts = local_db.Column(local_db.Float, nullable=False)  # first sample of the bucket
+    samples = local_db.Column(local_db.Integer, default=0)
+    distance = local_db.Column(local_db.Integer, default=0)  # m at the end of the bucket
+    kcal = local_db.Column(local_db.Integer, default=0)
+    speed_min = local_db.Column(local_db.Float, default=0.0)
+    speed_mean = local_db.Column(local_db.Float, default=0.0)
+    speed_max = local_db.Column(local_db.Float, default=0.0)
+    bpm_min = local_db.Column(local_db.Integer)
+    bpm_mean = local_db.Column(local_db.Float)
+    bpm_max = local_db.Column(local_db.Integer)
+
+class LocalBestEffort(local_db.Model):
+    __tablename__ = 'best_efforts'
+    __table_args__ = (
+        local_db.UniqueConstraint('run_id', 'distance', name='uq_best_efforts_run_distance'),
+        local_db.Index('ix_best_efforts_distance_seconds', 'distance', 'seconds'),
+    )
+    id = local_db.Column(local_db.Integer, primary_key=True)
+    run_id = local_db.Column(local_db.Integer, nullable=False, index=True)
+    distance = local_db.Column(local_db.Integer, nullable=False)  # m
+    seconds = local_db.Column(local_db.Float, nullable=False)
+    start = local_db.Column(local_db.Float, default=0.0)  # elapsed s of the run where it started
+
+class LocalPersonalBest(local_db.Model):
+    __tablename__ = 'personal_bests'
+    distance = local_db.Column(local_db.Integer, primary_key=True)  # m
+    seconds = local_db.Column(local_db.Float, nullable=False)
+    run_id = local_db.Column(local_db.Integer, nullable=False)
+    datetime = local_db.Column(local_db.String, nullable=False)  # when it was set
 
 class RemoteSession(remote_db.Model):
     __tablename__ = 'sessions'
-    id = remote_db.Column(remote_db.Integer, primary_key=True)
+    __table_args__ = (
+        remote_db.UniqueConstraint('device_id', 'uid', name='uq_sessions_device_uid'),
+    )
+    id = remote_db.Column(remote_db.Integer, primary_key=True)  # remote only, never a local id
+    device_id = remote_db.Column(remote_db.String(32), nullable=False)
+    uid = remote_db.Column(remote_db.String(64), nullable=False)
+    local_id = remote_db.Column(remote_db.Integer)  # id of the row on its kiosk
     datetime = remote_db.Column(remote_db.DateTime, nullable=False)
     km = remote_db.Column(remote_db.Integer, default=0)
     elapsed = remote_db.Column(remote_db.Integer, default=0)
@@ -57,6 +181,56 @@ class RemoteSession(remote_db.Model):
     avg_bpm = remote_db.Column(remote_db.Float, default=0.0)
     kcal = remote_db.Column(remote_db.Integer, default=0)
 
+class RemoteSample(remote_db.Model):
+    __tablename__ = 'samples'
+    __table_args__ = (
+        remote_db.UniqueConstraint('device_id', 'local_id', name='uq_samples_device_local'),
+    )
+    id = remote_db.Column(remote_db.Integer, primary_key=True)
+    device_id = remote_db.Column(remote_db.String(32), nullable=False)
+    local_id = remote_db.Column(remote_db.Integer, nullable=False)
+    run_uid = remote_db.Column(remote_db.String(64), nullable=False, index=True)
+    ts = remote_db.Column(remote_db.Float, nullable=False)
+    elapsed = remote_db.Column(remote_db.Integer, default=0)
+    distance = remote_db.Column(remote_db.Integer, default=0)
+    speed = remote_db.Column(remote_db.Float, default=0.0)
+    bpm = remote_db.Column(remote_db.Integer, default=0)
+    kcal = remote_db.Column(remote_db.Integer, default=0)
+
+# Remote session columns copied from the local row on every upsert
+REMOTE_SESSION_FIELDS = ("local_id", "datetime", "km", "elapsed", "avg_speed", "avg_bpm", "kcal")
+REMOTE_SAMPLE_FIELDS = ("run_uid", "ts", "elapsed", "distance", "speed", "bpm", "kcal")
+
+def upsert_remote(model, rows, keys, update_fields=()):
+    """
+    Insert rows into a remote table in one statement; rows whose unique
+    keys already exist are updated with update_fields (or left alone if
+    there are none). No read before the write and no lock beyond the
+    touched rows, so several kiosks can push at the same time.
+    Must run inside an app context bound to remote_db.
+    """
+    dialect = remote_db.engine.dialect.name
+    if dialect == "mysql":
+        from sqlalchemy.dialects.mysql import insert as mysql_insert
+        stmt = mysql_insert(model).values(rows)
+        if update_fields:
+            stmt = stmt.on_duplicate_key_update({f: stmt.inserted[f] for f in update_fields})
+        else:
+            stmt = stmt.prefix_with("IGNORE")
+    else:
+        # SQLite stand-in (PostgreSQL has the same syntax)
+        from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+        stmt = sqlite_insert(model).values(rows)
+        if update_fields:
+            stmt = stmt.on_conflict_do_update(
+                index_elements=list(keys),
+                set_={f: stmt.excluded[f] for f in update_fields}
+            )
+        else:
+            stmt = stmt.on_conflict_do_nothing(index_elements=list(keys))
+    remote_db.session.execute(stmt)
+    remote_db.session.commit()
+
 ########################################################################
 # 4. DBManagement Class
 ########################################################################
@@ -69,6 +243,12 @@ class DBManagement:
     """
 
     def __init__(self, config):
+        # Identifies this kiosk on the shared remote DB
+        self.device_id = config.get("device_id") or socket.gethostname()
+        # With an ingest service configured, the outbox is pushed over HTTP
+        # instead of writing to the remote DB directly
+        self.ingest = config.get("Ingest")
+
         # -------------------------
         # Create the local (SQLite) Flask app
         # -------------------------
@@ -79,21 +259,44 @@ class DBManagement:
         # -------------------------
         # Create the remote (MySQL) Flask app
         # -------------------------
-        self.remote_app = Flask(__name__)
-        self.remote_app.config.from_object(MySQLConfig(
-            user=config["Mysql"]["user"],
-            password=config["Mysql"]["password"],
-            host=config["Mysql"]["host"],
-            db_name=config["Mysql"]["database"]
-            )
-        )
-        remote_db.init_app(self.remote_app)
+        # A kiosk that pushes to an ingest service has no database credentials
+        self.remote_app = None
+        if not self.ingest:
+            self.remote_app = Flask(__name__)
+            if config.get("remote_uri"):
+                self.remote_app.config.from_object(RemoteURIConfig(config["remote_uri"]))
+            else:
+                self.remote_app.config.from_object(MySQLConfig(
+                    user=config["Mysql"]["user"],
+                    password=config["Mysql"]["password"],
+                    host=config["Mysql"]["host"],
+                    db_name=config["Mysql"]["database"]
+                    )
+                )
+            remote_db.init_app(self.remote_app)
+            if config.get("remote_uri"):
+                # A stand-in starts empty; the real MySQL schema is managed by hand
+                with self.remote_app.app_context():
+                    remote_db.create_all()
 
         # -------------------------
         # Initialize local DB
         # -------------------------
         with self.app.app_context():
+            # A new file starts in incremental auto-vacuum (only possible before its
+            # first table), so compact_local_db() never needs a full VACUUM on it
+            with local_db.engine.connect() as conn:
+                if not inspect(conn).get_table_names():
+                    conn.execute(text("PRAGMA auto_vacuum = INCREMENTAL"))
+                    local_db.metadata.create_all(conn)
+                    conn.commit()
             local_db.create_all()  # Creates tables for LocalSession if not existing
+            self._upgrade_local_schema()
+            # Rows saved before the uid column existed
+            local_db.session.execute(text(
+                "UPDATE sessions SET uid = 'legacy-' || printf('%010d', id) WHERE uid IS NULL"
+            ))
+            local_db.session.commit()
 
         # -------------------------
         # Start a background scheduler
@@ -101,8 +304,87 @@ class DBManagement:
         self.scheduler = BackgroundScheduler()
         self.scheduler.start()
 
+        # Read at every /metrics scrape
+        SYNC_BACKLOG.labels(table="sessions").set_function(lambda: self.count_pending(LocalSession))
+        if self.ingest:  # samples only leave the kiosk through the ingest service
+            SYNC_BACKLOG.labels(table="samples").set_function(lambda: self.count_pending(LocalSample))
+
+        # Updated by save_samples() and touch_activity(): lets background jobs stay
+        # away from a run in progress
+        self.active_run_id = None
+        self.last_sample_time = 0.0
+        # sample_archive.SampleArchive, set by the app: iter_run_samples() reads
+        # the runs whose samples were moved out of SQLite from it
+        self.archive = None
+        # push_outbox() running / asked to run again by sync_sessions()
+        self.pushing = False
+        self.push_requested = False
+
+        if self.ingest:
+            # The outbox (sessions and samples) is only pushed by this job, woken up
+            # early by sync_sessions(), never on the thread that saved the rows
+            self.scheduler.add_job(
+                self.push_outbox, 'interval', seconds=self.ingest.get("interval", 60),
+                id="push_outbox", coalesce=True, max_instances=1, replace_existing=True
+            )
+
         print("[DBManagement] Initialization complete.")
 
+    # Columns that can be requested through list_local_sessions_page(fields=...)
+    SESSION_FIELDS = ("id", "datetime", "km", "elapsed", "avg_speed",
+                      "avg_bpm", "kcal", "needs_sync", "run_id")
+
+    def _upgrade_local_schema(self):
+        """
+        create_all() skips tables that already exist, so columns and indexes
+        added to the models after the first release never reach an existing
+        ftms.db. Add the missing ones here (must run inside the app context).
+        """
+        engine = local_db.engine
+        inspector = inspect(engine)
+        for table in local_db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {c["name"] for c in inspector.get_columns(table.name)}
+            with engine.begin() as conn:
+                for column in table.columns:
+                    if column.name not in existing:
+                        col_type = column.type.compile(dialect=engine.dialect)
+                        conn.execute(text(
+                            f"ALTER TABLE {table.name} ADD COLUMN {column.name} {col_type}"
+                        ))
+                        print(f"[DBManagement] Added column {table.name}.{column.name}")
+            for index in table.indexes:
+                index.create(bind=engine, checkfirst=True)
+        self._backfill_run_ids()
+
+    def _backfill_run_ids(self):
+        """
+        Give the rows saved before the run_id column existed the id of the
+        row that opened their run. They are cumulative per-km snapshots in
+        id order: a run starts at a km=0 start row, or where km or elapsed
+        go back. Without this every legacy row counts as a run of its own.
+        """
+        rows = local_db.session.execute(
+            select(LocalSession.id, LocalSession.km, LocalSession.elapsed)
+            .where(LocalSession.run_id.is_(None))
+            .order_by(LocalSession.id)
+        ).all()
+        if not rows:
+            return
+        updates = []
+        run_id = prev_km = prev_elapsed = None
+        for row_id, km, elapsed in rows:
+            km, elapsed = km or 0, elapsed or 0
+            if run_id is None or km == 0 or km < prev_km or elapsed < prev_elapsed:
+                run_id = row_id
+            updates.append({"id": row_id, "run_id": run_id})
+            prev_km, prev_elapsed = km, elapsed
+        local_db.session.execute(update(LocalSession), updates)
+        local_db.session.commit()
+        print(f"[DBManagement] Grouped {len(rows)} legacy sessions into "
+              f"{len({u['run_id'] for u in updates})} runs.")
+
     def parse_local_datetime(self, dt_str):
         """
         Convert a local string (e.g. "2025-01-01 11:30:00" or "01/01/2025 11:30")
@@ -117,6 +399,7 @@ class DBManagement:
     def save_local_session(self, data):
         """
         Save a new session in local DB, attempt immediate remote sync.
+        If data has no 'run_id' the row opens a new run (run_id = its own id).
        """
 
         with self.app.app_context():
@@ -127,9 +410,13 @@ class DBManagement:
                 avg_speed=data['avg_speed'],
                 avg_bpm=data['avg_bpm'],
                 kcal=data['kcal'],
-                needs_sync=True
+                needs_sync=True,
+                run_id=data.get('run_id')
             )
             local_db.session.add(new_sess)
+            local_db.session.flush()
+            if new_sess.run_id is None:
+                new_sess.run_id = new_sess.id
             local_db.session.commit()
 
             created_id = new_sess.id
@@ -140,12 +427,12 @@ class DBManagement:
             print("[IMMEDIATE SYNC ERROR]", e)
             return {        
                 "message": "Session saved locally. Immediate sync failed.",
-                "id": new_sess.id
+                "id": created_id
             }, 500
 
         return {
             "message": "Session saved locally. Sync attempted.",
-            "id": new_sess.id
+            "id": created_id
         }, 201
 
     def list_local_sessions(self):
@@ -164,10 +451,435 @@ class DBManagement:
                     "avg_speed": s.avg_speed,
                     "avg_bpm": s.avg_bpm,
                     "kcal": s.kcal,
-                    "needs_sync": s.needs_sync
+                    "needs_sync": s.needs_sync,
+                    "run_id": s.run_id
                 })
         return results
 
+    def save_samples(self, run_id, samples):
+        """
+        Bulk insert per-second samples of a run (one executemany, one commit).
+        Each sample is a dict with ts, elapsed, distance, speed, bpm, kcal.
+        """
+        if not samples:
+            return
+        rows = [dict(sample, run_id=run_id) for sample in samples]
+        with self.app.app_context():
+            local_db.session.execute(insert(LocalSample), rows)
+            local_db.session.commit()
+        self.active_run_id = run_id
+        self.last_sample_time = time.time()
+
+    def touch_activity(self):
+        """
+        Called by BLEConnection for every sample of a run, also before the
+        run has a row (first km) and samples are saved.
+        """
+        self.last_sample_time = time.time()
+
+    def run_in_progress(self, idle_seconds=600):
+        """True if a sample was recorded in the last idle_seconds."""
+        return time.time() - self.last_sample_time < idle_seconds
+
+    def list_finished_runs(self, older_than, include_unsynced=False):
+        """
+        Ids of the runs that still have samples in the local DB and whose
+        last sample is older than the epoch time older_than. With an ingest
+        service, runs with samples still waiting in the outbox are left out:
+        the callers archive or delete the raw samples. (Without it samples
+        never leave the kiosk and their needs_sync flag is never cleared.)
+        """
+        query = (
+            select(LocalSample.run_id)
+            .group_by(LocalSample.run_id)
+            .having(func.max(LocalSample.ts) < older_than)
+            .order_by(LocalSample.run_id)
+        )
+        if self.ingest and not include_unsynced:
+            query = query.having(func.sum(case((LocalSample.needs_sync == True, 1), else_=0)) == 0)
+        with self.app.app_context():
+            run_ids = local_db.session.execute(query).scalars().all()
+        if self.run_in_progress():
+            run_ids = [r for r in run_ids if r != self.active_run_id]
+        return run_ids
+
+    def delete_run_samples(self, run_id, batch_size=2000):
+        """
+        Delete the samples of a run in small transactions, so the SD card
+        never has to journal one huge delete and readers are not blocked.
+        Returns the number of deleted rows.
+        """
+        deleted = 0
+        with self.app.app_context():
+            while True:
+                ids = select(LocalSample.id).where(LocalSample.run_id == run_id).limit(batch_size)
+                result = local_db.session.execute(
+                    delete(LocalSample).where(LocalSample.id.in_(ids.scalar_subquery()))
+                )
+                local_db.session.commit()
+                deleted += result.rowcount
+                if result.rowcount < batch_size:
+                    break
+        return deleted
+
+    def iter_run_samples(self, run_id, batch_size=500):
+        """
+        Yield the samples of a run in order as (ts, elapsed, distance, speed,
+        bpm, kcal) rows. The rows are fetched from the cursor batch_size at a
+        time, so a long run is never loaded in memory at once. A run whose
+        samples already left SQLite is read from the sample archive, if any.
+        """
+        with self.app.app_context():
+            engine = local_db.engine
+        query = (
+            select(LocalSample.ts, LocalSample.elapsed, LocalSample.distance,
+                   LocalSample.speed, LocalSample.bpm, LocalSample.kcal)
+            .where(LocalSample.run_id == run_id)
+            .order_by(LocalSample.id)
+        )
+        found = False
+        with engine.connect() as conn:
+            result = conn.execution_options(stream_results=True, yield_per=batch_size).execute(query)
+            for row in result:
+                found = True
+                yield row
+        if not found and self.archive is not None:
+            yield from self.archive.iter_run(run_id)
+
+    def get_run_summary(self, run_id):
+        """
+        Start time and totals of a run, computed by SQLite from the session
+        rows and the samples. Returns None if the run does not exist.
+        """
+        with self.app.app_context():
+            start = local_db.session.execute(
+                select(func.min(LocalSession.datetime), func.max(LocalSession.km),
+                       func.max(LocalSession.elapsed), func.max(LocalSession.kcal))
+                .where(func.coalesce(LocalSession.run_id, LocalSession.id) == run_id)
+            ).one()
+            if start[0] is None:
+                return None
+            samples = local_db.session.execute(
+                select(func.count(), func.max(LocalSample.elapsed),
+                       func.max(LocalSample.distance), func.max(LocalSample.kcal),
+                       func.avg(case((LocalSample.bpm > 0, LocalSample.bpm))))
+                .where(LocalSample.run_id == run_id)
+            ).one()
+        if not samples[0] and self.archive is not None:
+            samples = self.archive.run_totals(run_id)
+
+        return {
+            "run_id": run_id,
+            "datetime": start[0],
+            "samples": samples[0],
+            "distance": max(start[1] or 0, samples[2] or 0),
+            "elapsed": max(start[2] or 0, samples[1] or 0),
+            "kcal": max(start[3] or 0, samples[3] or 0),
+            "avg_bpm": samples[4] or 0,
+        }
+
+    def get_run_laps(self, run_id):
+        """
+        Laps of a stored run in the same tuple layout that
+        BLEConnection.decode_treadmill_data keeps in data_stream["average_speeds"]:
+        (lap_time, lap_kcal, avg_speed, avg_pace, avg_bpm, elapsed, kcal, distance)
+        """
+        with self.app.app_context():
+            rows = local_db.session.execute(
+                select(LocalSession.km, LocalSession.elapsed, LocalSession.kcal,
+                       LocalSession.avg_speed, LocalSession.avg_bpm)
+                .where(func.coalesce(LocalSession.run_id, LocalSession.id) == run_id)
+                .where(LocalSession.km > 0)
+                .order_by(LocalSession.id)
+            ).all()
+
+        laps = []
+        prev_elapsed = prev_kcal = prev_km = 0
+        for km, elapsed, kcal, avg_speed, avg_bpm in rows:
+            if elapsed <= prev_elapsed or km <= prev_km:
+                continue  # e.g. a /save_session row with nothing new
+            pace_min_km = 60 / avg_speed if avg_speed > 0 else 0
+            avg_pace = f"{int(pace_min_km)}:{int((pace_min_km % 1) * 60):02d}"
+            laps.append((elapsed - prev_elapsed, kcal - prev_kcal, avg_speed, avg_pace,
+                         avg_bpm, elapsed, kcal, km))
+            prev_elapsed, prev_kcal, prev_km = elapsed, kcal, km
+        return laps
+
+    def save_best_efforts(self, run_id, efforts):
+        """
+        Store the best efforts of a run ({distance: best_efforts.Effort},
+        replacing what the run had) and update the all-time personal_bests.
+        Called when a session is closed. Returns the distances of the new PBs.
+        """
+        if not efforts:
+            return []
+        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        improved = []
+        with self.app.app_context():
+            local_db.session.execute(delete(LocalBestEffort).where(LocalBestEffort.run_id == run_id))
+            local_db.session.execute(insert(LocalBestEffort), [
+                {"run_id": run_id, "distance": e.distance, "seconds": e.seconds, "start": e.start}
+                for e in efforts.values()
+            ])
+            for effort in efforts.values():
+                pb = local_db.session.get(LocalPersonalBest, effort.distance)
+                if pb is None:
+                    pb = LocalPersonalBest(distance=effort.distance)
+                    local_db.session.add(pb)
+                elif pb.seconds <= effort.seconds:
+                    continue
+                pb.seconds = effort.seconds
+                pb.run_id = run_id
+                pb.datetime = now
+                improved.append(effort.distance)
+            local_db.session.commit()
+        if improved:
+            print(f"[DBManagement] New personal bests on run {run_id}: {sorted(improved)} m")
+        return improved
+
+    def update_run_best_efforts(self, run_id):
+        """
+        Compute the best efforts of a stored run from its raw samples
+        (one pass) and save them; for runs recorded before best efforts
+        were tracked. Returns the distances of the new PBs.
+        """
+        return self.save_best_efforts(run_id, best_efforts(self.iter_run_samples(run_id)))
+
+    def get_run_best_efforts(self, run_id):
+        """Best efforts of a stored run: {distance: seconds}."""
+        with self.app.app_context():
+            rows = local_db.session.execute(
+                select(LocalBestEffort.distance, LocalBestEffort.seconds)
+                .where(LocalBestEffort.run_id == run_id)
+            ).all()
+        return dict(rows)
+
+    def get_personal_bests(self):
+        """All-time personal bests: {distance: seconds}."""
+        with self.app.app_context():
+            rows = local_db.session.execute(
+                select(LocalPersonalBest.distance, LocalPersonalBest.seconds)
+            ).all()
+        return dict(rows)
+
+    def rollup_run_samples(self, run_id, width=60):
+        """
+        Summarize the samples of a run in buckets of width seconds
+        (min/mean/max of speed and bpm), computed by SQLite with GROUP BY.
+        Does nothing if the run already has rollups, so a run whose raw
+        samples were only partly deleted is never rolled up twice.
+        """
+        bucket = (LocalSample.elapsed // width) * width
+        bpm = func.nullif(LocalSample.bpm, 0)
+        rollup = (
+            select(
+                LocalSample.run_id, literal(width), bucket, func.min(LocalSample.ts),
+                func.count(), func.max(LocalSample.distance), func.max(LocalSample.kcal),
+                func.min(LocalSample.speed), func.avg(LocalSample.speed), func.max(LocalSample.speed),
+                func.min(bpm), func.avg(bpm), func.max(bpm),
+            )
+            .where(LocalSample.run_id == run_id)
+            .group_by(LocalSample.run_id, bucket)
+        )
+        columns = ["run_id", "width", "elapsed", "ts", "samples", "distance", "kcal",
+                   "speed_min", "speed_mean", "speed_max", "bpm_min", "bpm_mean", "bpm_max"]
+        with self.app.app_context():
+            exists = local_db.session.execute(
+                select(LocalSampleRollup.id).where(LocalSampleRollup.run_id == run_id).limit(1)
+            ).first()
+            if exists:
+                return 0
+            result = local_db.session.execute(insert(LocalSampleRollup).from_select(columns, rollup))
+            local_db.session.commit()
+        return result.rowcount
+
+    def rollup_old_samples(self, raw_days=30, width=60, max_seconds=None, batch_size=2000):
+        """
+        Retention job: replace the raw samples of runs older than raw_days
+        with rollups of width seconds. Works one run at a time and stops
+        early when max_seconds have passed or a run starts. Runs with
+        samples not pushed to the ingest service yet keep their raw
+        samples, however old (a kiosk can stay offline for weeks).
+        Returns the number of runs processed.
+        """
+        deadline = time.monotonic() + max_seconds if max_seconds else None
+        older_than = time.time() - raw_days * 86400
+        run_ids = self.list_finished_runs(older_than=older_than)
+        if self.ingest:
+            waiting = len(self.list_finished_runs(older_than=older_than, include_unsynced=True)) - len(run_ids)
+            if waiting:
+                print(f"[DBManagement] Keeping the raw samples of {waiting} runs not synced yet.")
+        processed = 0
+        for run_id in run_ids:
+            if self.run_in_progress() or (deadline and time.monotonic() > deadline):
+                print("[DBManagement] Rollup interrupted, will resume next time.")
+                break
+            if self.ingest and self.count_pending_samples(run_id):
+                continue  # flagged again since the list was read
+            self.rollup_run_samples(run_id, width)
+            self.delete_run_samples(run_id, batch_size=batch_size)
+            processed += 1
+        if processed:
+            print(f"[DBManagement] Rolled up samples of {processed} runs.")
+        return processed
+
+    def compact_local_db(self, vacuum_pages=2000, max_seconds=None):
+        """
+        Maintenance job: give back the pages freed by the deletes and refresh
+        the planner statistics. A file created before incremental auto-vacuum
+        was the default needs one full VACUUM to switch; it is abandoned
+        (SQLite rolls it back) past max_seconds or when a run starts, and
+        tried again the next night.
+        """
+        if self.run_in_progress():
+            return
+        deadline = time.monotonic() + max_seconds if max_seconds else None
+        with self.app.app_context():
+            engine = local_db.engine
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            mode = conn.execute(text("PRAGMA auto_vacuum")).scalar()
+            if mode != 2:  # 2 = INCREMENTAL
+                sqlite_conn = conn.connection.driver_connection
+                sqlite_conn.set_progress_handler(
+                    lambda: self.run_in_progress() or bool(deadline and time.monotonic() > deadline),
+                    10000  # SQLite VM instructions between checks
+                )
+                try:
+                    conn.execute(text("PRAGMA auto_vacuum = INCREMENTAL"))
+                    conn.execute(text("VACUUM"))
+                except OperationalError:
+                    print("[DBManagement] VACUUM interrupted, will retry next time.")
+                    return
+                finally:
+                    sqlite_conn.set_progress_handler(None, 0)
+                print("[DBManagement] Local DB switched to incremental vacuum.")
+            conn.execute(text(f"PRAGMA incremental_vacuum({int(vacuum_pages)})"))
+            conn.execute(text("ANALYZE"))
+
+    def schedule_maintenance(self, settings):
+        """
+        Add the retention jobs to the scheduler, run in the idle hours given
+        by settings (the "Retention" section of config.json):
+        raw_days, rollup_seconds, hour, max_minutes, vacuum_pages.
+        """
+        hour = settings.get("hour", 4)
+        max_seconds = settings.get("max_minutes", 20) * 60
+        self.scheduler.add_job(
+            self.rollup_old_samples, 'cron', hour=hour, id="rollup_samples",
+            kwargs={
+                "raw_days": settings.get("raw_days", 30),
+                "width": settings.get("rollup_seconds", 60),
+                "max_seconds": max_seconds,
+            },
+            coalesce=True, max_instances=1, misfire_grace_time=max_seconds, replace_existing=True
+        )
+        # After the rollup has freed pages (it stops after max_minutes)
+        compact_hour, compact_minute = divmod(hour * 60 + settings.get("max_minutes", 20) + 5, 60)
+        self.scheduler.add_job(
+            self.compact_local_db, 'cron', hour=compact_hour % 24, minute=compact_minute,
+            id="compact_local_db",
+            kwargs={"vacuum_pages": settings.get("vacuum_pages", 2000), "max_seconds": max_seconds},
+            coalesce=True, max_instances=1, misfire_grace_time=max_seconds, replace_existing=True
+        )
+
+    def list_local_sessions_page(self, before_id=None, limit=50,
+                                 date_from=None, date_to=None, fields=None):
+        """
+        One page of local sessions, newest first, using keyset pagination
+        on the primary key: pass the returned 'next_cursor' as before_id to
+        get the next page. Only the requested columns are read.
+
+        date_from / date_to are "YYYY-MM-DD" strings (both inclusive); the
+        datetime column is TEXT "YYYY-MM-DD HH:MM:SS" so they compare lexically.
+        """
+        fields = list(fields) if fields else list(self.SESSION_FIELDS)
+        unknown = [f for f in fields if f not in self.SESSION_FIELDS]
+        if unknown:
+            raise ValueError(f"Unknown fields: {unknown}")
+        if "id" not in fields:
+            fields.insert(0, "id")  # needed for the cursor
+
+        columns = [getattr(LocalSession, f) for f in fields]
+        query = select(*columns).order_by(LocalSession.id.desc()).limit(limit)
+        if before_id is not None:
+            query = query.where(LocalSession.id < before_id)
+        if date_from:
+            query = query.where(LocalSession.datetime >= date_from)
+        if date_to:
+            query = query.where(LocalSession.datetime <= f"{date_to} 23:59:59")
+
+        with self.app.app_context():
+            rows = local_db.session.execute(query).all()
+            results = [dict(zip(fields, row)) for row in rows]
+
+        next_cursor = results[-1]["id"] if len(results) == limit else None
+        return {"sessions": results, "next_cursor": next_cursor}
+
+    def session_stats(self, group="week", date_from=None, date_to=None):
+        """
+        Totals per week or month computed by SQLite (GROUP BY), one entry
+        per period: runs, distance (m), elapsed (s), avg pace and avg bpm.
+
+        km/elapsed are cumulative within a run, so each run is first reduced
+        to its MAX values, then the runs are summed per period.
+        """
+        if group not in ("week", "month"):
+            raise ValueError("group must be 'week' or 'month'")
+
+        run_key = func.coalesce(LocalSession.run_id, LocalSession.id)
+        runs = select(
+            func.min(LocalSession.datetime).label("started"),
+            func.max(LocalSession.km).label("distance"),
+            func.max(LocalSession.elapsed).label("elapsed"),
+            func.avg(case((LocalSession.avg_bpm > 0, LocalSession.avg_bpm))).label("avg_bpm"),
+        ).group_by(run_key)
+        if date_from:
+            runs = runs.where(LocalSession.datetime >= date_from)
+        if date_to:
+            runs = runs.where(LocalSession.datetime <= f"{date_to} 23:59:59")
+        runs = runs.subquery()
+
+        if group == "week":
+            # ISO week ("2026-W01"): the week and its year are those of its
+            # Thursday, so a week never splits at the new year (SQLite only
+            # has %G/%V from 3.46)
+            thursday = func.date(runs.c.started, "-3 days", "weekday 4")
+            week = (cast(func.strftime("%j", thursday), local_db.Integer) + 6) / 7
+            period = func.printf("%s-W%02d", func.strftime("%Y", thursday), week)
+        else:
+            period = func.strftime("%Y-%m", runs.c.started)
+        query = (
+            select(
+                period.label("period"),
+                func.count().label("runs"),
+                func.sum(runs.c.distance).label("distance"),
+                func.sum(runs.c.elapsed).label("elapsed"),
+                func.avg(runs.c.avg_bpm).label("avg_bpm"),
+            )
+            .where(runs.c.distance > 0)
+            .group_by(period)
+            .order_by(period.desc())
+        )
+
+        with self.app.app_context():
+            rows = local_db.session.execute(query).all()
+
+        results = []
+        for row in rows:
+            distance = row.distance or 0
+            elapsed = row.elapsed or 0
+            pace_s_km = elapsed / (distance / 1000) if distance > 0 else 0
+            results.append({
+                "period": row.period,
+                "runs": row.runs,
+                "distance": distance,
+                "elapsed": elapsed,
+                "avg_pace": f"{int(pace_s_km // 60)}:{int(pace_s_km % 60):02d}",
+                "avg_speed": round(distance / elapsed * 3.6, 2) if elapsed > 0 else 0,
+                "avg_bpm": round(row.avg_bpm or 0, 1),
+            })
+        return results
+
 
     def sync_session(self, session_id):
         """
@@ -175,42 +887,360 @@ class DBManagement:
         If success, mark needs_sync=False locally.
         If fail, handle error (or schedule a retry).
         """
+        self.sync_sessions([session_id])
+
+    def _remote_row(self, local_session):
+        return {
+            "device_id": self.device_id,
+            "uid": local_session.uid,
+            "local_id": local_session.id,
+            # Convert local TEXT datetime into Python datetime
+            "datetime": self.parse_local_datetime(local_session.datetime),
+            "km": local_session.km,
+            "elapsed": local_session.elapsed,
+            "avg_speed": local_session.avg_speed,
+            "avg_bpm": local_session.avg_bpm,
+            "kcal": local_session.kcal,
+        }
+
+    def sync_sessions(self, session_ids):
+        """
+        Upsert a batch of local sessions to the remote DB and mark them
+        needs_sync=False. Returns the number of synced sessions.
+        With an ingest service configured the sessions are already in the
+        outbox (needs_sync): the push_outbox job is only woken up, so the
+        caller (often the BLE thread) never waits on the HTTP push; returns 0.
+        """
+        if self.ingest:
+            self.push_requested = True
+            if not self.pushing:  # else the running push goes round once more
+                self.scheduler.modify_job("push_outbox", next_run_time=datetime.datetime.now())
+            return 0
+
         with self.app.app_context():
-            local_session = local_db.session.get(LocalSession, session_id)
-            if not local_session:
-                print(f"[SYNC ERROR] session {session_id} not found locally.")
-                return
+            local_sessions = LocalSession.query.filter(LocalSession.id.in_(session_ids)).all()
+            if not local_sessions:
+                print(f"[SYNC ERROR] sessions {session_ids} not found locally.")
+                return 0
 
+            synced_ids = [s.id for s in local_sessions]
             try:
                 # Sync with remote DB in its own context
+                rows = [self._remote_row(s) for s in local_sessions]
                 with self.remote_app.app_context():
-                    remote_session = remote_db.session.get(RemoteSession, session_id)
-                    if not remote_session:
-                        remote_session = RemoteSession(id=session_id)
-
-                    # Convert local TEXT datetime into Python datetime
-                    dt_obj = self.parse_local_datetime(local_session.datetime)
+                    upsert_remote(RemoteSession, rows, ("device_id", "uid"), REMOTE_SESSION_FIELDS)
 
-                    remote_session.datetime = dt_obj
-                    remote_session.km = local_session.km
-                    remote_session.elapsed = local_session.elapsed
-                    remote_session.avg_speed = local_session.avg_speed
-                    remote_session.avg_bpm = local_session.avg_bpm
-                    remote_session.kcal = local_session.kcal
-
-                    remote_db.session.add(remote_session)
-                    remote_db.session.commit()
-
-                # Mark local item as synced
-                local_session.needs_sync = False
+                # Mark local items as synced
+                local_db.session.execute(
+                    update(LocalSession).where(LocalSession.id.in_(synced_ids)).values(needs_sync=False)
+                )
                 local_db.session.commit()
-                print(f"[SYNC SUCCESS] session {session_id} synced to remote.")
+                SYNC_RESULTS.labels(result="ok").inc()
+                SYNC_ROWS.labels(table="sessions").inc(len(synced_ids))
+                print(f"[SYNC SUCCESS] sessions {synced_ids} synced to remote.")
+                return len(synced_ids)
 
             except Exception as e:
-                print(f"[SYNC FAILED] session {session_id}: {e}")
+                local_db.session.rollback()
+                SYNC_RESULTS.labels(result="failed").inc()
+                print(f"[SYNC FAILED] sessions {synced_ids}: {e}")
                 traceback.print_exc()
                 # Optionally schedule a one-time retry job here if needed
                 # e.g., self.scheduler.add_job(...)
+                return 0
+
+    # -------------------------
+    # Ingest service outbox
+    # -------------------------
+    def _outbox_frames(self, batch_size):
+        """
+        Up to batch_size pending sessions and batch_size pending samples as
+        NDJSON-ready dicts, plus the local ids needed to mark them synced.
+        """
+        with self.app.app_context():
+            sessions = LocalSession.query.filter(LocalSession.needs_sync == True) \
+                .order_by(LocalSession.id).limit(batch_size).all()
+            frames = []
+            for s in sessions:
+                row = self._remote_row(s)
+                row["datetime"] = row["datetime"].strftime("%Y-%m-%d %H:%M:%S")
+                frames.append(dict(row, type="session"))
+            samples = local_db.session.execute(
+                select(LocalSample.id, LocalSession.uid, LocalSample.ts, LocalSample.elapsed,
+                       LocalSample.distance, LocalSample.speed, LocalSample.bpm, LocalSample.kcal)
+                .join(LocalSession, LocalSession.id == LocalSample.run_id)
+                .where(LocalSample.needs_sync == True)
+                .order_by(LocalSample.id)
+                .limit(batch_size)
+            ).all()
+        for row in samples:
+            frames.append({
+                "type": "sample", "device_id": self.device_id, "local_id": row[0],
+                "run_uid": row[1], "ts": row[2], "elapsed": row[3], "distance": row[4],
+                "speed": row[5], "bpm": row[6], "kcal": row[7],
+            })
+        return frames, [s.id for s in sessions], [row[0] for row in samples]
+
+    def _post_frames(self, frames):
+        """POST frames as gzip-compressed NDJSON to the ingest service."""
+        body = "\n".join(json.dumps(f, separators=(",", ":")) for f in frames).encode("utf-8")
+        headers = {"Content-Type": "application/x-ndjson", "Content-Encoding": "gzip"}
+        if self.ingest.get("token"):
+            headers["Authorization"] = f"Bearer {self.ingest['token']}"
+        request = urllib.request.Request(
+            self.ingest["url"], data=gzip.compress(body, compresslevel=6), headers=headers, method="POST"
+        )
+        with urllib.request.urlopen(request, timeout=self.ingest.get("timeout", 10)) as response:
+            return json.loads(response.read() or b"{}")
+
+    def push_outbox(self):
+        """
+        Push every session and sample flagged needs_sync to the ingest
+        service, one batch per request, marking each batch synced once the
+        service accepted it. Returns {"sessions": n, "samples": m}.
+        """
+        batch_size = self.ingest.get("batch_size", 500)
+        pushed = {"sessions": 0, "samples": 0}
+        self.pushing = True
+        self.push_requested = False
+        try:
+            while True:
+                frames, session_ids, sample_ids = self._outbox_frames(batch_size)
+                if not frames:
+                    if not self.push_requested:
+                        break
+                    self.push_requested = False  # rows saved meanwhile: look again
+                    continue
+                try:
+                    self._post_frames(frames)
+                except Exception as e:
+                    SYNC_RESULTS.labels(result="failed").inc()
+                    print(f"[SYNC FAILED] ingest push of {len(frames)} frames: {e}")
+                    break
+                with self.app.app_context():
+                    if session_ids:
+                        local_db.session.execute(
+                            update(LocalSession).where(LocalSession.id.in_(session_ids)).values(needs_sync=False)
+                        )
+                    if sample_ids:
+                        local_db.session.execute(
+                            update(LocalSample).where(LocalSample.id.in_(sample_ids)).values(needs_sync=False)
+                        )
+                    local_db.session.commit()
+                SYNC_RESULTS.labels(result="ok").inc()
+                SYNC_ROWS.labels(table="sessions").inc(len(session_ids))
+                SYNC_ROWS.labels(table="samples").inc(len(sample_ids))
+                pushed["sessions"] += len(session_ids)
+                pushed["samples"] += len(sample_ids)
+        finally:
+            self.pushing = False
+        if pushed["sessions"] or pushed["samples"]:
+            print(f"[SYNC SUCCESS] pushed {pushed['sessions']} sessions, {pushed['samples']} samples to ingest.")
+        return pushed
+
+    def adopt_legacy_remote_rows(self):
+        """
+        One-off migration for a remote DB filled before device ids existed:
+        give the rows without a uid this kiosk's device id and the same
+        'legacy-<id>' uid the local rows got, so they are updated in place
+        instead of duplicated. Run it from the kiosk that created them.
+        """
+        if self.remote_app is None:
+            print("[DBManagement] No remote DB access (ingest service): nothing to adopt.")
+            return 0
+        with self.remote_app.app_context():
+            if remote_db.engine.dialect.name == "mysql":
+                uid = "CONCAT('legacy-', LPAD(id, 10, '0'))"
+            else:
+                uid = "'legacy-' || printf('%010d', id)"
+            result = remote_db.session.execute(
+                text(f"UPDATE sessions SET device_id = :device, local_id = id, uid = {uid} "
+                     "WHERE uid IS NULL OR uid = ''"),
+                {"device": self.device_id}
+            )
+            remote_db.session.commit()
+        print(f"[DBManagement] {result.rowcount} remote rows adopted by {self.device_id}.")
+        return result.rowcount
+
+    def count_pending(self, model):
+        """Number of rows of a local model still flagged needs_sync."""
+        with self.app.app_context():
+            return local_db.session.execute(
+                select(func.count()).select_from(model).where(model.needs_sync == True)
+            ).scalar()
+
+    def count_pending_samples(self, run_id):
+        """Samples of a run still flagged needs_sync."""
+        with self.app.app_context():
+            return local_db.session.execute(
+                select(func.count()).select_from(LocalSample)
+                .where(LocalSample.run_id == run_id, LocalSample.needs_sync == True)
+            ).scalar()
+
+    def sync_backlog(self):
+        """Rows waiting to be synced, per table (as in the sync_backlog_rows gauge)."""
+        backlog = {"sessions": self.count_pending(LocalSession)}
+        if self.ingest:
+            backlog["samples"] = self.count_pending(LocalSample)
+        return backlog
+
+    def sync_pending_sessions(self):
+        """Retry the sync of every local session still flagged needs_sync."""
+        with self.app.app_context():
+            pending = local_db.session.execute(
+                select(LocalSession.id).where(LocalSession.needs_sync == True).order_by(LocalSession.id)
+            ).scalars().all()
+        batch_size = 200
+        for i in range(0, len(pending), batch_size):
+            self.sync_sessions(pending[i:i + batch_size])
+        return len(pending)
+
+    # -------------------------
+    # Local / remote reconciliation
+    # -------------------------
+    # Each side is summarized per bucket by a tuple of SQL aggregates; only
+    # buckets whose tuples differ are split further (month -> day -> rows),
+    # so an unchanged history costs one query per side.
+
+    @staticmethod
+    def _digest_columns(model, id_column):
+        seconds_of_day = (extract('hour', model.datetime) * 3600
+                          + extract('minute', model.datetime) * 60
+                          + extract('second', model.datetime))
+        return (
+            func.count(),
+            func.sum(id_column),
+            func.sum(model.km),
+            func.sum(model.elapsed),
+            func.sum(model.kcal),
+            func.sum(func.round(model.avg_speed * 100)),
+            func.sum(func.round(model.avg_bpm * 100)),
+            func.sum(seconds_of_day),
+            func.sum(id_column * model.km + model.elapsed),  # catches values swapped between rows
+        )
+
+    @staticmethod
+    def _month_bounds(month):
+        start = datetime.datetime.strptime(month, "%Y-%m")
+        end = (start + datetime.timedelta(days=32)).replace(day=1)
+        return start, end
+
+    def _local_digests(self, level, month=None):
+        """{bucket: digest} of the local sessions, per 'month' or per 'day' of a month."""
+        key = func.substr(LocalSession.datetime, 1, 7 if level == "month" else 10)
+        query = select(key, *self._digest_columns(LocalSession, LocalSession.id)).group_by(key)
+        if month:
+            start, end = self._month_bounds(month)
+            query = query.where(LocalSession.datetime >= start.strftime("%Y-%m-%d"),
+                                LocalSession.datetime < end.strftime("%Y-%m-%d"))
+        with self.app.app_context():
+            rows = local_db.session.execute(query).all()
+        return {row[0]: tuple(int(v or 0) for v in row[1:]) for row in rows}
+
+    def _remote_digests(self, level, month=None):
+        """{bucket: digest} of the remote sessions, same buckets as _local_digests."""
+        dt = RemoteSession.datetime
+        if level == "month":
+            keys = (extract('year', dt), extract('month', dt))
+        else:
+            keys = (extract('year', dt), extract('month', dt), extract('day', dt))
+        query = (
+            select(*keys, *self._digest_columns(RemoteSession, RemoteSession.local_id))
+            .where(RemoteSession.device_id == self.device_id)
+            .group_by(*keys)
+        )
+        if month:
+            start, end = self._month_bounds(month)
+            query = query.where(dt >= start, dt < end)
+        with self.remote_app.app_context():
+            rows = remote_db.session.execute(query).all()
+        digests = {}
+        for row in rows:
+            key = "-".join(f"{int(v):02d}" for v in row[:len(keys)])
+            digests[key] = tuple(int(v or 0) for v in row[len(keys):])
+        return digests
+
+    def _day_rows(self, day):
+        """Rows of one day on both sides as {local id: comparable tuple}."""
+        start = datetime.datetime.strptime(day, "%Y-%m-%d")
+        end = start + datetime.timedelta(days=1)
+
+        def as_tuple(dt, row):
+            return (dt, row.km, row.elapsed, round(row.avg_speed or 0, 2),
+                    round(row.avg_bpm or 0, 2), row.kcal)
+
+        with self.app.app_context():
+            local_rows = LocalSession.query.filter(
+                LocalSession.datetime >= start.strftime("%Y-%m-%d"),
+                LocalSession.datetime < end.strftime("%Y-%m-%d")
+            ).all()
+            local = {r.id: as_tuple(self.parse_local_datetime(r.datetime), r) for r in local_rows}
+        with self.remote_app.app_context():
+            remote_rows = RemoteSession.query.filter(
+                RemoteSession.device_id == self.device_id,
+                RemoteSession.datetime >= start, RemoteSession.datetime < end
+            ).all()
+            remote = {r.local_id: as_tuple(r.datetime.replace(microsecond=0), r) for r in remote_rows}
+        return local, remote
+
+    def reconcile_remote(self, resync=True):
+        """
+        Find the sessions that differ between SQLite and MySQL by comparing
+        per-month, then per-day aggregate digests, and only reading the rows
+        of the days that disagree. Differing local rows are flagged
+        needs_sync again (and re-synced if resync); rows that only exist
+        remotely are reported but left alone.
+        """
+        if self.remote_app is None:
+            print("[RECONCILE] Skipped: this kiosk has no access to the remote DB (ingest service).")
+            return None
+        report = {"months": 0, "days": 0, "queries": 2, "reflagged": [], "remote_only": []}
+        local_months = self._local_digests("month")
+        remote_months = self._remote_digests("month")
+        months = sorted(m for m in set(local_months) | set(remote_months)
+                        if local_months.get(m) != remote_months.get(m))
+        report["months"] = len(months)
+
+        days = []
+        for month in months:
+            local_days = self._local_digests("day", month)
+            remote_days = self._remote_digests("day", month)
+            report["queries"] += 2
+            days += sorted(d for d in set(local_days) | set(remote_days)
+                           if local_days.get(d) != remote_days.get(d))
+        report["days"] = len(days)
+
+        reflag = []
+        missing = set()  # remote ids not on the same day locally
+        for day in days:
+            local, remote = self._day_rows(day)
+            report["queries"] += 2
+            reflag += [i for i, row in local.items() if remote.get(i) != row]
+            missing.update(i for i in remote if i not in local)
+        if missing:
+            # A row whose date changed sits on another day locally: it is
+            # already flagged from that day, not remote-only
+            with self.app.app_context():
+                moved = set(local_db.session.execute(
+                    select(LocalSession.id).where(LocalSession.id.in_(missing))
+                ).scalars().all())
+            report["queries"] += 1
+            reflag += sorted(moved - set(reflag))
+            report["remote_only"] = sorted(missing - moved)
+
+        if reflag:
+            with self.app.app_context():
+                local_db.session.execute(
+                    update(LocalSession).where(LocalSession.id.in_(reflag)).values(needs_sync=True)
+                )
+                local_db.session.commit()
+        report["reflagged"] = sorted(reflag)
+        print(f"[RECONCILE] {report['months']} months, {report['days']} days differ; "
+              f"{len(reflag)} sessions flagged for sync, {len(report['remote_only'])} only remote.")
+
+        if resync and reflag:
+            self.sync_pending_sessions()
+        return report
 
     def shutdown(self):
         """Graceful shutdown of the scheduler (if needed)."""
@@ -10,32 +10,17 @@ import subprocess
 
 # Import your TreadmillSimulate as before
 from ble_treadmill import TreadmillSimulate
+from treadmill_simulator import TreadmillSimulator, interval_workout
 
 
 # Instantiate your treadmill simulator
 treadmill = TreadmillSimulate(device_name="ORANGE-PI3-ZERO")
 
 def generate_data():
-    distance = 0.0
-    elapsed_time = 0
-    energy = 0
+    # Intervals workout, one packet per second, repeated forever
     while True:
-        # Generate some data
-        distance += 0.1
-        elapsed_time += 1
-        energy += 1
-        data = {
-            "speed_m_s": 15,
-            "distance": distance,
-            "energy": energy,
-            "bpm": 100,
-            "elapsed_s": elapsed_time
-        }
-        #def set_measures(self, speed_m_s=None, distance_m=None, energy=None, bpm=None, elapsed_s=None):
-
-        # Update the treadmill data
-        treadmill.set_measures(data)
-        time.sleep(1.0)
+        simulator = TreadmillSimulator(interval_workout(), rate_hz=1)
+        simulator.drive_peripheral(treadmill)
 
     
 def reset_bluetooth():
@@ -0,0 +1,198 @@
+# ftms_scanner.py
+# Find the treadmill without a hard-coded MAC address.
+#
+# find_treadmill() scans for advertisements carrying the Fitness Machine
+# service (UUID 0x1826) and returns as soon as one is seen: the detection
+# callback resolves a Future, so there is no fixed scan window to wait out.
+# Devices seen within `settle` seconds of the first one are ranked by RSSI
+# (the nearest treadmill wins); the cached address wins at once.
+#
+# AddressCache keeps the last treadmill connected, so the next start tries a
+# direct connect first and only scans when that fails. Set "address": "auto"
+# (or leave it out) in config.json; a replaced treadmill is found by itself.
+#
+# Usage: python ftms_scanner.py [--timeout 15] [--settle 0.5]
+#        python ftms_scanner.py --name ORANGE-PI3-ZERO   (time to discover one device
+#                                                        and what its advertisement carries)
+
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import os
+import time
+
+from treadmill_simulator import MACHINE_TREADMILL, decode_ftms_service_data
+
+logger = logging.getLogger(__name__)
+
+FTMS_SERVICE_UUID = "00001826-0000-1000-8000-00805f9b34fb"
+
+DEFAULT_CACHE = "ftms_device.json"
+
+
+class Candidate:
+    __slots__ = ("address", "name", "rssi", "seen", "machine_type")
+
+    def __init__(self, address, name, rssi, seen, machine_type=None):
+        self.address = address
+        self.name = name
+        self.rssi = rssi
+        self.seen = seen
+        self.machine_type = machine_type  # from FTMS Service Data, None if not advertised
+
+    def __repr__(self):
+        return f"Candidate({self.address}, {self.name!r}, rssi={self.rssi})"
+
+
+class AddressCache:
+    """Last treadmill connected to, in a small JSON file."""
+
+    def __init__(self, path=DEFAULT_CACHE):
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path, "r") as file:
+                return json.load(file).get("address")
+        except (OSError, ValueError):
+            return None
+
+    def save(self, address, name=None):
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as file:
+            json.dump({"address": address, "name": name,
+                       "saved": datetime.datetime.now().isoformat(timespec="seconds")}, file)
+        os.replace(tmp, self.path)
+
+
+def is_ftms(advertisement_data):
+    uuids = {u.lower() for u in advertisement_data.service_uuids}
+    uuids.update(u.lower() for u in advertisement_data.service_data)
+    return FTMS_SERVICE_UUID in uuids
+
+
+def machine_type(advertisement_data):
+    """Fitness Machine Type bits of the FTMS Service Data, or None if absent."""
+    data = advertisement_data.service_data.get(FTMS_SERVICE_UUID)
+    decoded = decode_ftms_service_data(data) if data else None
+    return decoded[1] if decoded else None
+
+
+async def find_treadmill(timeout=15.0, settle=0.5, preferred=None, exclude_names=(), scanner_cls=None):
+    """
+    Scan until an FTMS device advertises, then keep listening `settle`
+    seconds and return the Candidate with the strongest RSSI (`preferred`,
+    e.g. the cached address, is returned as soon as it is seen). Devices
+    named in exclude_names (other kiosks advertising their emulated
+    treadmill) are ignored. Returns None after `timeout` seconds.
+    """
+    if scanner_cls is None:
+        from bleak import BleakScanner
+        scanner_cls = BleakScanner
+
+    loop = asyncio.get_running_loop()
+    first_seen = loop.create_future()
+    preferred_seen = loop.create_future()
+    candidates = {}
+    preferred = preferred.upper() if preferred else None
+
+    def detection_callback(device, advertisement_data):
+        if not is_ftms(advertisement_data):
+            return
+        name = advertisement_data.local_name or device.name
+        if name in exclude_names:
+            return
+        kind = machine_type(advertisement_data)
+        if kind is not None and not kind & MACHINE_TREADMILL:
+            return  # a bike or rower advertising FTMS
+        address = device.address.upper()
+        candidates[address] = Candidate(address, name, advertisement_data.rssi, time.monotonic(), kind)
+        if not first_seen.done():
+            first_seen.set_result(address)
+        if address == preferred and not preferred_seen.done():
+            preferred_seen.set_result(address)
+
+    # service_uuids lets the backend filter in the controller where it can
+    scanner = scanner_cls(detection_callback=detection_callback, service_uuids=[FTMS_SERVICE_UUID])
+    start = time.monotonic()
+    await scanner.start()
+    try:
+        try:
+            await asyncio.wait_for(asyncio.shield(first_seen), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("No FTMS treadmill found in %.1f s", timeout)
+            return None
+        if settle > 0 and not preferred_seen.done():
+            await asyncio.wait([preferred_seen], timeout=settle)
+    finally:
+        await scanner.stop()
+
+    if preferred_seen.done():
+        best = candidates[preferred]
+    else:
+        best = max(candidates.values(), key=lambda c: c.rssi if c.rssi is not None else -999)
+    logger.info("Treadmill %s (%s, RSSI %s) found in %.2f s among %d candidate(s)",
+                best.address, best.name, best.rssi, time.monotonic() - start, len(candidates))
+    return best
+
+
+async def time_to_discovery(name, timeout=30.0, scanner_cls=None):
+    """
+    (seconds, AdvertisementData) until a device named `name` is first seen
+    with its advertising and scan response data, or None after timeout.
+    """
+    if scanner_cls is None:
+        from bleak import BleakScanner
+        scanner_cls = BleakScanner
+
+    seen = asyncio.get_running_loop().create_future()
+
+    def detection_callback(device, advertisement_data):
+        if (advertisement_data.local_name or device.name) == name and not seen.done():
+            seen.set_result(advertisement_data)
+
+    scanner = scanner_cls(detection_callback=detection_callback)
+    start = time.monotonic()
+    await scanner.start()
+    try:
+        advertisement_data = await asyncio.wait_for(seen, timeout)
+    except asyncio.TimeoutError:
+        return None
+    finally:
+        await scanner.stop()
+    return time.monotonic() - start, advertisement_data
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Find FTMS treadmills nearby.")
+    parser.add_argument("--timeout", type=float, default=15.0)
+    parser.add_argument("--settle", type=float, default=0.5, help="seconds to rank after the first one")
+    parser.add_argument("--cache", default=DEFAULT_CACHE, help="save the address found here")
+    parser.add_argument("--name", help="only time the discovery of this device")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    if args.name:
+        found = asyncio.run(time_to_discovery(args.name, timeout=args.timeout))
+        if found is None:
+            print(f"{args.name} not seen in {args.timeout:.0f} s")
+            return 1
+        elapsed, advertisement_data = found
+        print(f"{args.name} seen after {elapsed * 1000:.0f} ms, RSSI {advertisement_data.rssi}")
+        print(f"  service UUIDs: {', '.join(advertisement_data.service_uuids) or '-'}")
+        print(f"  FTMS machine type: {machine_type(advertisement_data)}")
+        print(f"  classified without connecting: {is_ftms(advertisement_data)}")
+        return 0
+    best = asyncio.run(find_treadmill(timeout=args.timeout, settle=args.settle))
+    if best is None:
+        return 1
+    print(f"Address: {best.address}, Name: {best.name}, RSSI: {best.rssi}")
+    if args.cache:
+        AddressCache(args.cache).save(best.address, best.name)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,169 @@
+# health.py
+# Liveness of the kiosk's loops and the systemd watchdog.
+#
+# Every loop ticks a Heartbeat from inside itself (an asyncio callback on the
+# bleak loop, a GLib timeout on the GATT server loop, a scheduler job), so a
+# loop that is wedged, and not just its thread, is noticed. Threads that have
+# no loop of their own to tick from (Flask) are watched with is_alive().
+#
+# /healthz returns HeartbeatRegistry.status(). The Watchdog thread pings
+# systemd (sd_notify WATCHDOG=1) only while every component is healthy: with
+# WatchdogSec= in the unit, systemd restarts the app within seconds of a
+# wedge instead of the kiosk serving stale data forever.
+
+import logging
+import os
+import socket
+import threading
+import time
+
+from metrics import gauge
+
+logger = logging.getLogger(__name__)
+
+HEARTBEAT_LAG = gauge("heartbeat_lag_seconds", "Seconds since the last heartbeat of a component",
+                      ("component",))
+HEALTHY = gauge("healthy", "1 while every component is healthy")
+
+
+class Heartbeat:
+    """Last tick of one component, stale after max_lag seconds."""
+
+    __slots__ = ("name", "max_lag", "last")
+
+    def __init__(self, name, max_lag):
+        self.name = name
+        self.max_lag = max_lag
+        self.last = None  # no tick yet
+
+    def beat(self):
+        self.last = time.monotonic()
+
+    def lag(self, now=None):
+        if self.last is None:
+            return None
+        return (now if now is not None else time.monotonic()) - self.last
+
+
+class HeartbeatRegistry:
+    """
+    Heartbeats and watched threads of the app. A component that has not
+    ticked yet is healthy for `startup_grace` seconds after registration.
+    """
+
+    def __init__(self, startup_grace=30.0):
+        self.startup_grace = startup_grace
+        self.started = time.monotonic()
+        self.heartbeats = {}
+        self.threads = {}
+        self.lock = threading.Lock()
+        HEALTHY.set_function(self.healthy)
+
+    def register(self, name, max_lag):
+        with self.lock:
+            heartbeat = self.heartbeats.get(name)
+            if heartbeat is None:
+                heartbeat = self.heartbeats[name] = Heartbeat(name, max_lag)
+                HEARTBEAT_LAG.labels(component=name).set_function(
+                    lambda: heartbeat.lag() if heartbeat.last is not None else time.monotonic() - self.started)
+        return heartbeat
+
+    def watch_thread(self, name, thread):
+        with self.lock:
+            self.threads[name] = thread
+
+    def components(self, now=None):
+        """{name: {"healthy": bool, ...}} for every heartbeat and watched thread."""
+        now = now if now is not None else time.monotonic()
+        result = {}
+        with self.lock:
+            heartbeats = list(self.heartbeats.values())
+            threads = list(self.threads.items())
+        for heartbeat in heartbeats:
+            lag = heartbeat.lag(now)
+            if lag is None:
+                healthy = now - self.started < self.startup_grace
+            else:
+                healthy = lag <= heartbeat.max_lag
+            result[heartbeat.name] = {
+                "healthy": healthy,
+                "lag_s": round(lag, 3) if lag is not None else None,
+                "max_lag_s": heartbeat.max_lag,
+            }
+        for name, thread in threads:
+            result[name] = {"healthy": thread.is_alive(), "alive": thread.is_alive()}
+        return result
+
+    def unhealthy(self, now=None):
+        return [name for name, c in self.components(now).items() if not c["healthy"]]
+
+    def healthy(self, now=None):
+        return not self.unhealthy(now)
+
+
+def tick_asyncio(loop, heartbeat, interval=1.0):
+    """Beat from a callback of loop every interval (safe to call from any thread)."""
+    def tick():
+        heartbeat.beat()
+        loop.call_later(interval, tick)
+    loop.call_soon_threadsafe(tick)
+
+
+def sd_notify(state):
+    """
+    Send a state ("READY=1", "WATCHDOG=1"...) to systemd. Returns False when
+    not started by systemd (no NOTIFY_SOCKET) or the socket is unreachable.
+    """
+    address = os.environ.get("NOTIFY_SOCKET")
+    if not address:
+        return False
+    if address.startswith("@"):  # abstract namespace
+        address = "\0" + address[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM | socket.SOCK_CLOEXEC) as sock:
+            sock.connect(address)
+            sock.sendall(state.encode())
+        return True
+    except OSError as e:
+        logger.warning("sd_notify(%s) failed: %s", state, e)
+        return False
+
+
+def watchdog_interval():
+    """Half of WatchdogSec= (WATCHDOG_USEC), or None if the watchdog is off."""
+    usec = os.environ.get("WATCHDOG_USEC")
+    pid = os.environ.get("WATCHDOG_PID")
+    if not usec or (pid and int(pid) != os.getpid()):
+        return None
+    return int(usec) / 2e6
+
+
+class Watchdog:
+    """Pings the systemd watchdog while registry reports every component healthy."""
+
+    def __init__(self, registry, interval=None):
+        self.registry = registry
+        self.interval = interval or watchdog_interval()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        sd_notify("READY=1")
+        if self.interval is None:
+            logger.info("systemd watchdog not enabled (no WATCHDOG_USEC)")
+            return
+        self.thread = threading.Thread(target=self._run, name="watchdog", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            unhealthy = self.registry.unhealthy()
+            if unhealthy:
+                # No ping: systemd restarts the app when WatchdogSec= runs out
+                logger.error("Unhealthy: %s, watchdog not pinged", ", ".join(unhealthy))
+                continue
+            sd_notify("WATCHDOG=1")
+
+    def stop(self):
+        self.stop_event.set()
+        sd_notify("STOPPING=1")
@@ -0,0 +1,159 @@
+# ingest_server.py
+# Central telemetry ingest service.
+#
+# Kiosks POST batches of frames (gzip-compressed NDJSON, one JSON object per
+# line with "type": "session" or "sample") to /ingest instead of holding a
+# MySQL connection each. Every request is bulk-loaded into the central store
+# with one upsert per table, keyed on (device_id, uid) for sessions and
+# (device_id, local_id) for samples, so retried batches are harmless.
+#
+# A batch is at most --max-batch-mb, compressed and once decompressed (the
+# gzip stream is inflated in bounded steps, never all at once): larger ones
+# get 413. Malformed batches get 400 and store failures 500, so the kiosk
+# keeps the frames and retries; all three are counted in /stats "errors".
+#
+# Usage: python ingest_server.py --db mysql+mysqlconnector://... [--port 8080] [--token secret]
+# Kiosk side: "Ingest": {"url": "http://<server>:8080/ingest", "token": "secret"}
+# in the "Database" section of config.json.
+
+import argparse
+import datetime
+import json
+import logging
+import threading
+import time
+import zlib
+
+from flask import Flask, jsonify, request
+
+from db_management import (
+    REMOTE_SAMPLE_FIELDS,
+    REMOTE_SESSION_FIELDS,
+    RemoteSample,
+    RemoteSession,
+    RemoteURIConfig,
+    remote_db,
+    upsert_remote,
+)
+
+SESSION_KEYS = ("device_id", "uid") + REMOTE_SESSION_FIELDS
+SAMPLE_KEYS = ("device_id", "local_id") + REMOTE_SAMPLE_FIELDS
+MAX_BATCH_BYTES = 16 * 1024 * 1024  # default limit of a request body, compressed or not
+
+logger = logging.getLogger(__name__)
+
+
+class BatchTooLarge(Exception):
+    pass
+
+
+def gunzip(body, max_size):
+    """Decompress a gzip body, raising BatchTooLarge past max_size bytes."""
+    inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)  # gzip header and trailer
+    data = inflater.decompress(body, max_size + 1)
+    if len(data) > max_size:
+        raise BatchTooLarge(f"more than {max_size} bytes once decompressed")
+    if not inflater.eof:
+        raise ValueError("truncated gzip stream")
+    return data
+
+
+def parse_frames(body):
+    """Split an NDJSON body into session rows and sample rows."""
+    sessions = []
+    samples = []
+    for line in body.splitlines():
+        if not line.strip():
+            continue
+        frame = json.loads(line)
+        if not isinstance(frame, dict):
+            raise ValueError("frame is not a JSON object")
+        kind = frame.get("type")
+        if kind == "session":
+            row = {key: frame[key] for key in SESSION_KEYS}
+            row["datetime"] = datetime.datetime.strptime(row["datetime"], "%Y-%m-%d %H:%M:%S")
+            sessions.append(row)
+        elif kind == "sample":
+            samples.append({key: frame[key] for key in SAMPLE_KEYS})
+        else:
+            raise ValueError(f"unknown frame type: {kind}")
+    return sessions, samples
+
+
+def create_app(db_uri, token=None, max_batch_bytes=MAX_BATCH_BYTES):
+    """Flask app bound to the central store at db_uri (tables are created if missing)."""
+    app = Flask(__name__)
+    app.config.from_object(RemoteURIConfig(db_uri))
+    app.config["MAX_CONTENT_LENGTH"] = max_batch_bytes
+    remote_db.init_app(app)
+    with app.app_context():
+        remote_db.create_all()
+
+    stats = {"requests": 0, "sessions": 0, "samples": 0, "errors": 0, "started": time.time()}
+    stats_lock = threading.Lock()
+
+    def error(message, status):
+        with stats_lock:
+            stats["errors"] += 1
+        return jsonify({"error": message}), status
+
+    @app.errorhandler(413)
+    def too_large(e):
+        # Compressed body over MAX_CONTENT_LENGTH, refused by werkzeug
+        return error(f"batch too large: more than {max_batch_bytes} bytes", 413)
+
+    @app.route('/ingest', methods=['POST'])
+    def ingest():
+        if token and request.headers.get("Authorization") != f"Bearer {token}":
+            return jsonify({"error": "unauthorized"}), 401
+        body = request.get_data()
+        try:
+            if request.headers.get("Content-Encoding") == "gzip":
+                body = gunzip(body, max_batch_bytes)
+            sessions, samples = parse_frames(body.decode("utf-8"))
+        except BatchTooLarge as e:
+            return error(f"batch too large: {e}", 413)
+        except (zlib.error, ValueError, KeyError, TypeError) as e:
+            return error(f"bad batch: {e}", 400)
+
+        try:
+            if sessions:
+                upsert_remote(RemoteSession, sessions, ("device_id", "uid"), REMOTE_SESSION_FIELDS)
+            if samples:
+                # Samples never change once recorded: duplicates are ignored
+                upsert_remote(RemoteSample, samples, ("device_id", "local_id"))
+        except Exception as e:
+            remote_db.session.rollback()
+            logger.error("Error storing a batch: %s", e)
+            return error("store failed", 500)
+
+        with stats_lock:
+            stats["requests"] += 1
+            stats["sessions"] += len(sessions)
+            stats["samples"] += len(samples)
+        return jsonify({"sessions": len(sessions), "samples": len(samples)})
+
+    @app.route('/stats', methods=['GET'])
+    def get_stats():
+        uptime = time.time() - stats["started"]
+        return jsonify(dict(stats, uptime=uptime))
+
+    return app
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Treadmill telemetry ingest service.")
+    parser.add_argument("--db", required=True, help="SQLAlchemy URI of the central store")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--token", help="required bearer token")
+    parser.add_argument("--max-batch-mb", type=float, default=MAX_BATCH_BYTES / 1024 / 1024,
+                        help="largest request body, compressed or not")
+    args = parser.parse_args(argv)
+
+    app = create_app(args.db, token=args.token, max_batch_bytes=int(args.max_batch_mb * 1024 * 1024))
+    app.run(host=args.host, port=args.port, threaded=True, debug=False)
+
+
+if __name__ == "__main__":
+    main()
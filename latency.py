@@ -0,0 +1,110 @@
+# latency.py
+# End-to-end latency of the treadmill data, hop by hop.
+#
+# BLEConnection.notification_handler stamps every packet with time.monotonic()
+# when it arrives; each consumer records how old that stamp is when the data
+# leaves through it:
+#
+#   decode       packet decoded and handed to the GATT server
+#   rebroadcast  PropertiesChanged emitted by TreadmillDataCharacteristic
+#   http         /api/treadmill_data response (age of the data served)
+#   db           sample written to the local DB by flush_samples
+#
+# /api/latency returns LatencyTracker.snapshot(): percentiles over the last
+# `window` records of each hop and a cumulative histogram.
+
+import bisect
+import collections
+import threading
+import time
+
+HOPS = ("decode", "rebroadcast", "http", "db")
+
+# Upper bounds of the histogram buckets (ms); the last bucket is open-ended
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, 60000)
+
+
+class LatencyTracker:
+    """
+    Thread-safe per-hop latency recorder with bounded memory.
+    """
+
+    def __init__(self, window=1000):
+        self.window = window
+        self.lock = threading.Lock()
+        self.hops = {}
+
+    def _hop(self, hop):
+        entry = self.hops.get(hop)
+        if entry is None:
+            entry = {
+                "recent": collections.deque(maxlen=self.window),
+                "buckets": [0] * (len(BUCKETS_MS) + 1),
+                "count": 0,
+                "max": 0.0,
+            }
+            self.hops[hop] = entry
+        return entry
+
+    def record(self, hop, rx_time, now=None):
+        """Record the age of a packet received at rx_time (time.monotonic())."""
+        if now is None:
+            now = time.monotonic()
+        ms = (now - rx_time) * 1000
+        with self.lock:
+            entry = self._hop(hop)
+            entry["recent"].append(ms)
+            entry["buckets"][bisect.bisect_left(BUCKETS_MS, ms)] += 1
+            entry["count"] += 1
+            entry["max"] = max(entry["max"], ms)
+
+    def record_many(self, hop, rx_times, now=None):
+        if now is None:
+            now = time.monotonic()
+        for rx_time in rx_times:
+            self.record(hop, rx_time, now)
+
+    @staticmethod
+    def _percentile(ordered, q):
+        return ordered[min(int(len(ordered) * q), len(ordered) - 1)]
+
+    def percentiles(self, hop):
+        """p50/p90/p95/p99/max in ms over the recent window, or None if empty."""
+        with self.lock:
+            entry = self.hops.get(hop)
+            recent = sorted(entry["recent"]) if entry else []
+        if not recent:
+            return None
+        return {
+            "p50": self._percentile(recent, 0.50),
+            "p90": self._percentile(recent, 0.90),
+            "p95": self._percentile(recent, 0.95),
+            "p99": self._percentile(recent, 0.99),
+            "max": recent[-1],
+        }
+
+    def snapshot(self):
+        """JSON-ready summary of every hop seen so far."""
+        result = {}
+        with self.lock:
+            names = [h for h in HOPS if h in self.hops] + sorted(set(self.hops) - set(HOPS))
+        for hop in names:
+            stats = self.percentiles(hop)
+            with self.lock:
+                entry = self.hops[hop]
+                labels = [f"<={b}" for b in BUCKETS_MS] + [f">{BUCKETS_MS[-1]}"]
+                histogram = dict(zip(labels, entry["buckets"]))
+                count, worst = entry["count"], entry["max"]
+            result[hop] = {
+                "count": count,
+                "window": stats,
+                "max_ever": round(worst, 3),
+                "histogram_ms": histogram,
+            }
+            if stats:
+                result[hop]["window"] = {k: round(v, 3) for k, v in stats.items()}
+        return result
+
+    def reset(self):
+        with self.lock:
+            self.hops.clear()
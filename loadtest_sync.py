@@ -0,0 +1,140 @@
+# loadtest_sync.py
+# Load test of the multi-kiosk sync: several simulated devices (one process
+# each, with its own local SQLite file) save sessions and push them at the
+# same time into one shared stand-in for the remote MySQL DB.
+#
+# Usage: python loadtest_sync.py [--devices 4] [--sessions 200] [--dir loadtest]
+#
+# Checks that every session arrives exactly once, keyed by (device_id, uid),
+# that re-pushing everything is idempotent, and prints the throughput.
+
+import argparse
+import multiprocessing
+import os
+import queue
+import sys
+import time
+from contextlib import redirect_stdout
+
+
+def run_device(device_id, sessions, workdir, remote_uri, results):
+    # Imported here so that each process builds its own engines
+    from db_management import DBManagement, LocalSession, local_db
+
+    config = {
+        "localfile": os.path.abspath(os.path.join(workdir, f"{device_id}.db")),
+        "remote_uri": remote_uri,
+        "device_id": device_id,
+        "Mysql": {},
+    }
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        db_manager = DBManagement(config)
+        start = time.perf_counter()
+        for i in range(sessions):
+            db_manager.save_local_session({
+                "datetime": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "km": 1000 * (i % 10 + 1),
+                "elapsed": 360 * (i % 10 + 1),
+                "avg_speed": 10.0,
+                "avg_bpm": 130.0,
+                "kcal": 60 * (i % 10 + 1),
+                "run_id": None,
+            })
+        saved = time.perf_counter() - start
+
+        # Push everything again: must update in place, not duplicate
+        with db_manager.app.app_context():
+            local_db.session.query(LocalSession).update({"needs_sync": True})
+            local_db.session.commit()
+        start = time.perf_counter()
+        db_manager.sync_pending_sessions()
+        resynced = time.perf_counter() - start
+
+        with db_manager.app.app_context():
+            pending = LocalSession.query.filter_by(needs_sync=True).count()
+        db_manager.shutdown()
+    results.put((device_id, sessions, saved, resynced, pending))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Multi-kiosk sync load test.")
+    parser.add_argument("--devices", type=int, default=4)
+    parser.add_argument("--sessions", type=int, default=200, help="sessions per device")
+    parser.add_argument("--dir", default="loadtest")
+    parser.add_argument("--timeout", type=float, default=300.0,
+                        help="seconds to wait for each device before failing")
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.dir, exist_ok=True)
+    for name in os.listdir(args.dir):
+        if name.endswith(".db"):
+            os.remove(os.path.join(args.dir, name))
+    remote_file = os.path.abspath(os.path.join(args.dir, "remote.db"))
+    remote_uri = f"sqlite:///{remote_file}"
+
+    # Create the stand-in schema once, before the devices race for it
+    from sqlalchemy import create_engine
+    from db_management import remote_db
+    engine = create_engine(remote_uri)
+    remote_db.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.exec_driver_sql("PRAGMA journal_mode=WAL")
+
+    results = multiprocessing.Queue()
+    devices = [f"kiosk-{n:02d}" for n in range(args.devices)]
+    processes = [
+        multiprocessing.Process(target=run_device,
+                                args=(device, args.sessions, args.dir, remote_uri, results))
+        for device in devices
+    ]
+    start = time.perf_counter()
+    for p in processes:
+        p.start()
+    reports = []
+    deadline = time.monotonic() + args.timeout
+    while len(reports) < len(processes):
+        try:
+            reports.append(results.get(timeout=1.0))
+        except queue.Empty:
+            # A device that crashed never reports: fail instead of waiting forever
+            if time.monotonic() > deadline or any(
+                    p.exitcode not in (None, 0) for p in processes):
+                break
+    for p in processes:
+        p.join(timeout=max(deadline - time.monotonic(), 1.0))
+        if p.is_alive():
+            p.terminate()
+            p.join()
+    wall = time.perf_counter() - start
+
+    failed = [f"{device} (exit code {p.exitcode})" for device, p in zip(devices, processes)
+              if p.exitcode != 0]
+    if failed or len(reports) < len(processes):
+        print(f"Devices failed: {', '.join(failed) or 'timed out'}")
+        print("FAILED")
+        return 1
+
+    for device_id, sessions, saved, resynced, pending in sorted(reports):
+        print(f"{device_id}: {sessions} sessions saved+synced in {saved:.2f}s "
+              f"({sessions / saved:.0f}/s), full re-push {resynced:.2f}s, pending {pending}")
+
+    with engine.connect() as conn:
+        total = conn.exec_driver_sql("SELECT COUNT(*) FROM sessions").scalar()
+        per_device = dict(conn.exec_driver_sql(
+            "SELECT device_id, COUNT(*) FROM sessions GROUP BY device_id").all())
+        duplicates = conn.exec_driver_sql(
+            "SELECT COUNT(*) FROM (SELECT device_id, local_id FROM sessions "
+            "GROUP BY device_id, local_id HAVING COUNT(*) > 1)").scalar()
+
+    expected = args.devices * args.sessions
+    print(f"Remote rows: {total} (expected {expected}), duplicates: {duplicates}, "
+          f"wall time {wall:.2f}s, {total / wall:.0f} sessions/s overall")
+    ok = (total == expected and duplicates == 0
+          and all(per_device.get(d) == args.sessions for d in devices)
+          and all(r[4] == 0 for r in reports))
+    print("OK" if ok else "FAILED")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,123 @@
+# logging_setup.py
+# Logging for the kiosk: the BLE, GLib and Flask threads only put records
+# on a queue; one listener thread formats them and does the I/O (stderr,
+# i.e. journald, and optionally a file), so a slow SD card never stalls a
+# notification.
+#
+# Config ("Logging" section of config.json, all optional):
+#   "level": "INFO"             root level
+#   "trace_packets": false      DEBUG trace of every packet received and sent
+#                               (logger "treadmill.packets")
+#   "rate_limit_seconds": 10    same message logged at most once per interval
+#                               (not the packet trace: one line per packet)
+#   "file": null                also write to this file
+#
+# Log with %-style arguments (logger.warning("Bad packet %s", data)), not
+# f-strings: the message template is the rate-limit key, and formatting is
+# left to the listener thread.
+
+import atexit
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+PACKET_LOGGER = "treadmill.packets"
+
+FORMAT = "%(asctime)s %(levelname)-7s %(threadName)s %(name)s: %(message)s"
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Let the same message (logger, level and template) through at most once
+    every `interval` seconds. The next record that passes carries the
+    number of copies suppressed in between. Records of the `exempt`
+    loggers (and their children) always pass.
+    """
+
+    def __init__(self, interval=10.0, exempt=()):
+        super().__init__()
+        self.interval = interval
+        self.exempt = tuple(exempt)
+        self.lock = threading.Lock()
+        self.last = {}        # key -> time of the last record let through
+        self.suppressed = {}  # key -> copies dropped since then
+
+    def filter(self, record):
+        if self.interval <= 0:
+            return True
+        name = record.name
+        if any(name == e or name.startswith(e + ".") for e in self.exempt):
+            return True
+        key = (record.name, record.levelno, record.msg)
+        now = time.monotonic()
+        with self.lock:
+            last = self.last.get(key)
+            if last is not None and now - last < self.interval:
+                self.suppressed[key] = self.suppressed.get(key, 0) + 1
+                return False
+            self.last[key] = now
+            suppressed = self.suppressed.pop(key, 0)
+            if len(self.last) > 1000:  # templates are few; drop stale keys if not
+                self.last = {k: t for k, t in self.last.items() if now - t < self.interval}
+        if suppressed:
+            record.msg = f"{record.msg} ({suppressed} similar messages suppressed)"
+        return True
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that leaves the formatting to the listener thread (the
+    stock one formats in the caller). Records are handed over as they are,
+    so arguments must not be mutated after the call.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class _QueueListener(logging.handlers.QueueListener):
+    """QueueListener that can be stopped more than once (explicitly and at exit)."""
+
+    def stop(self):
+        if self._thread is not None:
+            super().stop()
+
+
+def setup_logging(settings=None):
+    """
+    Route all logging through a queue and start the listener thread.
+    Returns the QueueListener (stopped at exit).
+    """
+    settings = settings or {}
+    level = getattr(logging, str(settings.get("level", "INFO")).upper(), logging.INFO)
+
+    formatter = logging.Formatter(FORMAT)
+    handlers = [logging.StreamHandler()]
+    if settings.get("file"):
+        handlers.append(logging.handlers.WatchedFileHandler(settings["file"]))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = _QueueHandler(log_queue)
+    queue_handler.addFilter(RateLimitFilter(settings.get("rate_limit_seconds", 10),
+                                            exempt=(PACKET_LOGGER,)))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    # Packet trace only on request, whatever the root level
+    trace = settings.get("trace_packets", False)
+    logging.getLogger(PACKET_LOGGER).setLevel(logging.DEBUG if trace else logging.INFO)
+    logging.getLogger("werkzeug").setLevel(max(level, logging.WARNING))  # no line per poll
+    logging.getLogger("apscheduler").setLevel(max(level, logging.WARNING))  # no line per job run
+
+    listener = _QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
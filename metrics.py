@@ -0,0 +1,260 @@
+# metrics.py
+# Minimal metrics registry with Prometheus text output (served at /metrics).
+#
+# Counters, gauges and histograms are plain Python objects: an update is an
+# attribute increment (histograms add a bisect), with no lock and no
+# formatting, so they can sit in the BLE and GLib callbacks. Everything is
+# rendered only when /metrics is scraped.
+#
+#   from metrics import counter, histogram
+#   PACKETS = counter("ble_notifications_total", "Treadmill Data notifications received")
+#   PACKETS.inc()
+#   DECODE = histogram("ble_decode_seconds", "Time to decode a notification")
+#   DECODE.observe(0.0002)
+#   ROUTE = histogram("http_request_duration_seconds", "...", labelnames=("route",))
+#   ROUTE.labels(route="/api/treadmill_data").observe(0.003)
+#
+# Labeled children are created on first use and kept: use labels with a
+# small fixed set of values (route names, thread names), never ids.
+
+import bisect
+import math
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if value == -math.inf:
+        return "-Inf"
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        (k, str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+        for k, v in labels
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+class _CounterValue:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, name, labels):
+        return [(name, labels, self.value)]
+
+
+class _GaugeValue:
+    __slots__ = ("value", "function")
+
+    def __init__(self):
+        self.value = 0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set_function(self, function):
+        """Read the value from function() at scrape time instead."""
+        self.function = function
+
+    def samples(self, name, labels):
+        if self.function is None:
+            return [(name, labels, self.value)]
+        try:
+            return [(name, labels, self.function())]
+        except Exception:
+            return []  # e.g. DB unreachable: no sample rather than a failed scrape
+
+
+class _HistogramValue:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self):
+        """Context manager observing the duration of the block."""
+        return _Timer(self)
+
+    def samples(self, name, labels):
+        result = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            result.append((f"{name}_bucket", labels + (("le", _format_value(bound)),), cumulative))
+        result.append((f"{name}_bucket", labels + (("le", "+Inf"),), self.count))
+        result.append((f"{name}_sum", labels, self.sum))
+        result.append((f"{name}_count", labels, self.count))
+        return result
+
+
+class _Timer:
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+
+class Metric:
+    """
+    A named metric, optionally with labels. Without labels the metric is
+    updated directly (inc / set / observe); with labels through
+    .labels(name=value, ...).
+    """
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.children = {}
+        self.lock = threading.Lock()
+        if not self.labelnames:
+            self._value = self._new_value()
+            self.children[()] = self._value
+
+    def _new_value(self):
+        if self.kind == "counter":
+            return _CounterValue()
+        if self.kind == "gauge":
+            return _GaugeValue()
+        return _HistogramValue(self.buckets)
+
+    def labels(self, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        child = self.children.get(key)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(key, self._new_value())
+        return child
+
+    # Unlabeled shortcuts
+    def inc(self, amount=1):
+        self._value.inc(amount)
+
+    def dec(self, amount=1):
+        self._value.dec(amount)
+
+    def set(self, value):
+        self._value.set(value)
+
+    def set_function(self, function):
+        self._value.set_function(function)
+
+    def observe(self, value):
+        self._value.observe(value)
+
+    def time(self):
+        return self._value.time()
+
+    @property
+    def value(self):
+        return self._value.value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for key, child in list(self.children.items()):
+            labels = tuple(zip(self.labelnames, key))
+            for name, sample_labels, value in child.samples(self.name, labels):
+                lines.append(f"{name}{_format_labels(sample_labels)} {_format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, cls, name, documentation, labelnames=(), **kwargs):
+        """Create the metric, or return the one already registered under name."""
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = cls(name, documentation, labelnames, **kwargs)
+                self.metrics[name] = metric
+            elif not isinstance(metric, cls) or metric.labelnames != tuple(labelnames):
+                raise ValueError(f"Metric {name} already registered with another type or labels")
+            return metric
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format (0.0.4)."""
+        lines = []
+        with self.lock:
+            metrics = list(self.metrics.values())
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def counter(name, documentation, labelnames=()):
+    return REGISTRY.register(Counter, name, documentation, labelnames)
+
+
+def gauge(name, documentation, labelnames=()):
+    return REGISTRY.register(Gauge, name, documentation, labelnames)
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram, name, documentation, labelnames, buckets=buckets)
+
+
+PROCESS_START = gauge("process_start_time_seconds", "Start time of the process since the epoch")
+PROCESS_START.set(time.time())
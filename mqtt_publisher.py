@@ -0,0 +1,160 @@
+# mqtt_publisher.py
+# One long-lived MQTT connection for the whole app.
+#
+# The paho network loop runs in its own thread (loop_start) and reconnects
+# by itself; messages published while the broker is unreachable wait in a
+# bounded in-memory queue and are sent on reconnect. A telemetry thread
+# publishes the live treadmill values at a fixed rate (QoS 0), so Home
+# Assistant can follow the run without polling Flask.
+
+import collections
+import json
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+
+class MQTTPublisher:
+    """
+    Persistent MQTT client with offline queue and live telemetry.
+    """
+
+    def __init__(self, server, port=1883, client_id="", keepalive=60, queue_size=1000, client=None):
+        self.server = server
+        self.port = port
+        self.keepalive = keepalive
+        self.connected = threading.Event()
+        self.queue = collections.deque(maxlen=queue_size)  # oldest messages dropped first
+        self.queue_lock = threading.Lock()
+        self.telemetry_thread = None
+        self.telemetry_stop = threading.Event()
+        self.published = 0
+        self.dropped = 0
+
+        if client is None:
+            if hasattr(mqtt, "CallbackAPIVersion"):  # paho-mqtt >= 2.0
+                client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=client_id)
+            else:
+                client = mqtt.Client(client_id=client_id)
+        self.client = client
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+        self.client.reconnect_delay_set(min_delay=1, max_delay=60)
+
+    # -------------------------
+    # Connection
+    # -------------------------
+    def start(self):
+        """Connect in the background; the paho thread keeps reconnecting."""
+        self.client.connect_async(self.server, self.port, self.keepalive)
+        self.client.loop_start()
+        print(f"[MQTT] Connecting to {self.server}:{self.port} in background...")
+
+    def stop(self):
+        self.stop_telemetry()
+        self.client.disconnect()
+        self.client.loop_stop()
+        self.connected.clear()
+        print("[MQTT] Disconnected.")
+
+    def _on_connect(self, client, userdata, flags, reason_code, *args):
+        # paho 1.x passes rc as an int, 2.x a ReasonCode; both compare to 0 on success
+        if reason_code != 0:
+            print(f"[MQTT] Connection refused: {reason_code}")
+            return
+        self.connected.set()
+        print(f"[MQTT] Connected to {self.server}:{self.port}.")
+        self._flush_queue()
+
+    def _on_disconnect(self, client, userdata, *args):
+        self.connected.clear()
+        print("[MQTT] Connection lost, reconnecting...")
+
+    # -------------------------
+    # Publishing
+    # -------------------------
+    def _flush_queue(self):
+        while self.connected.is_set():
+            with self.queue_lock:
+                if not self.queue:
+                    return
+                topic, payload, qos, retain = self.queue.popleft()
+            self.client.publish(topic, payload, qos=qos, retain=retain)
+            self.published += 1
+
+    def publish(self, topic, payload, qos=0, retain=False, queue=True):
+        """
+        Publish now if connected, else keep the message for the reconnect
+        (unless queue is False: then it is dropped). Returns the paho
+        MQTTMessageInfo, or None if the message was queued or dropped.
+        """
+        if self.connected.is_set():
+            self.published += 1
+            return self.client.publish(topic, payload, qos=qos, retain=retain)
+        if queue:
+            with self.queue_lock:
+                self.queue.append((topic, payload, qos, retain))
+        else:
+            self.dropped += 1
+        return None
+
+    def publish_and_wait(self, topic, payload, qos=1, timeout=3.0):
+        """
+        Publish and wait up to timeout seconds for the broker to take the
+        message. Returns True on success (used before a shutdown, when a
+        queued message would be lost).
+        """
+        if not self.connected.wait(timeout):
+            return False
+        info = self.client.publish(topic, payload, qos=qos)
+        try:
+            info.wait_for_publish(timeout)
+        except (RuntimeError, ValueError):
+            return False
+        return info.is_published()
+
+    # -------------------------
+    # Live telemetry
+    # -------------------------
+    @staticmethod
+    def telemetry_payload(data_stream):
+        """Compact JSON of the live values (no lap history, no limits)."""
+        return json.dumps({
+            "speed": data_stream["speed"],
+            "pace": data_stream["pace"],
+            "distance": data_stream["distance"],
+            "bpm": data_stream["bpm"],
+            "time": data_stream["running_time"],
+            "kcal": data_stream["energy"],
+        }, separators=(",", ":"))
+
+    def start_telemetry(self, data_stream, topic, rate_hz=1.0):
+        """
+        Publish data_stream to topic rate_hz times per second (QoS 0).
+        Samples are not queued while offline: stale live data is useless.
+        """
+        if self.telemetry_thread and self.telemetry_thread.is_alive():
+            return
+        period = 1.0 / rate_hz
+        self.telemetry_stop.clear()
+
+        def run():
+            next_time = time.monotonic()
+            while not self.telemetry_stop.is_set():
+                self.publish(topic, self.telemetry_payload(data_stream), qos=0, queue=False)
+                next_time += period
+                delay = next_time - time.monotonic()
+                if delay < 0:  # fell behind: skip instead of bursting
+                    next_time = time.monotonic()
+                    delay = 0
+                self.telemetry_stop.wait(delay)
+
+        self.telemetry_thread = threading.Thread(target=run, name="mqtt-telemetry", daemon=True)
+        self.telemetry_thread.start()
+        print(f"[MQTT] Publishing telemetry to '{topic}' at {rate_hz} Hz.")
+
+    def stop_telemetry(self):
+        self.telemetry_stop.set()
+        if self.telemetry_thread:
+            self.telemetry_thread.join(timeout=2)
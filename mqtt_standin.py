@@ -0,0 +1,179 @@
+# mqtt_standin.py
+# Minimal local MQTT 3.1.1 broker stand-in for testing MQTTPublisher
+# without the Home Assistant broker.
+#
+# Supports CONNECT, PUBLISH (QoS 0 and 1), SUBSCRIBE ('#' and '+'
+# wildcards), PINGREQ and DISCONNECT; every received message is kept in
+# .messages with its arrival time. It can be stopped and started again on
+# the same port to test reconnects.
+#
+# Usage: python mqtt_standin.py [--port 1883]   (prints what it receives)
+
+import argparse
+import socket
+import socketserver
+import struct
+import threading
+import time
+
+CONNECT, CONNACK, PUBLISH, PUBACK, SUBSCRIBE, SUBACK = 1, 2, 3, 4, 8, 9
+PINGREQ, PINGRESP, DISCONNECT = 12, 13, 14
+
+
+def topic_matches(pattern, topic):
+    pattern_parts = pattern.split("/")
+    topic_parts = topic.split("/")
+    for i, part in enumerate(pattern_parts):
+        if part == "#":
+            return True
+        if i >= len(topic_parts) or (part != "+" and part != topic_parts[i]):
+            return False
+    return len(pattern_parts) == len(topic_parts)
+
+
+def encode_packet(packet_type, flags, body):
+    length = len(body)
+    encoded = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        encoded.append(byte | 0x80 if length else byte)
+        if not length:
+            break
+    return bytes([(packet_type << 4) | flags]) + bytes(encoded) + body
+
+
+def read_packet(sock_file):
+    header = sock_file.read(1)
+    if not header:
+        return None, None, None
+    multiplier, length = 1, 0
+    while True:
+        byte = sock_file.read(1)[0]
+        length += (byte & 0x7F) * multiplier
+        multiplier *= 128
+        if not byte & 0x80:
+            break
+    return header[0] >> 4, header[0] & 0x0F, sock_file.read(length)
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        broker = self.server.broker
+        subscriptions = []
+        broker._add_client(self, subscriptions)
+        try:
+            while True:
+                packet_type, flags, body = read_packet(self.rfile)
+                if packet_type is None or packet_type == DISCONNECT:
+                    break
+                if packet_type == CONNECT:
+                    self.send(encode_packet(CONNACK, 0, b"\x00\x00"))
+                elif packet_type == PUBLISH:
+                    qos = (flags >> 1) & 0x03
+                    topic_len = struct.unpack(">H", body[:2])[0]
+                    topic = body[2:2 + topic_len].decode("utf-8")
+                    offset = 2 + topic_len
+                    if qos:
+                        packet_id = body[offset:offset + 2]
+                        offset += 2
+                        self.send(encode_packet(PUBACK, 0, packet_id))
+                    broker._deliver(topic, body[offset:], qos)
+                elif packet_type == SUBSCRIBE:
+                    packet_id, offset, granted = body[:2], 2, bytearray()
+                    while offset < len(body):
+                        topic_len = struct.unpack(">H", body[offset:offset + 2])[0]
+                        subscriptions.append(body[offset + 2:offset + 2 + topic_len].decode("utf-8"))
+                        offset += 2 + topic_len + 1
+                        granted.append(0)
+                    self.send(encode_packet(SUBACK, 0, packet_id + bytes(granted)))
+                elif packet_type == PINGREQ:
+                    self.send(encode_packet(PINGRESP, 0, b""))
+        except (OSError, IndexError):
+            pass
+        finally:
+            broker._remove_client(self)
+
+    def send(self, data):
+        with self.server.broker.lock:
+            self.wfile.write(data)
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class MQTTBrokerStandin:
+    """In-process MQTT broker: start(), stop(), and inspect .messages."""
+
+    def __init__(self, host="127.0.0.1", port=1883, on_message=None):
+        self.host = host
+        self.port = port
+        self.on_message = on_message
+        self.messages = []  # (arrival time, topic, payload, qos)
+        self.lock = threading.Lock()
+        self.clients = {}
+        self.server = None
+        self.thread = None
+
+    def start(self):
+        self.server = _Server((self.host, self.port), _Handler)
+        self.server.broker = self
+        self.port = self.server.server_address[1]  # when started with port 0
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stop listening and drop every client connection (like a broker crash)."""
+        self.server.shutdown()
+        self.server.server_close()
+        with self.lock:
+            clients = list(self.clients)
+        for handler in clients:
+            try:
+                handler.connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _add_client(self, handler, subscriptions):
+        with self.lock:
+            self.clients[handler] = subscriptions
+
+    def _remove_client(self, handler):
+        with self.lock:
+            self.clients.pop(handler, None)
+
+    def _deliver(self, topic, payload, qos):
+        with self.lock:
+            self.messages.append((time.monotonic(), topic, payload, qos))
+            targets = [h for h, subs in self.clients.items() if any(topic_matches(s, topic) for s in subs)]
+        if self.on_message:
+            self.on_message(topic, payload)
+        body = struct.pack(">H", len(topic)) + topic.encode("utf-8") + payload
+        for handler in targets:
+            try:
+                handler.send(encode_packet(PUBLISH, 0, body))
+            except OSError:
+                pass
+
+    def received(self, topic=None):
+        with self.lock:
+            return [m for m in self.messages if topic is None or topic_matches(topic, m[1])]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local MQTT broker stand-in.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=1883)
+    args = parser.parse_args()
+    broker = MQTTBrokerStandin(args.host, args.port,
+                               on_message=lambda t, p: print(f"{t}: {p.decode('utf-8', 'replace')}"))
+    broker.start()
+    print(f"MQTT stand-in listening on {args.host}:{broker.port}. Ctrl+C to stop.")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        broker.stop()
@@ -0,0 +1,120 @@
+# pace_estimator.py
+# Smoothed live speed and pace, fed from the decoded Treadmill Data packets
+# a few times a second (BLEConnection samples it every PACE_PUBLISH_INTERVAL).
+#
+# The instantaneous speed of the treadmill jitters from packet to packet, and
+# so did the pace shown on the kiosk. PaceEstimator publishes instead:
+#
+#   speed_smooth, pace_smooth   exponential moving average of the speed with
+#                               a time constant of tau seconds (independent
+#                               of the packet rate: alpha = 1 - exp(-dt/tau))
+#   speed_30s, pace_30s         distance over the last window_s seconds
+#   pace_1km                    time of the last 1000 m (None before the first km)
+#
+# Each update is O(1) amortised: the rolling windows are deques of
+# (time, distance) points, appended when the distance grows and dropped
+# from the left once out of the window, so the UI renders these values
+# instead of recomputing them over the chart history.
+#
+# Config ("Pace" section of config.json, optional):
+#   "tau_s": 5          time constant of the smoothing
+#   "window_s": 30      rolling window of speed_30s / pace_30s
+
+import collections
+import math
+
+MIN_PACE_SPEED = 0.5  # km/h; slower than that (belt stopping) shows no pace
+
+
+def format_pace(speed_kmh):
+    """Pace "m:ss" per km at speed_kmh, "0:00" when stopped."""
+    if speed_kmh is None or speed_kmh < MIN_PACE_SPEED:
+        return "0:00"
+    seconds = round(3600 / speed_kmh)
+    return f"{seconds // 60}:{seconds % 60:02d}"
+
+
+class PaceEstimator:
+    """Streaming speed and pace estimates; update() with each new reading."""
+
+    def __init__(self, tau=5.0, window=30.0, lap=1000.0):
+        self.tau = tau
+        self.window = window
+        self.lap = lap
+        self.reset()
+
+    def reset(self):
+        """Forget everything (new run)."""
+        self.last_time = None
+        self.distance = 0.0  # m
+        self.speed_smooth = 0.0
+        self.recent = collections.deque()  # (time, distance) over the last window seconds
+        self.last_km = collections.deque()  # (time, distance) over the last lap metres
+
+    def update(self, now, speed, distance=None):
+        """
+        A reading at time now (s): speed in km/h, distance in m if the
+        packet carries it (else the speed is integrated).
+        """
+        last_time = self.last_time
+        self.last_time = now
+        if last_time is None:
+            dt = 0.0
+            self.speed_smooth = speed
+        else:
+            dt = now - last_time
+            if dt > 0:
+                alpha = 1.0 - math.exp(-dt / self.tau) if self.tau > 0 else 1.0
+                self.speed_smooth += alpha * (speed - self.speed_smooth)
+
+        if distance is None:
+            distance = self.distance + speed / 3.6 * max(dt, 0.0)
+        elif distance < self.distance:
+            self.reset()  # counters went back: a new workout
+            self.update(now, speed, distance)
+            return
+        recent = self.recent
+        last_km = self.last_km
+        if distance > self.distance or not recent:
+            point = (now, distance)
+            recent.append(point)
+            last_km.append(point)
+        self.distance = distance
+
+        # Keep one point at or before the window start as the anchor
+        while len(recent) > 1 and recent[1][0] <= now - self.window:
+            recent.popleft()
+        while len(last_km) > 1 and last_km[1][1] <= distance - self.lap:
+            last_km.popleft()
+
+    def speed_window(self):
+        """km/h over the rolling window (shorter at the start)."""
+        if not self.recent or self.last_time is None:
+            return 0.0
+        start_time, start_distance = self.recent[0]
+        span = self.last_time - start_time
+        if span <= 0:
+            return self.speed_smooth
+        return (self.distance - start_distance) / span * 3.6
+
+    def lap_speed(self):
+        """km/h over the last lap metres, None until that far."""
+        if not self.last_km:
+            return None
+        start_time, start_distance = self.last_km[0]
+        span = self.last_time - start_time
+        if self.distance - start_distance < self.lap or span <= 0:
+            return None
+        return (self.distance - start_distance) / span * 3.6
+
+    def values(self):
+        """The fields published in BLEConnection.data_stream."""
+        speed_30s = self.speed_window()
+        lap_speed = self.lap_speed()
+        return {
+            "speed_smooth": round(self.speed_smooth, 2),
+            "pace_smooth": format_pace(self.speed_smooth),
+            "speed_30s": round(speed_30s, 2),
+            "pace_30s": format_pace(speed_30s),
+            "pace_1km": format_pace(lap_speed) if lap_speed is not None else None,
+        }
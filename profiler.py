@@ -0,0 +1,153 @@
+# profiler.py
+# Live diagnosis on the kiosk without stopping the session.
+#
+# sample_stacks() is a sampling profiler over all threads (BLE loop, GLib
+# main loop, Flask, APScheduler...): every `interval` it reads the current
+# frame of each thread with sys._current_frames() and counts the stacks.
+# Nothing is hooked into the profiled code, so the cost is the sampling
+# thread itself (about 1-2% of one core at 100 Hz on the Orange Pi).
+# The result is in the collapsed format ("thread;outer;...;inner count"),
+# ready for flamegraph.pl or https://www.speedscope.app.
+#
+# AsyncioMonitor reports the pending tasks of the bleak loop and keeps the
+# last warnings of the asyncio logger (slow callbacks in debug mode, tasks
+# destroyed while pending, exceptions never retrieved).
+
+import asyncio
+import collections
+import concurrent.futures
+import logging
+import os
+import sys
+import threading
+import time
+
+MAX_SECONDS = 300
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+
+def sample_stacks(seconds, interval=0.01, include_self=False):
+    """
+    Sample the stacks of all threads for `seconds` and return
+    {collapsed stack: samples}. The calling thread is left out unless
+    include_self.
+    """
+    seconds = min(max(seconds, 0), MAX_SECONDS)
+    me = threading.get_ident()
+    counts = collections.Counter()
+    deadline = time.monotonic() + seconds
+    next_sample = time.monotonic()
+    while True:
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me and not include_self:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+            stack.append(names.get(ident, f"thread-{ident}"))
+            counts[";".join(reversed(stack))] += 1
+        next_sample += interval
+        now = time.monotonic()
+        if now >= deadline:
+            break
+        time.sleep(max(next_sample - now, 0))
+    return counts
+
+
+def collapsed(counts):
+    """The samples as flamegraph.pl input, most frequent stacks first."""
+    return "".join(f"{stack} {count}\n" for stack, count in counts.most_common())
+
+
+class _RecentRecords(logging.Handler):
+    def __init__(self, history):
+        super().__init__(logging.WARNING)
+        self.records = collections.deque(maxlen=history)
+
+    def emit(self, record):
+        self.records.append({
+            "time": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(record.created)),
+            "level": record.levelname,
+            "message": record.getMessage(),
+        })
+
+
+class AsyncioMonitor:
+    """
+    Pending tasks and recent asyncio warnings of an event loop running in
+    another thread. With debug=True the loop runs in asyncio debug mode and
+    every callback longer than slow_callback_ms is logged (and kept here);
+    debug mode slows the loop down, so it is off by default.
+    """
+
+    def __init__(self, loop, debug=False, slow_callback_ms=100, history=50):
+        self.loop = loop
+        self.recent = _RecentRecords(history)
+        logging.getLogger("asyncio").addHandler(self.recent)
+        if debug:
+            loop.set_debug(True)
+            loop.slow_callback_duration = slow_callback_ms / 1000
+
+    @staticmethod
+    def _describe(task, stack_limit):
+        info = {
+            "name": task.get_name(),
+            "coro": repr(task.get_coro()),
+            "done": task.done(),
+            "stack": [_frame_name(frame) for frame in task.get_stack(limit=stack_limit)],
+        }
+        if task.done() and not task.cancelled() and task.exception() is not None:
+            info["exception"] = repr(task.exception())
+        return info
+
+    def _tasks(self, stack_limit):
+        return [self._describe(task, stack_limit) for task in asyncio.all_tasks(self.loop)]
+
+    def snapshot(self, stack_limit=20, timeout=1.0):
+        """
+        Tasks collected on the loop itself; if the loop does not answer
+        within `timeout` it is blocked, and the tasks are read from here.
+        """
+        result = {
+            "running": self.loop.is_running(),
+            "closed": self.loop.is_closed(),
+            "debug": self.loop.get_debug(),
+            "slow_callback_ms": round(self.loop.slow_callback_duration * 1000),
+            "blocked": False,
+        }
+        if result["closed"]:
+            result["tasks"] = []
+        elif result["running"]:
+            future = concurrent.futures.Future()
+
+            def collect():
+                try:
+                    future.set_result(self._tasks(stack_limit))
+                except Exception as e:
+                    future.set_exception(e)
+
+            started = time.monotonic()
+            self.loop.call_soon_threadsafe(collect)
+            try:
+                result["tasks"] = future.result(timeout)
+                result["loop_lag_ms"] = round((time.monotonic() - started) * 1000, 3)
+            except concurrent.futures.TimeoutError:
+                result["blocked"] = True
+                result["tasks"] = self._tasks(stack_limit)
+                # Where the loop thread is stuck right now
+                frame = sys._current_frames().get(getattr(self.loop, "_thread_id", None))
+                stack = []
+                while frame is not None and len(stack) < stack_limit:
+                    stack.append(_frame_name(frame))
+                    frame = frame.f_back
+                result["loop_stack"] = stack
+        else:
+            result["tasks"] = self._tasks(stack_limit)
+        result["recent_warnings"] = list(self.recent.records)
+        return result
@@ -0,0 +1,182 @@
+# replay_latency.py
+# Replay a treadmill workout through BLEConnection in real time and check
+# the latency budget of every hop (see latency.py).
+#
+# Packets come from the simulator (or from a capture: one hex packet per
+# line, e.g. the "packet=" column of treadmill_simulator.py) and go through
+# the BLEConnection of app.py (imported with the config.json of the current
+# directory, nothing started) and DBManagement (temporary SQLite file,
+# SQLite stand-in for MySQL). The Flask app of app.py is served by werkzeug
+# on localhost and polled over HTTP like the browser (--poll-ms), so the
+# http hop is recorded by the real /api/treadmill_data route.
+#
+# The rebroadcast hop needs the GATT server (D-Bus, GLib) and is not
+# replayed here: it is reported as not measured, without a budget.
+#
+# Usage: python replay_latency.py [--rate 10] [--duration 60] [--capture packets.txt]
+#                                 [--budget db=5000 --budget http=1100] [--json]
+#
+# Exit code 1 if the p99 of a hop is over its budget. bench.py runs it as
+# the "latency" benchmark (from the repository directory) and fails on
+# that exit code.
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from contextlib import redirect_stdout
+
+from werkzeug.serving import make_server
+
+from latency import HOPS, LatencyTracker
+from treadmill_simulator import TreadmillSimulator, steady_workout
+
+NOT_REPLAYED = ("rebroadcast",)  # hops that need D-Bus
+
+
+class _NoGattServer:
+    """Takes the measures TreadmillSimulate would notify (no D-Bus here)."""
+
+    def set_measures(self, **measures):
+        pass
+
+    def set_raw_packet(self, packet):
+        pass
+
+
+def poll_http(url, poll_ms, stop_event, errors):
+    """The browser: GET /api/treadmill_data every poll_ms (failures go to errors)."""
+    while not stop_event.wait(poll_ms / 1000):
+        try:
+            with urllib.request.urlopen(url, timeout=10) as response:
+                json.load(response)
+        except (urllib.error.URLError, OSError, ValueError) as e:
+            errors.append(str(e))
+
+
+def load_capture(path):
+    with open(path, "r") as file:
+        return [bytes.fromhex(line.split()[0]) for line in file if line.strip()]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Latency budget check on a replayed workout.")
+    parser.add_argument("--rate", type=int, default=10, help="packets per second")
+    parser.add_argument("--duration", type=float, default=60, help="seconds")
+    parser.add_argument("--capture", help="file with one hex packet per line")
+    parser.add_argument("--poll-ms", type=int, default=1000, help="browser poll period")
+    parser.add_argument("--flush-size", type=int, default=30, help="samples per DB write")
+    parser.add_argument("--budget", action="append", default=[], metavar="HOP=MS",
+                        help="p99 budget of a hop, e.g. db=4000 (repeatable)")
+    parser.add_argument("--json", action="store_true", help="end with the p99 of every hop as JSON")
+    args = parser.parse_args(argv)
+
+    # Default budgets: the period of the consumer plus some slack. The packet
+    # that completes a km also writes the lap row (and syncs it) in the handler.
+    budgets = {
+        "decode": 50,
+        "http": args.poll_ms + 100,
+        "db": args.flush_size * 1000 / args.rate + 1000,
+    }
+    for item in args.budget:
+        hop, ms = item.split("=")
+        budgets[hop] = float(ms)
+
+    import app as kiosk
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)  # no access log per poll
+
+    # Every record of the run is kept, not the last 1000 of the kiosk tracker
+    latency = LatencyTracker(window=100000)
+    kiosk.latency_tracker = latency
+    workdir = tempfile.mkdtemp(prefix="replay-")
+    from db_management import DBManagement
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        db_manager = DBManagement({
+            "localfile": os.path.join(workdir, "replay.db"),
+            "remote_uri": f"sqlite:///{os.path.join(workdir, 'remote.db')}",
+            "device_id": "replay",
+            "Mysql": {},
+        })
+
+    connection = kiosk.ble_connection
+    connection.latency = latency
+    connection.treadmill = _NoGattServer()
+    connection.db_manager = db_manager
+    connection.samples_flush_size = args.flush_size
+
+    server = make_server("127.0.0.1", 0, kiosk.app, threaded=True)
+    url = f"http://127.0.0.1:{server.server_port}/api/treadmill_data"
+    stop_event = threading.Event()
+    http_errors = []
+    threads = [
+        threading.Thread(target=server.serve_forever, daemon=True),
+        threading.Thread(target=poll_http, args=(url, args.poll_ms, stop_event, http_errors),
+                         daemon=True),
+    ]
+    for t in threads:
+        t.start()
+
+    period = 1.0 / args.rate
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        if args.capture:
+            packets = load_capture(args.capture)
+            next_time = time.monotonic()
+            for packet in packets[:int(args.duration * args.rate)]:
+                connection.notification_handler(None, packet)
+                next_time += period
+                time.sleep(max(next_time - time.monotonic(), 0))
+            sent = min(len(packets), int(args.duration * args.rate))
+        else:
+            # Start just before the first km so the run, and its sample writes, open at once
+            simulator = TreadmillSimulator(steady_workout(minutes=args.duration / 60 + 1), rate_hz=args.rate,
+                                           start_distance=999)
+            sent = simulator.run(connection.notification_handler, duration=args.duration)
+        connection.flush_samples()
+        stop_event.set()
+        server.shutdown()
+        db_manager.shutdown()
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"Replayed {sent} packets at {args.rate} Hz. Latency (ms):")
+    print(f"  {'hop':12s} {'count':>7s} {'p50':>9s} {'p95':>9s} {'p99':>9s} {'max':>9s} {'budget':>9s}")
+    failed = []
+    p99 = {}
+    snapshot = latency.snapshot()
+    for hop in HOPS:
+        if hop in NOT_REPLAYED:
+            print(f"  {hop:12s} not measured (needs the GATT server on D-Bus)")
+            continue
+        stats = latency.percentiles(hop)
+        if stats is None:
+            print(f"  {hop:12s} no records")
+            failed.append(hop)
+            continue
+        p99[hop] = stats["p99"]
+        count = snapshot[hop]["count"]
+        budget = budgets[hop]
+        status = "ok" if stats["p99"] <= budget else "OVER BUDGET"
+        if status != "ok":
+            failed.append(hop)
+        print(f"  {hop:12s} {count:7d} {stats['p50']:9.1f} {stats['p95']:9.1f} "
+              f"{stats['p99']:9.1f} {stats['max']:9.1f} {budget:9.0f}  {status}")
+
+    if http_errors:
+        print(f"  {len(http_errors)} polls of /api/treadmill_data failed, first: {http_errors[0]}")
+        if "http" not in failed:
+            failed.append("http")
+
+    print("OK" if not failed else f"FAILED: {', '.join(failed)}")
+    if args.json:
+        print(json.dumps({"p99_ms": p99, "budgets_ms": budgets, "failed": failed}))
+    return 0 if not failed else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
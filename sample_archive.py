@@ -0,0 +1,260 @@
+# sample_archive.py
+# Columnar archive of the per-second samples of finished runs.
+#
+# Samples are moved out of SQLite into one NumPy .npz file per month
+# (samples-YYYY-MM.npz). Each file holds one array per column and row group
+# ("speed.0", "speed.1", ...); index.json keeps the row count and the
+# min/max of ts and run_id of every file and row group, so a reader can
+# skip whole files and row groups without opening them, and the ids of the
+# runs each file holds, so a run is never archived twice.
+#
+# By default the samples are copied and stay in SQLite until the Retention
+# job (DBManagement.rollup_old_samples) replaces them; with delete=True
+# they are rolled up and deleted as soon as they are archived. Either way
+# DBManagement.iter_run_samples (exports, best efforts) falls back to
+# iter_run() once a run has left SQLite.
+#
+#   archive = SampleArchive(db_manager, "archive")
+#   archive.archive_finished_runs()
+#   data = archive.read(["ts", "speed"], start=..., end=..., run_ids=[...])
+
+import datetime
+import json
+import os
+
+import numpy as np
+
+COLUMNS = {
+    "run_id": np.int32,
+    "ts": np.float64,
+    "elapsed": np.int32,
+    "distance": np.int32,
+    "speed": np.float32,
+    "bpm": np.int16,
+    "kcal": np.int32,
+}
+# Order of the columns in the rows yielded by DBManagement.iter_run_samples
+SAMPLE_COLUMNS = ("ts", "elapsed", "distance", "speed", "bpm", "kcal")
+
+INDEX_FILE = "index.json"
+
+
+def _stats(arrays):
+    return {
+        "rows": int(len(arrays["ts"])),
+        "ts_min": float(arrays["ts"].min()),
+        "ts_max": float(arrays["ts"].max()),
+        "run_min": int(arrays["run_id"].min()),
+        "run_max": int(arrays["run_id"].max()),
+    }
+
+
+def _overlaps(stats, start, end, run_ids):
+    """False if the min/max statistics prove that no row can match."""
+    if start is not None and stats["ts_max"] < start:
+        return False
+    if end is not None and stats["ts_min"] > end:
+        return False
+    if run_ids is not None and not any(stats["run_min"] <= r <= stats["run_max"] for r in run_ids):
+        return False
+    return True
+
+
+class SampleArchive:
+    """
+    Move samples of finished runs from the local DB to monthly .npz files
+    and read them back as NumPy arrays.
+    """
+
+    def __init__(self, db_manager, directory="archive", row_group_size=65536, min_age_hours=24,
+                 rollup_seconds=60, delete=False):
+        self.db_manager = db_manager
+        self.rollup_seconds = rollup_seconds
+        self.delete = delete
+        self.directory = directory
+        self.row_group_size = row_group_size
+        self.min_age_hours = min_age_hours
+        os.makedirs(self.directory, exist_ok=True)
+
+    # -------------------------
+    # Index
+    # -------------------------
+    def _index_path(self):
+        return os.path.join(self.directory, INDEX_FILE)
+
+    def load_index(self):
+        try:
+            with open(self._index_path(), "r") as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {}
+
+    def _save_index(self, index):
+        tmp = self._index_path() + ".tmp"
+        with open(tmp, "w") as file:
+            json.dump(index, file, indent=1, sort_keys=True)
+        os.replace(tmp, self._index_path())
+
+    # -------------------------
+    # Writer
+    # -------------------------
+    def _run_arrays(self, run_id):
+        """All samples of a run as a dict of column arrays."""
+        columns = {name: [] for name in SAMPLE_COLUMNS}
+        for row in self.db_manager.iter_run_samples(run_id):
+            for name, value in zip(SAMPLE_COLUMNS, row):
+                columns[name].append(value)
+        arrays = {name: np.asarray(values, dtype=COLUMNS[name]) for name, values in columns.items()}
+        arrays["run_id"] = np.full(len(arrays["ts"]), run_id, dtype=COLUMNS["run_id"])
+        return arrays
+
+    def _append(self, filename, index, arrays):
+        """
+        Append arrays as new row group(s) of filename. An .npz cannot be
+        appended in place, so the existing row groups are copied to a new
+        file that replaces the old one once it is complete.
+        """
+        path = os.path.join(self.directory, filename)
+        entry = index.get(filename, {"row_groups": []})
+        members = {}
+        if os.path.exists(path):
+            with np.load(path) as existing:
+                members = {key: existing[key] for key in existing.files}
+
+        rows = len(arrays["ts"])
+        for offset in range(0, rows, self.row_group_size):
+            group = {name: arr[offset:offset + self.row_group_size] for name, arr in arrays.items()}
+            number = len(entry["row_groups"])
+            for name, arr in group.items():
+                members[f"{name}.{number}"] = arr
+            entry["row_groups"].append(_stats(group))
+
+        tmp = path + ".tmp.npz"
+        np.savez(tmp, **members)
+        os.replace(tmp, path)
+
+        groups = entry["row_groups"]
+        entry.update({
+            "rows": sum(g["rows"] for g in groups),
+            "ts_min": min(g["ts_min"] for g in groups),
+            "ts_max": max(g["ts_max"] for g in groups),
+            "run_min": min(g["run_min"] for g in groups),
+            "run_max": max(g["run_max"] for g in groups),
+            "run_ids": sorted(set(entry.get("run_ids", [])) | set(np.unique(arrays["run_id"]).tolist())),
+        })
+        index[filename] = entry
+
+    def archived_runs(self):
+        """Ids of the runs already in the archive."""
+        runs = set()
+        for entry in self.load_index().values():
+            runs.update(entry.get("run_ids", []))
+        return runs
+
+    def archive_finished_runs(self, delete=None):
+        """
+        Archive every run whose last sample is older than min_age_hours and
+        that is not archived yet, grouped by the month of its first sample.
+        With delete (default: self.delete) its samples are then rolled up
+        and deleted from the local DB. Returns the number of archived rows.
+        """
+        if delete is None:
+            delete = self.delete
+        cutoff = datetime.datetime.now().timestamp() - self.min_age_hours * 3600
+        archived_runs = self.archived_runs()
+        run_ids = [r for r in self.db_manager.list_finished_runs(older_than=cutoff)
+                   if r not in archived_runs]
+        if not run_ids:
+            return 0
+
+        by_month = {}
+        for run_id in run_ids:
+            arrays = self._run_arrays(run_id)
+            if len(arrays["ts"]) == 0:
+                continue
+            month = datetime.datetime.fromtimestamp(arrays["ts"][0]).strftime("%Y-%m")
+            by_month.setdefault(month, []).append(arrays)
+
+        index = self.load_index()
+        archived = 0
+        for month, runs in sorted(by_month.items()):
+            arrays = {name: np.concatenate([r[name] for r in runs]) for name in COLUMNS}
+            self._append(f"samples-{month}.npz", index, arrays)
+            # The index must describe the new file before the rows leave SQLite
+            self._save_index(index)
+            archived += len(arrays["ts"])
+            if delete:
+                # Keep a coarse copy in SQLite for the history charts
+                for run in runs:
+                    run_id = int(run["run_id"][0])
+                    self.db_manager.rollup_run_samples(run_id, self.rollup_seconds)
+                    self.db_manager.delete_run_samples(run_id)
+
+        print(f"[SampleArchive] Archived {archived} samples of {len(run_ids)} runs.")
+        return archived
+
+    # -------------------------
+    # Reader
+    # -------------------------
+    def iter_run(self, run_id):
+        """The archived samples of a run as DBManagement.iter_run_samples rows."""
+        data = self.read(SAMPLE_COLUMNS, run_ids=[run_id])
+        order = np.argsort(data["ts"], kind="stable")
+        columns = [data[name][order].tolist() for name in SAMPLE_COLUMNS]
+        return zip(*columns)
+
+    def run_totals(self, run_id):
+        """
+        (samples, max elapsed, max distance, max kcal, mean bpm > 0) of an
+        archived run, as DBManagement.get_run_summary computes them in SQL.
+        """
+        data = self.read(["elapsed", "distance", "kcal", "bpm"], run_ids=[run_id])
+        if len(data["elapsed"]) == 0:
+            return (0, None, None, None, None)
+        bpm = data["bpm"][data["bpm"] > 0]
+        return (len(data["elapsed"]), int(data["elapsed"].max()), int(data["distance"].max()),
+                int(data["kcal"].max()), float(bpm.mean()) if len(bpm) else None)
+
+    def read(self, columns=None, start=None, end=None, run_ids=None):
+        """
+        Return {column: np.ndarray} with the archived samples matching the
+        filters: start/end are epoch seconds (inclusive), run_ids a list.
+        Files and row groups whose min/max statistics exclude the filters
+        are never opened; only the requested columns are loaded.
+        """
+        columns = list(columns) if columns else list(COLUMNS)
+        unknown = [c for c in columns if c not in COLUMNS]
+        if unknown:
+            raise ValueError(f"Unknown columns: {unknown}")
+        if run_ids is not None:
+            run_ids = [int(r) for r in run_ids]
+        # Columns needed to evaluate the filters row by row
+        needed = set(columns)
+        if start is not None or end is not None:
+            needed.add("ts")
+        if run_ids is not None:
+            needed.add("run_id")
+
+        parts = {name: [] for name in columns}
+        for filename, entry in sorted(self.load_index().items()):
+            if not _overlaps(entry, start, end, run_ids):
+                continue
+            with np.load(os.path.join(self.directory, filename)) as npz:
+                for number, group in enumerate(entry["row_groups"]):
+                    if not _overlaps(group, start, end, run_ids):
+                        continue
+                    data = {name: npz[f"{name}.{number}"] for name in needed}
+                    mask = np.ones(group["rows"], dtype=bool)
+                    if start is not None:
+                        mask &= data["ts"] >= start
+                    if end is not None:
+                        mask &= data["ts"] <= end
+                    if run_ids is not None:
+                        mask &= np.isin(data["run_id"], run_ids)
+                    for name in columns:
+                        parts[name].append(data[name][mask])
+
+        return {
+            name: np.concatenate(arrs) if arrs else np.empty(0, dtype=COLUMNS[name])
+            for name, arrs in parts.items()
+        }
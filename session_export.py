@@ -0,0 +1,368 @@
+# session_export.py
+# Export a stored run (laps + per-second samples) as FIT, TCX or GPX.
+#
+# Every exporter is a generator of bytes chunks that reads the samples from
+# a DB cursor (DBManagement.iter_run_samples), so a 3 hour run is streamed
+# to the HTTP response or to a file without being loaded in memory.
+#
+# Usage: python session_export.py <run_id> [--format fit|tcx|gpx] [-o file]
+
+import argparse
+import datetime
+import json
+import struct
+import sys
+from xml.sax.saxutils import escape
+
+FORMATS = {
+    "fit": "application/vnd.ant.fit",
+    "tcx": "application/vnd.garmin.tcx+xml",
+    "gpx": "application/gpx+xml",
+}
+
+CHUNK_SIZE = 64 * 1024
+
+# Laps use the tuple layout of data_stream["average_speeds"]
+LAP_TIME, LAP_KCAL, LAP_AVG_SPEED, LAP_AVG_PACE, LAP_AVG_BPM, LAP_ELAPSED, LAP_TOTAL_KCAL, LAP_DISTANCE = range(8)
+
+
+########################################################################
+# Helpers
+########################################################################
+
+def _run_start(db_manager, summary):
+    """Start of the run as an aware UTC datetime."""
+    # The local DB stores local time without offset
+    local = db_manager.parse_local_datetime(summary["datetime"])
+    return local.astimezone(datetime.timezone.utc)
+
+
+def _run_laps(db_manager, run_id, summary):
+    """
+    Stored laps, plus a last partial lap if the samples go further than
+    the last lap row (e.g. the run was stopped mid-km without saving).
+    """
+    laps = db_manager.get_run_laps(run_id)
+    last_elapsed = laps[-1][LAP_ELAPSED] if laps else 0
+    last_distance = laps[-1][LAP_DISTANCE] if laps else 0
+    last_kcal = laps[-1][LAP_TOTAL_KCAL] if laps else 0
+    if summary["elapsed"] > last_elapsed and summary["distance"] > last_distance:
+        lap_time = summary["elapsed"] - last_elapsed
+        avg_speed = (summary["distance"] - last_distance) / lap_time * 3.6
+        laps.append((lap_time, summary["kcal"] - last_kcal, avg_speed, "",
+                     summary["avg_bpm"], summary["elapsed"], summary["kcal"],
+                     summary["distance"]))
+    return laps
+
+
+def _sample_time(start, sample):
+    """
+    Timestamp of a sample from the treadmill elapsed time, so that records
+    and laps (which only know elapsed) share the same clock.
+    """
+    return start + datetime.timedelta(seconds=sample[1])
+
+
+def _iso(dt):
+    return dt.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def _chunked(parts, size=CHUNK_SIZE):
+    """Group many small str/bytes parts into chunks of about size bytes."""
+    buffer = []
+    length = 0
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode("utf-8")
+        buffer.append(part)
+        length += len(part)
+        if length >= size:
+            yield b"".join(buffer)
+            buffer = []
+            length = 0
+    if buffer:
+        yield b"".join(buffer)
+
+
+########################################################################
+# TCX
+########################################################################
+
+def _tcx_parts(db_manager, run_id, summary):
+    start = _run_start(db_manager, summary)
+    laps = _run_laps(db_manager, run_id, summary)
+    samples = db_manager.iter_run_samples(run_id)
+    sample = next(samples, None)
+
+    yield ('<?xml version="1.0" encoding="UTF-8"?>\n'
+           '<TrainingCenterDatabase xmlns="http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2">\n'
+           '<Activities><Activity Sport="Running">\n'
+           f'<Id>{_iso(start)}</Id>\n')
+
+    lap_start = 0
+    lap_start_distance = 0
+    for lap in laps:
+        lap_begin = start + datetime.timedelta(seconds=lap_start)
+        yield (f'<Lap StartTime="{_iso(lap_begin)}">'
+               f'<TotalTimeSeconds>{lap[LAP_TIME]}</TotalTimeSeconds>'
+               f'<DistanceMeters>{lap[LAP_DISTANCE] - lap_start_distance}</DistanceMeters>'
+               f'<Calories>{int(lap[LAP_KCAL])}</Calories>')
+        if lap[LAP_AVG_BPM] > 0:
+            yield f'<AverageHeartRateBpm><Value>{int(lap[LAP_AVG_BPM])}</Value></AverageHeartRateBpm>'
+        yield '<Intensity>Active</Intensity><TriggerMethod>Distance</TriggerMethod><Track>\n'
+
+        # Trackpoints of this lap: samples up to the lap end
+        while sample is not None and sample[1] <= lap[LAP_ELAPSED]:
+            yield (f'<Trackpoint><Time>{_iso(_sample_time(start, sample))}</Time>'
+                   f'<DistanceMeters>{sample[2]}</DistanceMeters>')
+            if sample[4]:
+                yield f'<HeartRateBpm><Value>{sample[4]}</Value></HeartRateBpm>'
+            yield '</Trackpoint>\n'
+            sample = next(samples, None)
+
+        yield '</Track></Lap>\n'
+        lap_start = lap[LAP_ELAPSED]
+        lap_start_distance = lap[LAP_DISTANCE]
+
+    samples.close()
+    yield (f'<Notes>{escape(f"Treadmill run {run_id}")}</Notes>\n'
+           '</Activity></Activities>\n</TrainingCenterDatabase>\n')
+
+
+########################################################################
+# GPX
+########################################################################
+
+def _gpx_parts(db_manager, run_id, summary, lat=0.0, lon=0.0):
+    """
+    GPX has no distance field and a treadmill has no position: every point
+    is at (lat, lon), so GPX only carries time and heart rate. Use TCX or
+    FIT when the distance matters.
+    """
+    start = _run_start(db_manager, summary)
+    yield ('<?xml version="1.0" encoding="UTF-8"?>\n'
+           '<gpx version="1.1" creator="treadmill" xmlns="http://www.topografix.com/GPX/1/1" '
+           'xmlns:gpxtpx="http://www.garmin.com/xmlschemas/TrackPointExtension/v1">\n'
+           f'<metadata><time>{_iso(start)}</time></metadata>\n'
+           f'<trk><name>Treadmill run {run_id}</name><type>running</type><trkseg>\n')
+    for sample in db_manager.iter_run_samples(run_id):
+        yield (f'<trkpt lat="{lat}" lon="{lon}">'
+               f'<time>{_iso(_sample_time(start, sample))}</time>')
+        if sample[4]:
+            yield (f'<extensions><gpxtpx:TrackPointExtension><gpxtpx:hr>{sample[4]}'
+                   '</gpxtpx:hr></gpxtpx:TrackPointExtension></extensions>')
+        yield '</trkpt>\n'
+    yield '</trkseg></trk>\n</gpx>\n'
+
+
+########################################################################
+# FIT
+########################################################################
+
+FIT_EPOCH = 631065600  # 1989-12-31 00:00:00 UTC in unix time
+
+# Base types
+ENUM, UINT8, UINT16, UINT32, UINT32Z = 0x00, 0x02, 0x84, 0x86, 0x8C
+BASE_FORMATS = {ENUM: "B", UINT8: "B", UINT16: "H", UINT32: "I", UINT32Z: "I"}
+
+# (global message number, [(field number, base type), ...])
+FIT_MESSAGES = {
+    "file_id": (0, [(0, ENUM), (1, UINT16), (2, UINT16), (3, UINT32Z), (4, UINT32)]),
+    "record": (20, [(253, UINT32), (5, UINT32), (6, UINT16), (3, UINT8)]),
+    "lap": (19, [(253, UINT32), (0, ENUM), (1, ENUM), (2, UINT32), (7, UINT32), (8, UINT32),
+                 (9, UINT32), (11, UINT16), (15, UINT8), (254, UINT16)]),
+    "session": (18, [(253, UINT32), (0, ENUM), (1, ENUM), (2, UINT32), (5, ENUM), (6, ENUM),
+                     (7, UINT32), (8, UINT32), (9, UINT32), (11, UINT16), (16, UINT8),
+                     (25, UINT16), (26, UINT16)]),
+    "activity": (34, [(253, UINT32), (0, UINT32), (1, UINT16), (2, ENUM), (3, ENUM), (4, ENUM)]),
+}
+FIT_LOCAL_TYPES = {name: i for i, name in enumerate(FIT_MESSAGES)}
+
+FIT_CRC_TABLE = (0x0000, 0xCC01, 0xD801, 0x1400, 0xF001, 0x3C00, 0x2800, 0xE401,
+                 0xA001, 0x6C00, 0x7800, 0xB401, 0x5000, 0x9C01, 0x8801, 0x4400)
+
+
+def fit_crc(data, crc=0):
+    """CRC-16 used by FIT headers and files."""
+    table = FIT_CRC_TABLE
+    for byte in data:
+        tmp = table[crc & 0xF]
+        crc = ((crc >> 4) & 0x0FFF) ^ tmp ^ table[byte & 0xF]
+        tmp = table[crc & 0xF]
+        crc = ((crc >> 4) & 0x0FFF) ^ tmp ^ table[(byte >> 4) & 0xF]
+    return crc
+
+
+def _fit_definition(name):
+    global_num, fields = FIT_MESSAGES[name]
+    header = struct.pack("<BBBHB", 0x40 | FIT_LOCAL_TYPES[name], 0, 0, global_num, len(fields))
+    return header + b"".join(
+        struct.pack("<BBB", num, struct.calcsize(BASE_FORMATS[base]), base)
+        for num, base in fields
+    )
+
+
+FIT_STRUCTS = {
+    name: struct.Struct("<B" + "".join(BASE_FORMATS[base] for _, base in fields))
+    for name, (_, fields) in FIT_MESSAGES.items()
+}
+
+
+def _fit_message(name, *values):
+    return FIT_STRUCTS[name].pack(FIT_LOCAL_TYPES[name], *values)
+
+
+def _fit_time(dt):
+    return int(dt.timestamp()) - FIT_EPOCH
+
+
+def _fit_parts(db_manager, run_id, summary):
+    """
+    FIT activity file: file_id, one record per sample, laps, session and
+    activity. The header holds the data size, which is known up front
+    because every message has a fixed size and SQLite counts the samples.
+    """
+    start = _run_start(db_manager, summary)
+    laps = _run_laps(db_manager, run_id, summary)
+    start_time = _fit_time(start)
+    end_time = start_time + summary["elapsed"]
+
+    definitions = b"".join(_fit_definition(name) for name in FIT_MESSAGES)
+    data_size = (
+        len(definitions)
+        + FIT_STRUCTS["file_id"].size
+        + summary["samples"] * FIT_STRUCTS["record"].size
+        + len(laps) * FIT_STRUCTS["lap"].size
+        + FIT_STRUCTS["session"].size
+        + FIT_STRUCTS["activity"].size
+    )
+
+    header = struct.pack("<BBHI4s", 14, 0x20, 2132, data_size, b".FIT")
+    yield header + struct.pack("<H", fit_crc(header))
+
+    crc = 0
+    first = definitions + _fit_message("file_id", 4, 255, 0, run_id, start_time)
+    crc = fit_crc(first, crc)
+    yield first
+
+    written = 0
+    for sample in db_manager.iter_run_samples(run_id):
+        if written == summary["samples"]:
+            break  # samples added after the count: the header size is fixed
+        timestamp = _fit_time(_sample_time(start, sample))
+        record = _fit_message(
+            "record",
+            timestamp,
+            int(sample[2] * 100),                 # distance, 1/100 m
+            min(int(sample[3] / 3.6 * 1000), 0xFFFE),  # speed, mm/s
+            sample[4] if sample[4] else 0xFF,     # 0xFF = invalid
+        )
+        crc = fit_crc(record, crc)
+        written += 1
+        yield record
+    # Pad with the last timestamp if rows disappeared while streaming
+    while written < summary["samples"]:
+        record = _fit_message("record", end_time, 0xFFFFFFFF, 0xFFFF, 0xFF)
+        crc = fit_crc(record, crc)
+        written += 1
+        yield record
+
+    tail = []
+    lap_start = 0
+    for index, lap in enumerate(laps):
+        tail.append(_fit_message(
+            "lap",
+            start_time + lap[LAP_ELAPSED],
+            9, 1,  # event lap, event_type stop
+            start_time + lap_start,
+            lap[LAP_TIME] * 1000,
+            lap[LAP_TIME] * 1000,
+            (lap[LAP_DISTANCE] - (laps[index - 1][LAP_DISTANCE] if index else 0)) * 100,
+            max(int(lap[LAP_KCAL]), 0),
+            int(lap[LAP_AVG_BPM]) if lap[LAP_AVG_BPM] > 0 else 0xFF,
+            index,
+        ))
+        lap_start = lap[LAP_ELAPSED]
+    tail.append(_fit_message(
+        "session",
+        end_time,
+        8, 1,  # event session, event_type stop
+        start_time,
+        1, 1,  # sport running, sub_sport treadmill
+        summary["elapsed"] * 1000,
+        summary["elapsed"] * 1000,
+        summary["distance"] * 100,
+        int(summary["kcal"]),
+        int(summary["avg_bpm"]) if summary["avg_bpm"] > 0 else 0xFF,
+        0,
+        len(laps),
+    ))
+    tail.append(_fit_message(
+        "activity",
+        end_time,
+        summary["elapsed"] * 1000,
+        1,
+        0, 26, 1,  # manual, event activity, event_type stop
+    ))
+    tail = b"".join(tail)
+    crc = fit_crc(tail, crc)
+    yield tail + struct.pack("<H", crc)
+
+
+########################################################################
+# Public API
+########################################################################
+
+def export_run(db_manager, run_id, fmt="tcx"):
+    """
+    Return a generator of bytes chunks with the run encoded as fmt
+    (fit, tcx or gpx). Raises LookupError if the run does not exist
+    and ValueError for an unknown format.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"format must be one of {', '.join(FORMATS)}")
+    summary = db_manager.get_run_summary(run_id)
+    if summary is None:
+        raise LookupError(f"run {run_id} not found")
+    parts = {"fit": _fit_parts, "tcx": _tcx_parts, "gpx": _gpx_parts}[fmt]
+    return _chunked(parts(db_manager, run_id, summary))
+
+
+def export_filename(run_id, fmt):
+    return f"treadmill_run_{run_id}.{fmt}"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export a treadmill run as FIT, TCX or GPX.")
+    parser.add_argument("run_id", type=int)
+    parser.add_argument("--format", "-f", choices=sorted(FORMATS), default="tcx")
+    parser.add_argument("--output", "-o", help="output file (default: treadmill_run_<id>.<format>, - for stdout)")
+    parser.add_argument("--config", default="config.json")
+    args = parser.parse_args(argv)
+
+    from db_management import DBManagement
+
+    with open(args.config, "r") as file:
+        config = json.load(file)
+    db_manager = DBManagement(config["Database"])
+    try:
+        chunks = export_run(db_manager, args.run_id, args.format)
+        output = args.output or export_filename(args.run_id, args.format)
+        if output == "-":
+            for chunk in chunks:
+                sys.stdout.buffer.write(chunk)
+        else:
+            with open(output, "wb") as file:
+                for chunk in chunks:
+                    file.write(chunk)
+            print(f"Run {args.run_id} exported to {output}")
+    except (LookupError, ValueError) as e:
+        print(f"Export failed: {e}")
+        return 1
+    finally:
+        db_manager.shutdown()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
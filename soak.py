@@ -0,0 +1,207 @@
+# soak.py
+# Memory soak test: hours of simulated running at accelerated speed.
+#
+# Back-to-back workouts (with rests, the treadmill counters resetting between
+# them) go through the real BLEConnection and DBManagement (temporary SQLite
+# file, SQLite stand-in for MySQL); several clients poll the data_stream
+# like the browser tabs, and every workout is closed like /save_session
+# does. Every simulated hour the harness takes a tracemalloc snapshot and
+# the RSS. Memory may grow while the caches warm up; after that it must stay
+# flat: the run fails if a subsystem (a file of this repo, or an installed
+# package) keeps more memory at the end than after the warm-up.
+#
+# Usage: python soak.py [--hours 12] [--rate 1] [--clients 3] [--warmup 2]
+#                       [--max-growth-kb 256] [--max-rss-mb 32] [--json]
+#
+# Exit code 1 if memory keeps growing. bench.py runs it as the "soak"
+# benchmark and fails on that exit code.
+
+import argparse
+import gc
+import json
+import os
+import resource
+import shutil
+import sys
+import sysconfig
+import tempfile
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+
+from ble_connection import BLEConnection
+from latency import LatencyTracker
+from treadmill_simulator import TreadmillSimulator, hill_workout, interval_workout, steady_workout
+
+SITE_PACKAGES = sysconfig.get_paths()["purelib"]
+STDLIB = sysconfig.get_paths()["stdlib"]
+
+
+def rss_bytes():
+    try:
+        with open("/proc/self/statm", "r") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # peak, not current
+
+
+def subsystem(filename):
+    """Group allocations by repo file, installed package or 'stdlib'."""
+    if filename.startswith(SITE_PACKAGES):
+        return filename[len(SITE_PACKAGES):].lstrip(os.sep).split(os.sep)[0]
+    if filename.startswith(STDLIB):
+        return "stdlib"
+    return os.path.basename(filename)
+
+
+def memory_by_subsystem():
+    gc.collect()
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, __file__),  # the checkpoints themselves
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+        tracemalloc.Filter(False, "<unknown>"),
+    ))
+    sizes = {}
+    for stat in snapshot.statistics("filename"):
+        name = subsystem(stat.traceback[0].filename)
+        sizes[name] = sizes.get(name, 0) + stat.size
+    return sizes
+
+
+class _Peripheral:
+    """Takes the measures like TreadmillSimulate (no D-Bus)."""
+
+    def set_measures(self, **measures):
+        self.measures = measures
+
+
+def close_session(connection, db_manager):
+    """What /save_session does at the end of a workout."""
+    data = {
+        "datetime": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "km": int(connection.data_stream["distance"] * 1000),
+        "elapsed": connection.data_stream["running_time"],
+        "avg_speed": connection.session_average["speed"].mean(),
+        "avg_bpm": connection.session_average["bpm"].mean(),
+        "kcal": connection.data_stream["energy"],
+        "run_id": connection.run_id
+    }
+    db_manager.save_local_session(data)
+    connection.flush_samples()
+    connection.session_average["speed"].clear()
+    connection.session_average["bpm"].clear()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Long-run memory soak test.")
+    parser.add_argument("--hours", type=float, default=12, help="simulated hours")
+    parser.add_argument("--rate", type=int, default=1, help="packets per simulated second")
+    parser.add_argument("--clients", type=int, default=3, help="polling browser tabs")
+    parser.add_argument("--workout-minutes", type=int, default=50)
+    parser.add_argument("--rest-minutes", type=int, default=10)
+    parser.add_argument("--warmup", type=float, default=2, help="hours before the reference snapshot")
+    parser.add_argument("--max-growth-kb", type=int, default=256,
+                        help="allowed growth of one subsystem after the warm-up")
+    parser.add_argument("--max-rss-mb", type=int, default=32, help="allowed RSS growth after the warm-up")
+    parser.add_argument("--json", action="store_true", help="end with the results as JSON")
+    args = parser.parse_args(argv)
+
+    tracemalloc.start(1)
+    workdir = tempfile.mkdtemp(prefix="soak-")
+    from db_management import DBManagement
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        db_manager = DBManagement({
+            "localfile": os.path.join(workdir, "soak.db"),
+            "remote_uri": f"sqlite:///{os.path.join(workdir, 'remote.db')}",
+            "device_id": "soak",
+            "Mysql": {},
+        })
+    latency = LatencyTracker()
+    connection = BLEConnection(_Peripheral(), db_manager, latency=latency)
+
+    workouts = [interval_workout, steady_workout, hill_workout]
+    workout_seconds = args.workout_minutes * 60
+    total_seconds = args.hours * 3600
+    simulated = 0.0       # simulated seconds, rests included
+    next_checkpoint = 0.0
+    checkpoints = []      # (hour, {subsystem: bytes}, rss)
+    packets = 0
+    sessions = 0
+    start = time.perf_counter()
+
+    def checkpoint():
+        checkpoints.append((simulated / 3600, memory_by_subsystem(), rss_bytes()))
+        hour, sizes, rss = checkpoints[-1]
+        print(f"[soak] {hour:5.1f} h  {packets:8d} packets  {sessions:3d} sessions  "
+              f"traced {sum(sizes.values()) / 1024:8.0f} KB  RSS {rss / 2**20:6.1f} MB  "
+              f"({time.perf_counter() - start:.0f}s)", flush=True)
+
+    checkpoint()
+    next_checkpoint = 3600
+    with open(os.devnull, "w") as devnull:
+        while simulated < total_seconds:
+            workout = workouts[sessions % len(workouts)]()
+            simulator = TreadmillSimulator(workout, rate_hz=args.rate, seed=sessions)
+            session_start = simulated
+            for t, packet in simulator.packets(duration=workout_seconds):
+                with redirect_stdout(devnull):
+                    connection.notification_handler(None, packet)
+                packets += 1
+                if packets % args.rate == 0:  # once per simulated second
+                    for _ in range(args.clients):
+                        json.dumps(connection.data_stream)
+                        latency.record("http", connection.last_rx)
+                simulated = session_start + t
+                if simulated >= next_checkpoint:
+                    checkpoint()
+                    next_checkpoint += 3600
+            with redirect_stdout(devnull):
+                close_session(connection, db_manager)
+            sessions += 1
+            simulated += args.rest_minutes * 60
+            while simulated >= next_checkpoint and next_checkpoint <= total_seconds:
+                checkpoint()
+                next_checkpoint += 3600
+
+    wall = time.perf_counter() - start
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        db_manager.shutdown()
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    # Reference: first checkpoint after the warm-up
+    reference = next((c for c in checkpoints if c[0] >= args.warmup), checkpoints[0])
+    final = checkpoints[-1]
+    print(f"\nGrowth from {reference[0]:.1f} h to {final[0]:.1f} h "
+          f"({packets} packets, {sessions} sessions):")
+    failed = []
+    names = sorted(set(reference[1]) | set(final[1]),
+                   key=lambda n: final[1].get(n, 0) - reference[1].get(n, 0), reverse=True)
+    for name in names:
+        growth = final[1].get(name, 0) - reference[1].get(name, 0)
+        if growth > args.max_growth_kb * 1024:
+            failed.append(name)
+        if abs(growth) >= 1024 or name in failed:
+            status = "GROWING" if name in failed else "ok"
+            print(f"  {name:30s} {reference[1].get(name, 0) / 1024:9.1f} KB -> "
+                  f"{final[1].get(name, 0) / 1024:9.1f} KB  {growth / 1024:+9.1f} KB  {status}")
+    rss_growth = final[2] - reference[2]
+    print(f"  {'RSS':30s} {reference[2] / 2**20:9.1f} MB -> {final[2] / 2**20:9.1f} MB  "
+          f"{rss_growth / 2**20:+9.1f} MB  {'GROWING' if rss_growth > args.max_rss_mb * 2**20 else 'ok'}")
+    if rss_growth > args.max_rss_mb * 2**20:
+        failed.append("RSS")
+
+    print("OK" if not failed else f"FAILED: memory keeps growing in {', '.join(failed)}")
+    if args.json:
+        print(json.dumps({
+            "packets_per_s": packets / wall if wall > 0 else 0.0,
+            "max_growth_kb": max((final[1].get(n, 0) - reference[1].get(n, 0)) / 1024 for n in names),
+            "rss_growth_mb": rss_growth / 2**20,
+            "failed": failed,
+        }))
+    return 0 if not failed else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
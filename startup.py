@@ -0,0 +1,206 @@
+# startup.py
+# Cold start of the kiosk: startup timeline and subsystems built in the
+# background.
+#
+# TIMELINE records the wall time of every startup phase (and in which
+# thread it ran) from the start of the process, plus one-off marks such as
+# "http_ready" and "first_sample". app.py logs TIMELINE.report() once
+# everything is up and serves it at /debug/startup:
+#
+#     302.0 ms               imports
+#     305.3 ms               http_ready
+#     306.1 ms  +     417.4 ms  db                         db
+#     306.9 ms  +    1210.8 ms  gatt                       gatt
+#     ...
+#    4210.7 ms               first_sample
+#
+# Deferred builds a subsystem (DB, MQTT, GATT server...) in its own thread;
+# whoever needs it calls .get(), which waits until it is ready. The web UI
+# is served while the D-Bus and BLE stacks are still coming up.
+#
+# python startup.py [module ...] prints the slowest imports of the given
+# modules (default: the ones app.py loads) from `python -X importtime`.
+
+import argparse
+import contextlib
+import logging
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def _process_start():
+    """time.monotonic() of the process start (Linux), else of this import."""
+    try:
+        with open("/proc/self/stat", "r") as file:
+            start_ticks = int(file.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime", "r") as file:
+            uptime = float(file.read().split()[0])
+        age = uptime - start_ticks / os.sysconf("SC_CLK_TCK")
+        return time.monotonic() - max(age, 0.0)
+    except (OSError, ValueError, IndexError):
+        return time.monotonic()
+
+
+class StartupTimeline:
+    """Phases (name, start, end, thread) and marks, relative to the process start."""
+
+    def __init__(self, origin=None):
+        self.origin = origin if origin is not None else _process_start()
+        self.lock = threading.Lock()
+        self.phases = []
+        self.marks = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.monotonic())
+
+    def record(self, name, start, end, thread=None):
+        """Add a phase measured elsewhere (start/end from time.monotonic())."""
+        with self.lock:
+            self.phases.append((name, start, end, thread or threading.current_thread().name))
+
+    def mark(self, name):
+        """Record the first time `name` happens; later calls are ignored."""
+        now = time.monotonic()
+        with self.lock:
+            if name in self.marks:
+                return False
+            self.marks[name] = now
+        return True
+
+    def elapsed(self, name):
+        """Seconds from the process start to mark `name`, or None."""
+        when = self.marks.get(name)
+        return when - self.origin if when is not None else None
+
+    def as_dict(self):
+        with self.lock:
+            phases = sorted(self.phases, key=lambda p: p[1])
+            marks = sorted(self.marks.items(), key=lambda m: m[1])
+        return {
+            "phases": [
+                {"name": name, "start_ms": round((start - self.origin) * 1000, 1),
+                 "duration_ms": round((end - start) * 1000, 1), "thread": thread}
+                for name, start, end, thread in phases
+            ],
+            "marks": {name: round((when - self.origin) * 1000, 1) for name, when in marks},
+        }
+
+    def report(self):
+        timeline = self.as_dict()
+        rows = [(p["start_ms"], f"{p['start_ms']:9.1f} ms  + {p['duration_ms']:9.1f} ms  "
+                                f"{p['name']:26s} {p['thread']}")
+                for p in timeline["phases"]]
+        rows += [(ms, f"{ms:9.1f} ms  {'':13s}{name}") for name, ms in timeline["marks"].items()]
+        return "\n".join(line for _, line in sorted(rows, key=lambda r: r[0]))
+
+
+TIMELINE = StartupTimeline()
+
+
+class NotReady(Exception):
+    """A Deferred subsystem is still starting, or failed to start."""
+
+
+class Deferred:
+    """
+    A subsystem built by factory() in a background thread, inside a
+    timeline phase. get() waits for it and re-raises the factory's error.
+    """
+
+    def __init__(self, name, factory, timeline=TIMELINE):
+        self.name = name
+        self.factory = factory
+        self.timeline = timeline
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self.thread.start()
+        return self
+
+    def _run(self):
+        try:
+            with self.timeline.phase(self.name):
+                self.value = self.factory()
+        except Exception as e:
+            self.error = e
+            logger.exception("Startup of %s failed", self.name)
+        finally:
+            self.done.set()
+
+    @property
+    def ready(self):
+        return self.done.is_set() and self.error is None
+
+    def get(self, timeout=None):
+        if not self.done.wait(timeout):
+            raise NotReady(f"{self.name} is still starting")
+        if self.error is not None:
+            raise NotReady(f"{self.name} failed to start: {self.error}") from self.error
+        return self.value
+
+
+# -X importtime lines: "import time:  self [us] | cumulative | imported package"
+_IMPORTTIME = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)")
+
+APP_IMPORTS = ("flask", "db_management", "mqtt_publisher", "ble_connection", "bleak",
+               "session_export", "ble_treadmill")
+
+
+def parse_importtime(stderr):
+    """[(module, self_us, cumulative_us, depth)] from `python -X importtime` output."""
+    result = []
+    for line in stderr.splitlines():
+        match = _IMPORTTIME.match(line)
+        if match:
+            self_us, cumulative_us, indent, module = match.groups()
+            result.append((module, int(self_us), int(cumulative_us), len(indent) // 2))
+    return result
+
+
+def import_times(module, python=sys.executable, cwd=None):
+    """Import `module` in a fresh interpreter with -X importtime; None if it fails."""
+    process = subprocess.run([python, "-X", "importtime", "-c", f"import {module}"],
+                             capture_output=True, text=True, cwd=cwd)
+    if process.returncode != 0:
+        return None
+    return parse_importtime(process.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Slowest imports of the app modules.")
+    parser.add_argument("modules", nargs="*", default=list(APP_IMPORTS))
+    parser.add_argument("--top", type=int, default=8, help="slowest sub-imports per module")
+    args = parser.parse_args(argv)
+
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    for module in args.modules:
+        times = import_times(module, cwd=cwd)
+        if not times:
+            print(f"{module:40s} import failed")
+            continue
+        # A module's children are listed before it, one level deeper
+        end = max(i for i, t in enumerate(times) if t[0] == module and t[3] == 0)
+        start = max((i + 1 for i, t in enumerate(times[:end]) if t[3] == 0), default=0)
+        print(f"{module:40s} {times[end][2] / 1000:9.1f} ms")
+        children = sorted((t for t in times[start:end] if t[3] == 1), key=lambda t: t[2], reverse=True)
+        for name, _, cumulative, _ in children[:args.top]:
+            print(f"  {name:38s} {cumulative / 1000:9.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -24,6 +24,9 @@ $(document).ready(function () {
     // jQuery selectors for widgets
     const $speedElement = $("#speed");
     const $paceElement = $("#pace");
+    const $pace30sElement = $("#pace-30s");
+    const $pace1kmElement = $("#pace-1km");
+    const $pacePbElement = $("#pace-pb");
     const $bpmElement = $("#bpm");    
     const $energyElement = $("#energy");
     const $tableBody = $("#averageSpeeds");
@@ -44,7 +47,7 @@ $(document).ready(function () {
                 fill: false,
             },
             {
-                label: "Average Speed (km/h)",
+                label: "Last 30 s (km/h)",
                 data: [], // Average speed data
                 borderColor: "red",
                 borderWidth: 2,
@@ -86,15 +89,16 @@ $(document).ready(function () {
     // Function to fetch data from Flask API
     function fetchTreadmillData() {
         $.get("/api/treadmill_data", function(data) {
-            console.log(data);
-            console.log("Data received from server");
-
             // Update widgets using jQuery
-            var speed = data.speed.toFixed(1);
+            // Smoothed on the kiosk (pace_estimator.py), not packet by packet
+            var speed = data.speed_smooth.toFixed(1);
             var bpm = data.bpm;
             var limits = data.limits;
             $speedElement.text(`${speed}`);
-            $paceElement.text(data.pace);
+            $paceElement.text(data.pace_smooth);
+            $pace30sElement.text(data.pace_30s);
+            $pace1kmElement.text(data.pace_1km || "--");
+            $pacePbElement.text(data.pb_pace || "--");
             $bpmElement.text(data.bpm);
             $energyElement.text(data.energy);
             $totalDistanceElement.text(`${data.distance.toFixed(2)} km`);
@@ -136,17 +140,14 @@ $(document).ready(function () {
 
             // Add speed data to the chart
             chartData.labels.push(data.running_time); // Use elapsed time for labels
-            chartData.datasets[0].data.push(speed); // Push speed to the dataset
-
-            // Calculate and update average speed
-            const totalSpeed = chartData.datasets[0].data.reduce((sum, value) => sum + parseFloat(value), 0);
-            const averageSpeed = (totalSpeed / chartData.datasets[0].data.length).toFixed(1);
-            chartData.datasets[1].data = Array(chartData.labels.length).fill(averageSpeed); // Red line for avg speed
+            chartData.datasets[0].data.push(data.speed.toFixed(1)); // Push speed to the dataset
+            chartData.datasets[1].data.push(data.speed_30s.toFixed(1)); // Red line: speed over the last 30 s
 
             // Limit data points to maintain a clean chart
             if (chartData.labels.length > 60) {
                 chartData.labels.shift();
                 chartData.datasets[0].data.shift();
+                chartData.datasets[1].data.shift();
             }
 
             // Update the chart
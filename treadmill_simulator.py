@@ -0,0 +1,406 @@
+# treadmill_simulator.py
+# Realistic FTMS treadmill simulator for stress and soak tests.
+#
+# A TreadmillModel follows a workout (a list of segments of target speed and
+# incline): the belt accelerates and decelerates at a limited rate, the heart
+# rate follows the effort with a first-order lag, and distance, energy and
+# elevation gain are integrated step by step. TreadmillSimulator encodes the
+# model state as Treadmill Data packets (characteristic 0x2ACD) with any
+# combination of flags, at 1 to 100 Hz, and hands them to:
+#
+#   - a callback with the bleak signature, e.g. BLEConnection.notification_handler:
+#       sim = TreadmillSimulator(interval_workout(), rate_hz=50)
+#       sim.run(ble_connection.notification_handler, duration=600, realtime=False)
+#   - a TreadmillSimulate GATT peripheral (ble_treadmill.py):
+#       sim.drive_peripheral(treadmill, duration=3600)
+#
+# The 16-bit elapsed time, 24-bit distance and 16-bit energy fields wrap
+# around like on a real machine; start_elapsed / start_distance put the
+# counters just before the wrap.
+#
+# Usage: python treadmill_simulator.py [--rate 10] [--flags 0x0584] [--workout intervals]
+#                                      [--duration 600] [--fast] [--peripheral]
+
+import argparse
+import math
+import random
+import struct
+import threading
+import time
+from collections import namedtuple
+
+# Treadmill Data flags (FTMS 4.9.1)
+FLAG_MORE_DATA = 1 << 0        # instantaneous speed NOT present
+FLAG_AVG_SPEED = 1 << 1
+FLAG_DISTANCE = 1 << 2
+FLAG_INCLINE = 1 << 3          # inclination + ramp angle
+FLAG_ELEVATION = 1 << 4        # positive + negative elevation gain
+FLAG_INST_PACE = 1 << 5
+FLAG_AVG_PACE = 1 << 6
+FLAG_ENERGY = 1 << 7           # total, per hour, per minute
+FLAG_HEART_RATE = 1 << 8
+FLAG_MET = 1 << 9
+FLAG_ELAPSED = 1 << 10
+FLAG_REMAINING = 1 << 11
+FLAG_FORCE_POWER = 1 << 12     # force on belt + power output
+
+# What our treadmill sends, plus the heart rate of a paired chest strap
+DEFAULT_FLAGS = FLAG_DISTANCE | FLAG_ENERGY | FLAG_HEART_RATE | FLAG_ELAPSED
+# What TreadmillSimulate notifies when it builds the packet itself
+PERIPHERAL_FLAGS = FLAG_DISTANCE | FLAG_ENERGY | FLAG_ELAPSED
+ALL_FLAGS = 0x1FFE  # every field, instantaneous speed included
+
+# FTMS Service Data of the advertisement (FTMS 3.1.1): Flags, Fitness Machine Type
+AD_FLAG_AVAILABLE = 1 << 0     # Fitness Machine Available
+MACHINE_TREADMILL = 1 << 0
+MACHINE_CROSS_TRAINER = 1 << 1
+MACHINE_STEP_CLIMBER = 1 << 2
+MACHINE_STAIR_CLIMBER = 1 << 3
+MACHINE_ROWER = 1 << 4
+MACHINE_INDOOR_BIKE = 1 << 5
+
+MIN_RATE_HZ = 1
+MAX_RATE_HZ = 100
+
+Segment = namedtuple("Segment", ["duration", "speed", "incline"])  # seconds, km/h, %
+
+
+def steady_workout(minutes=30, speed=10.0, incline=0.0):
+    return [Segment(minutes * 60, speed, incline)]
+
+
+def interval_workout(reps=8, fast=14.0, fast_seconds=60, slow=8.0, slow_seconds=90,
+                     warmup_seconds=300, cooldown_seconds=300, incline=1.0):
+    """Warm-up, reps x (fast, slow), cool-down."""
+    workout = [Segment(warmup_seconds, slow, incline)]
+    for _ in range(reps):
+        workout.append(Segment(fast_seconds, fast, incline))
+        workout.append(Segment(slow_seconds, slow, incline))
+    workout.append(Segment(cooldown_seconds, 5.0, 0.0))
+    return workout
+
+
+def hill_workout(reps=5, speed=9.0, hill_seconds=120, flat_seconds=120, incline=6.0):
+    workout = []
+    for _ in range(reps):
+        workout.append(Segment(hill_seconds, speed, incline))
+        workout.append(Segment(flat_seconds, speed, 0.0))
+    return workout
+
+
+WORKOUTS = {
+    "steady": steady_workout,
+    "intervals": interval_workout,
+    "hills": hill_workout,
+}
+
+
+def encode_treadmill_data(flags, speed=0.0, avg_speed=0.0, distance=0, incline=0.0, ramp=0.0,
+                          elevation_up=0.0, elevation_down=0.0, inst_pace=0.0, avg_pace=0.0,
+                          kcal=0, kcal_hour=0, kcal_minute=0, bpm=0, met=0.0, elapsed=0,
+                          remaining=0, force=0, power=0):
+    """
+    Build a Treadmill Data packet with the fields selected by flags, in the
+    FTMS order. Units: speed km/h, distance m, incline %, ramp degrees,
+    elevation m, pace km/min, kcal, bpm, elapsed/remaining s, force N,
+    power W. Counters wrap at their field width; the other values are
+    clamped to the field range.
+    """
+    def u8(v):
+        return struct.pack("<B", min(max(int(round(v)), 0), 0xFF))
+
+    def u16(v):
+        return struct.pack("<H", min(max(int(round(v)), 0), 0xFFFF))
+
+    def s16(v):
+        return struct.pack("<h", min(max(int(round(v)), -0x8000), 0x7FFF))
+
+    def wrap16(v):
+        return struct.pack("<H", int(v) & 0xFFFF)
+
+    parts = [struct.pack("<H", flags & 0xFFFF)]
+    if not flags & FLAG_MORE_DATA:
+        parts.append(u16(speed * 100))
+    if flags & FLAG_AVG_SPEED:
+        parts.append(u16(avg_speed * 100))
+    if flags & FLAG_DISTANCE:
+        parts.append(struct.pack("<I", int(distance) & 0xFFFFFF)[:3])
+    if flags & FLAG_INCLINE:
+        parts.append(s16(incline * 10) + s16(ramp * 10))
+    if flags & FLAG_ELEVATION:
+        parts.append(wrap16(elevation_up * 10) + wrap16(elevation_down * 10))
+    if flags & FLAG_INST_PACE:
+        parts.append(u8(inst_pace * 10))
+    if flags & FLAG_AVG_PACE:
+        parts.append(u8(avg_pace * 10))
+    if flags & FLAG_ENERGY:
+        parts.append(wrap16(kcal) + u16(kcal_hour) + u8(kcal_minute))
+    if flags & FLAG_HEART_RATE:
+        parts.append(u8(bpm))
+    if flags & FLAG_MET:
+        parts.append(u8(met * 10))
+    if flags & FLAG_ELAPSED:
+        parts.append(wrap16(elapsed))
+    if flags & FLAG_REMAINING:
+        parts.append(u16(remaining))
+    if flags & FLAG_FORCE_POWER:
+        parts.append(s16(force) + s16(power))
+    return b"".join(parts)
+
+
+def encode_ftms_service_data(machine_type=MACHINE_TREADMILL, available=True):
+    """FTMS Service Data advertised with UUID 0x1826, so apps can classify the machine unconnected."""
+    return struct.pack("<BH", AD_FLAG_AVAILABLE if available else 0, machine_type)
+
+
+def decode_ftms_service_data(data):
+    """(available, machine_type) from FTMS Service Data, or None if it is too short."""
+    if len(data) < 3:
+        return None
+    flags, machine_type = struct.unpack_from("<BH", data)
+    return bool(flags & AD_FLAG_AVAILABLE), machine_type
+
+
+class TreadmillModel:
+    """
+    Physical state of the treadmill and of the runner, advanced with step(dt).
+    """
+
+    def __init__(self, workout=None, accel=1.0, decel=1.5, incline_rate=0.5, weight_kg=70,
+                 rest_bpm=60, max_bpm=190, vo2max=50.0, hr_tau=25.0, start_elapsed=0,
+                 start_distance=0, seed=None):
+        self.workout = workout if workout is not None else steady_workout()
+        self.accel = accel                # km/h per second
+        self.decel = decel
+        self.incline_rate = incline_rate  # % per second
+        self.weight_kg = weight_kg
+        self.rest_bpm = rest_bpm
+        self.max_bpm = max_bpm
+        self.vo2max = vo2max              # ml/kg/min
+        self.hr_tau = hr_tau              # heart rate time constant (s)
+        self.random = random.Random(seed)
+
+        self.time = 0.0                   # seconds since the start of the workout
+        self.elapsed = float(start_elapsed)
+        self.distance = float(start_distance)  # m
+        self.speed = 0.0                  # km/h
+        self.incline = 0.0                # %
+        self.bpm = float(rest_bpm)
+        self.kcal = 0.0
+        self.elevation_up = 0.0           # m
+        self.vo2 = 3.5
+        self.finished = False
+
+    @property
+    def duration(self):
+        return sum(segment.duration for segment in self.workout)
+
+    def target(self):
+        """(speed, incline) the workout asks for now; (0, 0) once it is over."""
+        t = self.time
+        for segment in self.workout:
+            if t < segment.duration:
+                return segment.speed, segment.incline
+            t -= segment.duration
+        return 0.0, 0.0
+
+    @staticmethod
+    def _approach(value, target, rate_up, rate_down, dt):
+        if target > value:
+            return min(target, value + rate_up * dt)
+        return max(target, value - rate_down * dt)
+
+    def step(self, dt):
+        target_speed, target_incline = self.target()
+        self.speed = self._approach(self.speed, target_speed, self.accel, self.decel, dt)
+        self.incline = self._approach(self.incline, target_incline,
+                                      self.incline_rate, self.incline_rate, dt)
+
+        # Oxygen cost (ACSM equations), walking below 7 km/h
+        metres_min = self.speed * 1000 / 60
+        grade = self.incline / 100
+        if self.speed <= 0:
+            self.vo2 = 3.5
+        elif self.speed < 7.0:
+            self.vo2 = 0.1 * metres_min + 1.8 * metres_min * grade + 3.5
+        else:
+            self.vo2 = 0.2 * metres_min + 0.9 * metres_min * grade + 3.5
+
+        # Heart rate lags behind the effort
+        effort = min(self.vo2 / self.vo2max, 1.0)
+        target_bpm = self.rest_bpm + (self.max_bpm - self.rest_bpm) * effort
+        self.bpm += (target_bpm - self.bpm) * (1 - math.exp(-dt / self.hr_tau))
+
+        metres = self.speed / 3.6 * dt
+        self.distance += metres
+        self.elevation_up += max(metres * grade, 0.0)
+        self.kcal += self.kcal_minute * dt / 60
+        self.time += dt
+        if self.speed > 0 or target_speed > 0:
+            self.elapsed += dt
+        self.finished = self.time >= self.duration and self.speed <= 0
+
+    @property
+    def kcal_minute(self):
+        return self.vo2 * self.weight_kg / 1000 * 5  # ~5 kcal per litre of O2
+
+    @property
+    def pace(self):
+        """km/min, as in the FTMS pace fields."""
+        return self.speed / 60
+
+    def fields(self):
+        """Keyword arguments of encode_treadmill_data for the current state."""
+        hours = self.elapsed / 3600
+        avg_speed = self.distance / 1000 / hours if hours > 0 else 0.0
+        speed_m_s = self.speed / 3.6
+        force = self.weight_kg * 9.81 * self.incline / 100
+        return {
+            "speed": self.speed,
+            "avg_speed": avg_speed,
+            "distance": self.distance,
+            "incline": self.incline,
+            "ramp": math.degrees(math.atan(self.incline / 100)),
+            "elevation_up": self.elevation_up,
+            "elevation_down": 0.0,
+            "inst_pace": self.pace,
+            "avg_pace": avg_speed / 60,
+            "kcal": self.kcal,
+            "kcal_hour": self.kcal_minute * 60,
+            "kcal_minute": self.kcal_minute,
+            "bpm": self.bpm + self.random.uniform(-1.0, 1.0),
+            "met": self.vo2 / 3.5,
+            "elapsed": self.elapsed,
+            "remaining": max(self.duration - self.time, 0),
+            "force": force,
+            "power": force * speed_m_s,
+        }
+
+
+class TreadmillSimulator:
+    """
+    Emit Treadmill Data packets of a TreadmillModel at a fixed rate.
+    """
+
+    def __init__(self, workout=None, rate_hz=1, flags=DEFAULT_FLAGS, model=None, **model_options):
+        if not MIN_RATE_HZ <= rate_hz <= MAX_RATE_HZ:
+            raise ValueError(f"rate_hz must be between {MIN_RATE_HZ} and {MAX_RATE_HZ}")
+        self.rate_hz = rate_hz
+        self.flags = flags
+        self.model = model if model is not None else TreadmillModel(workout, **model_options)
+        self.sent = 0
+        self.stop_event = threading.Event()
+
+    def packet(self):
+        return encode_treadmill_data(self.flags, **self.model.fields())
+
+    def packets(self, duration=None):
+        """
+        Generator of (simulated time, packet), without sleeping. Ends after
+        duration seconds, or when the workout is over.
+        """
+        dt = 1.0 / self.rate_hz
+        while not self.model.finished and (duration is None or self.model.time < duration):
+            self.model.step(dt)
+            self.sent += 1
+            yield self.model.time, self.packet()
+
+    def run(self, handler, duration=None, realtime=True, sender=None):
+        """
+        Call handler(sender, packet) for every packet, like bleak calls a
+        notification handler. With realtime=False the packets are sent as
+        fast as the handler accepts them. Returns the number of packets.
+        stop() ends the run from another thread.
+        """
+        self.stop_event.clear()
+        period = 1.0 / self.rate_hz
+        next_time = time.monotonic()
+        count = 0
+        for _, packet in self.packets(duration):
+            if self.stop_event.is_set():
+                break
+            handler(sender, packet)
+            count += 1
+            if realtime:
+                next_time += period
+                delay = next_time - time.monotonic()
+                if delay > 0:
+                    self.stop_event.wait(delay)
+        return count
+
+    def drive_peripheral(self, treadmill, duration=None):
+        """
+        Feed a TreadmillSimulate GATT server: set_measures() for its own
+        packet builder, and the raw packet so that the selected flags go
+        out over the air unchanged.
+        """
+        def handler(sender, packet):
+            state = self.model
+            treadmill.set_measures(
+                speed_m_s=state.speed,
+                distance_m=int(state.distance) & 0xFFFFFF,
+                energy=int(state.kcal) & 0xFFFF,
+                bpm=int(state.bpm),
+                elapsed_s=int(state.elapsed) & 0xFFFF
+            )
+            treadmill.set_raw_packet(packet)
+
+        return self.run(handler, duration=duration, realtime=True)
+
+    def stop(self):
+        self.stop_event.set()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="FTMS treadmill simulator.")
+    parser.add_argument("--rate", type=int, default=10, help="packets per second (1-100)")
+    parser.add_argument("--flags", type=lambda v: int(v, 0), default=DEFAULT_FLAGS,
+                        help="Treadmill Data flags, e.g. 0x0584 or 0x1ffe")
+    parser.add_argument("--workout", choices=sorted(WORKOUTS), default="intervals")
+    parser.add_argument("--duration", type=float, help="seconds of workout to simulate")
+    parser.add_argument("--start-elapsed", type=int, default=0, help="e.g. 65500 to test the wrap")
+    parser.add_argument("--start-distance", type=int, default=0, help="m, e.g. 16777000")
+    parser.add_argument("--fast", action="store_true", help="do not wait between packets")
+    parser.add_argument("--peripheral", action="store_true",
+                        help="serve the packets as a BLE GATT peripheral (BlueZ)")
+    parser.add_argument("--name", default="Test-Treadmill", help="peripheral device name")
+    args = parser.parse_args(argv)
+
+    simulator = TreadmillSimulator(WORKOUTS[args.workout](), rate_hz=args.rate, flags=args.flags,
+                                   start_elapsed=args.start_elapsed,
+                                   start_distance=args.start_distance)
+
+    if args.peripheral:
+        from ble_treadmill import TreadmillSimulate
+        treadmill = TreadmillSimulate(device_name=args.name,
+                                      notify_interval_ms=max(1000 // args.rate, 10))
+        server_thread = threading.Thread(target=treadmill.start, daemon=True)
+        server_thread.start()
+        try:
+            simulator.drive_peripheral(treadmill, duration=args.duration)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            treadmill.stop()
+        return
+
+    start = time.perf_counter()
+    report_every = args.rate * (60 if args.fast else 1)
+
+    def show(sender, packet):
+        if simulator.sent % report_every == 0:
+            state = simulator.model
+            print(f"t={state.time:7.1f}s speed={state.speed:5.2f} km/h incline={state.incline:4.1f}% "
+                  f"dist={state.distance:8.1f} m bpm={state.bpm:5.1f} kcal={state.kcal:6.1f} "
+                  f"packet={packet.hex()}")
+
+    try:
+        count = simulator.run(show, duration=args.duration, realtime=not args.fast)
+    except KeyboardInterrupt:
+        count = simulator.sent
+    wall = time.perf_counter() - start
+    print(f"{count} packets in {wall:.2f}s ({count / wall:.0f} packets/s)")
+
+
+if __name__ == "__main__":
+    main()